@@ -1,5 +1,5 @@
 import functools
-from typing import Optional
+from typing import Optional, Union
 
 from . import chainable as C
 from . import utils
@@ -234,10 +234,10 @@ class ForeachPSGDKron(C.BaseOpt):
                  split: bool = False, store_triu_as_line: bool = True, foreach: bool = True, q_dtype='float32',
                  stochastic_schedule: bool = False, storage_dtype: str = 'float32', mars: bool = False,
                  caution: bool = False, mars_gamma: float = 0.0025, delayed: Optional[bool] = C.use_default,
-                 cached: Optional[bool] = C.use_default, exp_avg_input: Optional[bool] = C.use_default,
+                 cached: Union[bool, str, None] = C.use_default, exp_avg_input: Optional[bool] = C.use_default,
                  gradient_clipping: C.str_or_fn = C.use_default, update_clipping: C.str_or_fn = C.use_default,  #
                  # expert parameters
-                 precond_init_scale=1.0, precond_lr=0.1):
+                 precond_init_scale=1.0, precond_lr=0.1, precond_rank: int = 0):
         defaults = locals()
         defaults.pop("self")
         self.precond_schedule = defaults.pop(
@@ -296,7 +296,7 @@ SignLaProp = ForeachSignLaProp
 
 __all__ = ["Muon", "RMSprop", "PrecondSchedulePaLMSOAP", "PSGDKron", "PurePSGD", "DelayedPSGD", "CachedPSGDKron",
            "CachedDelayedPSGDKron", "PalmForEachSoap", "PaLMSOAP", "PaLMSFAdamW", "LaProp", "ADOPT",
-           "PrecondScheduleSOAP", "PrecondSchedulePaLMSOAP", 'RMSprop', 'MuonLaProp', 'ForeachSignLaProp'  #
+           "PrecondScheduleSOAP", "PrecondSchedulePaLMSOAP", 'RMSprop', 'MuonLaProp', 'ForeachSignLaProp',  #
                                                                                       "ForeachAdamW", "ForeachSFAdamW",
            "ForeachLaProp", "ForeachADOPT", "ForeachSOAP", "ForeachPSGDKron", "ForeachPurePSGD", "ForeachDelayedPSGD",
            "ForeachCachedPSGDKron", "ForeachCachedDelayedPSGDKron", "ForeachRMSprop", "ForeachMuon",
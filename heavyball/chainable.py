@@ -51,6 +51,8 @@ class FunctionTransform:
 
 
 def _zero_guard(state, key, ref, dtype):
+    if dtype == torch.int8:  # block-wise quantized
+        return _guard_in_state(state, key, lambda: utils.quantized_zeros_like(ref))
     return _guard_in_state(state, key, lambda: torch.zeros_like(ref, dtype=dtype, memory_format=torch.preserve_format))
 
 
@@ -59,14 +61,30 @@ def _storage_dtype(group):
     return getattr(torch, dtype)
 
 
+def _flat_zero_guard(state, key, ref, dtype):
+    missing = [p for p in ref if not _key_in_state(state(p), key)]
+    for p, buf in zip(missing, utils.flat_zeros_like(missing, dtype)):
+        state(p)[key] = buf
+    return [state(p)[key] for p in ref]
+
+
 class ZeroGuard(FunctionTransform):
     def __init__(self, fn, names):
         super().__init__(fn)
-        self.names = names
+        self.names = [name if isinstance(name, str) else name[0] for name in names]
+        # for (name, alloc_fn), alloc_fn(dtype, **kwargs) may return a replacement for zeros_like(ref, dtype=dtype)
+        self.alloc_fns = {name[0]: name[1] for name in names if not isinstance(name, str)}
 
     def __call__(self, state, group, update, grad, param, *args, **kwargs):
-        vars = [[_zero_guard(state(p), self.val_name(name), p, _storage_dtype(group)) for p in param]  #
-                for name in self.names]
+        vars = []
+        for name in self.names:
+            alloc = self.alloc_fns[name](_storage_dtype(group), **kwargs) if name in self.alloc_fns else None
+            if alloc is not None:
+                vars.append([_guard_in_state(state(p), self.val_name(name), functools.partial(alloc, p)) for p in param])
+            elif group.get('flat_state', False) and _storage_dtype(group) != torch.int8:
+                vars.append(_flat_zero_guard(state, self.val_name(name), param, _storage_dtype(group)))
+            else:
+                vars.append([_zero_guard(state(p), self.val_name(name), p, _storage_dtype(group)) for p in param])
         return self.fn(state, group, update, grad, param, *args, *vars, **kwargs)
 
 
@@ -175,6 +193,17 @@ def scale_by_exp_avg_sq(group, update, grad, param, exp_avg_sq):
                                       group['eps'])
 
 
+def _factored_alloc(dtype, **kwargs):
+    return functools.partial(utils.factored_zeros_like, dtype=torch.float32 if dtype == torch.int8 else dtype)
+
+
+@zero_guard(("exp_avg_sq", _factored_alloc))
+@no_state
+def scale_by_factored_exp_avg_sq(group, update, grad, param, exp_avg_sq):
+    return utils.scale_by_factored_exp_avg_sq_(exp_avg_sq, update,
+                                               utils.beta_debias(utils.get_beta2(group), group["step"]), group['eps'])
+
+
 @zero_guard("exp_avg", "exp_avg_sq")
 @no_state
 def scale_by_adam(group, update, grad, param, exp_avg, exp_avg_sq):
@@ -212,7 +241,12 @@ def orthogonalize_grad_to_param(group, update, grad, param):
 @copy_guard(2, "z")
 @no_state
 def update_by_schedule_free(group, update, grad, param, z):
-    group['weight_sum'] = utils.schedule_free_(group['lr'], group['weight_lr_power'], group.get('weight_sum', 0),
+    if group.get('weight_sum_step') == group['step_index']:  # another slice of this step (foreach=False, fused_hook)
+        weight_sum = group['prev_weight_sum']
+    else:
+        weight_sum = group['prev_weight_sum'] = group.get('weight_sum', 0)
+        group['weight_sum_step'] = group['step_index']
+    group['weight_sum'] = utils.schedule_free_(group['lr'], group['weight_lr_power'], weight_sum,
                                                utils.get_beta1(group), param, z, update, grad, group['caution'],
                                                group['r'], group['step'], group['weight_decay'])
     raise SkipUpdate
@@ -227,8 +261,8 @@ def update_by_adopt(group, update, grad, param, exp_avg, exp_avg_sq):
 
     if group['step'] == 2:
         update = utils.promote(update)
-        easq = utils.promote(exp_avg_sq)
-        [utils.set_(ea, u / easq_.sqrt().clamp_(min=group['eps'])) for ea, u, easq_ in zip(exp_avg, update, easq)]
+        easq = utils.promote_state(exp_avg_sq, update)
+        utils.store_state_(exp_avg, [u / easq_.sqrt().clamp_(min=group['eps']) for u, easq_ in zip(update, easq)])
         utils.scale_by_exp_avg_sq_(exp_avg_sq, update, utils.beta_debias(utils.get_beta2(group), group['step']),
                                    group['eps'])
         raise SkipUpdate
@@ -247,8 +281,8 @@ def scale_by_adopt(group, update, grad, param, exp_avg, exp_avg_sq):
 
     if group['step'] == 2:
         update = utils.promote(update)
-        easq = utils.promote(exp_avg_sq)
-        [utils.set_(ea, u / easq_.sqrt().clamp_(min=group['eps'])) for ea, u, easq_ in zip(exp_avg, update, easq)]
+        easq = utils.promote_state(exp_avg_sq, update)
+        utils.store_state_(exp_avg, [u / easq_.sqrt().clamp_(min=group['eps']) for u, easq_ in zip(update, easq)])
         utils.scale_by_exp_avg_sq_(exp_avg_sq, update, utils.beta_debias(utils.get_beta2(group), group['step']),
                                    group['eps'])
         raise SkipUpdate
@@ -257,30 +291,35 @@ def scale_by_adopt(group, update, grad, param, exp_avg, exp_avg_sq):
 
 
 def _init_soap(state, group, update, grad, param, inner: str = ''):
-    utils.init_preconditioner(grad, state, group['max_precond_dim'], group['precondition_1d'])
+    utils.init_preconditioner(grad, state, group['max_precond_dim'], group['precondition_1d'],
+                              param if group.get('async_precond') else None)
+    state['precond_refresh'] = utils.new_precond_refresh()
 
 
 def _init_psgd(state, group, update, grad, param, cached: bool = False, prob: Optional[callable] = None):
     Q, state["exprs"] = utils.init_Q_exprs(grad, group['precond_init_scale'], group['max_size_triangular'],
                                            group['min_ndim_triangular'], group['memory_save_mode'],
-                                           dtype=getattr(torch, group['q_dtype']))
+                                           dtype=getattr(torch, group['q_dtype']), rank=group.get('precond_rank', 0))
     state["Q"] = utils.triu_to_line(Q) if group['store_triu_as_line'] else Q
+    state['precond_refresh'] = utils.new_precond_refresh()
 
     if not cached:
         return
 
-    state['Q_cache'] = [torch.empty_like(q) for q in Q]
+    state['Q_cache'] = []  # allocated by _update_psgd_cache once caching pays off
 
-    expr = [f'{c.upper()}{c}' if q_.ndim == 2 else c for c, q_ in zip(utils.einsum_base, Q)]
-    expr = ','.join(expr)
+    # low-rank factors are cached as-is and applied by lowrank_precond_
+    expr = [f'{c.upper()}{c}' if q_.ndim == 2 else c  #
+            for c, q_ in zip(utils.einsum_base, Q) if not utils.is_lowrank(q_)]
     grad_expr = ''.join(c for c, _ in zip(utils.einsum_base, grad.shape))
-    out_expr = ''.join(c.upper() if c.upper() in expr else c for c in grad_expr)
-    expr = f'{expr},{grad_expr}->{out_expr}'
+    out_expr = ''.join(c.upper() if c.upper() in ''.join(expr) else c for c in grad_expr)
+    expr = f"{','.join(expr + [grad_expr])}->{out_expr}"
 
     state['cache_expr'] = expr
 
 
-def precond_schedule(group, prob: Union[callable, float, None] = None, name: str = 'cumulative_prob'):
+def precond_schedule(group, prob: Union[callable, float, None] = None, name: str = 'cumulative_prob',
+                     store: Optional[dict] = None):
     step = group['step']
     if 'precondition_frequency' in group:
         return step > 0 and step % group['precondition_frequency'] == 0
@@ -292,7 +331,7 @@ def precond_schedule(group, prob: Union[callable, float, None] = None, name: str
     if 'precond_scheduler' in group:
         return utils.precond_schedule(step, group['precond_scheduler'], rng)
     if prob is not None:
-        return utils.psgd_should_update(group, prob, rng, name=name)
+        return utils.psgd_should_update(group, prob, rng, name=name, store=store)
     raise ValueError("No preconditioner update schedule specified.")
 
 
@@ -338,14 +377,21 @@ def heavyball_momentum(group, updates, grads, params, momentum):
     return utils.heavyball_momentum(momentum, updates, utils.get_beta1(group))
 
 
-_optim_fns = {'adam': utils.adam_, 'laprop': utils.laprop_}
+_optim_fns = {'adam': utils.adam_, 'laprop': utils.laprop_, 'adafactor': utils.adafactor_}
+_factored_optim_fns = {'adafactor'}
 
 
-@zero_guard("exp_avg", "exp_avg_sq")
-@general_guard("Q", "GG", init_fn=_init_soap)
+def _soap_second_moment(dtype, inner: str = 'adam'):
+    return _factored_alloc(dtype) if inner in _factored_optim_fns else None
+
+
+@zero_guard("exp_avg", ("exp_avg_sq", _soap_second_moment))
+@general_guard("Q", "GG", ("precond_refresh", None), init_fn=_init_soap)
 @no_state
-def scale_by_soap(group, update, grad, param, exp_avg, exp_avg_sq, Q, GG, inner: str = 'adam'):
+def scale_by_soap(group, update, grad, param, exp_avg, exp_avg_sq, Q, GG, precond_refresh, inner: str = 'adam'):
     update = utils.promote(update)  # Promote to highest precision if needed
+    if group.get('async_precond'):
+        utils.swap_async_bases(param, Q, exp_avg)
 
     grad_projected = [utils.project(u, q, False) for u, q in zip(update, Q)]
     fn = _optim_fns[inner]
@@ -353,49 +399,122 @@ def scale_by_soap(group, update, grad, param, exp_avg, exp_avg_sq, Q, GG, inner:
                  group['eps'])
     precond = [utils.project(p, q, True) for p, q in zip(precond, Q)]
 
-    for u, q, gg, ea in zip(update, Q, GG, exp_avg):
-        utils.update_preconditioner(u, q, gg, ea, group['max_precond_dim'], group['precondition_1d'],
-                                    utils.beta_debias(group['shampoo_beta'], group['step']),
-                                    group['is_preconditioning'])
+    refresh = _refresh_schedule(group, precond_refresh)
+    if group['adaptive_precond'] and any(refresh):
+        idx = [i for i, r in enumerate(refresh) if r]
+        utils.adapt_precond_schedule_([precond_refresh[i] for i in idx],
+                                      [utils.soap_basis_drift(Q[i], GG[i]) for i in idx],
+                                      group['adaptive_precond_target'])
+
+    rotated = exp_avg  # rotated into the new eigenbases when refreshing them
+    if any(refresh) and any(utils.is_quantized(ea) for ea in exp_avg):
+        rotated = utils.promote_state(exp_avg, update)
+    utils.foreach_update_preconditioner(update, Q, GG, rotated, group['max_precond_dim'], group['precondition_1d'],
+                                        utils.beta_debias(group['shampoo_beta'], group['step']), refresh,
+                                        param if group.get('async_precond') else None, param)
+    if rotated is not exp_avg:
+        utils.store_state_(exp_avg, rotated)
     return precond
 
 
-def _update_psgd_precond(cached, Q_cache, group, param, grad, Q_mat, Q, exprs, prob: Optional[callable] = None):
-    if prob is None:
-        prob = utils.precond_update_prob_schedule()
-
-    if not group['is_preconditioning']:
-        return Q_mat
+def _refresh_schedule(group, precond_refresh):
+    """
+    Whether to refresh each parameter's preconditioner in this step: per parameter with `adaptive_precond`, otherwise
+    (and for state from before it existed) following the optimizer's schedule.
+    """
+    if not group.get('adaptive_precond') or any(r is None for r in precond_refresh):
+        return [group['is_preconditioning']] * len(precond_refresh)
+    return [r.pop('due') if 'due' in r else utils.adaptive_should_update(r, group['precond_prob'])  # see _refresh_due
+            for r in precond_refresh]
 
-    utils.psgd_update_precond(Q_mat, exprs, getattr(param, 'hessian_vector', grad), group['precond_lr'], Q,
-                              group['store_triu_as_line'], getattr(param, 'vector', None))
-    if hasattr(param, 'vector'):
-        del param.vector
-        del param.hessian_vector
 
-    if grad.dim() > 1 and precond_schedule(group, balance_probability, f"balance_prob_{id(Q)}"):
+def _update_psgd_precond(cached, Q_cache, group, param, grad, Q_mat, Q, exprs, precond_refresh,
+                         prob: Optional[callable] = None):
+    """
+    Refreshes the preconditioners due in this step and their caches. Q_mat is the `_unpack_psgd_Q` of Q. Both are
+    updated, and the returned Q_mat stays valid for preconditioning without unpacking Q again.
+    """
+    refresh = _refresh_schedule(group, precond_refresh)
+    Q_mat = [[utils.unpack_triu(q_) for q_ in q] if r else q for q, r in zip(Q_mat, refresh)]
+    if any(refresh):
+        owned = utils.precond_owned(param) or [True] * len(param)  # with precond_shard, other ranks update the rest
+        ref = [i for i, r in enumerate(refresh) if r]
+        idx = [i for i in ref if owned[i]]
+        G = {i: getattr(param[i], 'hessian_vector', grad[i]) for i in ref}
+        V = {i: getattr(param[i], 'vector', None) for i in ref}
+        noise = {i: utils.psgd_update_noise(G[i], V[i], Q[i]) for i in ref}  # on every rank, to keep their RNG in sync
+        with utils.precond_rng_fork(grad[0].device):
+            drifts = utils.foreach_psgd_update_precond([Q_mat[i] for i in idx], [exprs[i] for i in idx],
+                                                       [G[i] for i in idx], group['precond_lr'], [Q[i] for i in idx],
+                                                       group['store_triu_as_line'], [V[i] for i in idx],
+                                                       [noise[i] for i in idx])
+            for i in ref:  # the schedule has to run on every rank to keep them in sync
+                q, r = Q[i], precond_refresh[i]
+                name = 'balance_prob' if r is not None else f"balance_prob_{id(q)}"  # r is checkpointed, id(q) isn't
+                if grad[i].dim() > 1 and precond_schedule(group, balance_probability, name, r) and owned[i]:
+                    utils.psgd_balance_Q(Q_mat[i])
+                    if group['store_triu_as_line']:
+                        utils.update_triu_(q, Q_mat[i])
+        for p in param:
+            if hasattr(p, 'vector'):
+                del p.vector
+                del p.hessian_vector
+        utils.sync_precond_([param[i] for i in ref], [Q[i] for i in ref])
         if group['store_triu_as_line']:
-            utils.psgd_balance_Q([q_ for _, q_ in Q])
-        else:
-            utils.psgd_balance_Q(Q)
+            for i in ref:
+                if not owned[i]:  # received from its owner
+                    Q_mat[i] = [utils.unpack_triu(q_) for q_ in Q[i]]
 
-    if isinstance(prob, float):
-        float_prob = prob
-    else:
-        float_prob = prob(group.get(f'cumulative_prob_{id(Q)}_prob_step', 1))
-    group['is_cached'] = should_use_cache = cached and float_prob < 0.5
+        if group['adaptive_precond']:
+            drifts = dict(zip(idx, drifts))
+            drifts = [drifts[i] if i in drifts else torch.zeros((), device=grad[i].device) for i in ref]
+            utils.sync_precond_([param[i] for i in ref], drifts)
+            utils.adapt_precond_schedule_([precond_refresh[i] for i in ref], drifts, group['adaptive_precond_target'])
+
+    if not cached:
+        return Q_mat
 
-    if should_use_cache:  # caching adds extra ops and is not worth the overhead when we precondition at every step
-        return _update_psgd_cache(cached, Q_cache, Q_mat)
+    if prob is None and group.get('precond_prob') is None:  # e.g. a custom BaseOpt without a precond_schedule
+        prob = utils.precond_update_prob_schedule()
+
+    for g, q, q_mat, q_cache, r in zip(grad, Q, Q_mat, Q_cache, refresh):
+        if prob is None:  # the optimizer's own schedule
+            float_prob = group['precond_prob']
+        elif isinstance(prob, float):
+            float_prob = prob
+        else:
+            float_prob = prob(group.get(f'cumulative_prob_{id(q)}_prob_step', 1))
+        if cached == 'auto':
+            should_use_cache = utils.psgd_cache_pays_off(q, g, float_prob)
+        else:  # caching adds extra ops and is not worth the overhead when we precondition at every step
+            should_use_cache = float_prob < 0.5
+
+        if not should_use_cache:
+            q_cache.clear()
+        elif r or not q_cache:
+            _update_psgd_cache(q_cache, [utils.unpack_triu(q_) for q_ in q_mat])
     return Q_mat
 
 
-def _update_psgd_cache(cached, Q_cache, q):
-    if not cached:
-        return q
+def _unpack_psgd_Q(Q, Q_cache):
+    """
+    Unpacks (see `utils.unpack_triu`) the `store_triu_as_line` Q of every parameter that's preconditioned without its
+    cache. The others stay packed, until `_update_psgd_precond` needs them.
+    """
+    return [[utils.unpack_triu(q_) for q_ in q] if not q_cache else q for q, q_cache in zip(Q, Q_cache)]
 
+
+def _update_psgd_cache(Q_cache, q):
+    """
+    Refreshes Q_cache (a list, empty while the cache is inactive) to Q^T Q of every factor of q (unpacked, see
+    `_unpack_psgd_Q`). Low-rank factors are copied instead, as their Q^T Q would be dense.
+    """
+    if not Q_cache:
+        Q_cache.extend(torch.empty_like(q_) for q_ in q)
     for c_, q_ in zip(Q_cache, q):
-        if q_.ndim == 2:
+        if utils.is_lowrank(q_):
+            c_.copy_(q_)
+        elif q_.ndim == 2:
             torch.matmul(q_.T, q_, out=c_)
         else:
             torch.mul(q_, q_, out=c_)
@@ -403,51 +522,61 @@ def _update_psgd_cache(cached, Q_cache, q):
 
 
 def _cached_psgd_precond_grad(group, cache_expr, exprs, update, Q_mat, Q_cache, grad):
-    if group.get('is_cached', False):
-        out = utils.precond_grad_cached_(cache_expr, update, *Q_cache, caution=group['caution'], grad=grad)
-    out = utils.psgd_precond_grad(exprs[-1], update, *Q_mat, caution=group['caution'], grad=grad)
+    out = []
+    for c_expr, expr, u, q_mat, q_cache, g in zip(cache_expr, exprs, update, Q_mat, Q_cache, grad):
+        if q_cache:
+            o = utils.precond_grad_cached_(utils.psgd_precond_plan(c_expr, u, q_cache, True), u, *q_cache,
+                                           caution=group['caution'], grad=g)
+        else:
+            o = utils.psgd_precond_grad(utils.psgd_precond_plan(expr[-1], u, q_mat), u, *q_mat,
+                                        caution=group['caution'], grad=g)
+        out.append(o)
     group['caution'] = False  # we already cautioned here - shouldn't do it again
     return out
 
 
 def _fused_cached_psgd_precond_grad(group, grad, param, cache_expr, exprs, update, Q_mat, Q_cache):
-    if group.get('is_cached', False):
-        utils.fused_precond_grad_cached_(cache_expr, update, param, group['lr'], grad, group['weight_decay'],
-                                         group['caution'], *Q_cache)
-    else:
-        utils.fused_psgd_precond_grad(exprs[-1], update, param, group['lr'], grad, group['weight_decay'],
-                                      group['caution'], *Q_mat)
+    for g, p, c_expr, expr, u, q_mat, q_cache in zip(grad, param, cache_expr, exprs, update, Q_mat, Q_cache):
+        if q_cache:
+            utils.fused_precond_grad_cached_(utils.psgd_precond_plan(c_expr, u, q_cache, True), u, p, group['lr'], g,
+                                             group['weight_decay'], group['caution'], *q_cache)
+        else:
+            utils.fused_psgd_precond_grad(utils.psgd_precond_plan(expr[-1], u, q_mat), u, p, group['lr'], g,
+                                          group['weight_decay'], group['caution'], *q_mat)
 
 
-@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), init_fn=_init_psgd, skip_first=False)
-@no_state_no_foreach
-def scale_by_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, cached: bool = False,
+@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), ("precond_refresh", None), init_fn=_init_psgd,
+               skip_first=False)
+@no_state
+def scale_by_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, precond_refresh, cached: bool = False,
                   prob: Optional[callable] = None):
-    update = update.to(memory_format=torch.contiguous_format)
-    Q_mat = utils.line_to_triu(Q) if group['store_triu_as_line'] else Q
+    update = [u.to(memory_format=torch.contiguous_format) for u in update]
     Q_mat = _update_psgd_precond(cached, Q_cache, group, param,
-                                 update if group['momentum_into_precond_update'] else grad, Q_mat, Q, exprs, prob)
+                                 update if group['momentum_into_precond_update'] else grad,
+                                 _unpack_psgd_Q(Q, Q_cache), Q, exprs, precond_refresh, prob)
     return _cached_psgd_precond_grad(group, cache_expr, exprs, update, Q_mat, Q_cache, grad)
 
 
-@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), init_fn=_init_psgd, skip_first=False)
-@no_state_no_foreach
-def scale_by_delayed_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, cached: bool = False,
-                          prob: Optional[callable] = None):
-    Q_mat = utils.line_to_triu(Q) if group['store_triu_as_line'] else Q
+@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), ("precond_refresh", None), init_fn=_init_psgd,
+               skip_first=False)
+@no_state
+def scale_by_delayed_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, precond_refresh,
+                          cached: bool = False, prob: Optional[callable] = None):
+    Q_mat = _unpack_psgd_Q(Q, Q_cache)
     precond = _cached_psgd_precond_grad(group, cache_expr, exprs, update, Q_mat, Q_cache, grad)
     _ = _update_psgd_precond(cached, Q_cache, group, param, update if group['momentum_into_precond_update'] else grad,
-                             Q_mat, Q, exprs, prob)
+                             Q_mat, Q, exprs, precond_refresh, prob)
     return precond
 
 
-@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), init_fn=_init_psgd, skip_first=False)
-@no_state_no_foreach
-def update_by_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, cached: bool = False,
-                   prob: Optional[callable] = None):
-    Q_mat = utils.line_to_triu(Q) if group['store_triu_as_line'] else Q
+@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), ("precond_refresh", None), init_fn=_init_psgd,
+               skip_first=False)
+@no_state
+def update_by_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, precond_refresh,
+                   cached: bool = False, prob: Optional[callable] = None):
     Q_mat = _update_psgd_precond(cached, Q_cache, group, param,
-                                 update if group['momentum_into_precond_update'] else grad, Q_mat, Q, exprs, prob)
+                                 update if group['momentum_into_precond_update'] else grad,
+                                 _unpack_psgd_Q(Q, Q_cache), Q, exprs, precond_refresh, prob)
     _fused_cached_psgd_precond_grad(group, update, param, cache_expr, exprs, update, Q_mat, Q_cache)
     raise SkipUpdate
 
@@ -457,14 +586,15 @@ def sign(group, update, grad, param, graft: bool = True):
     return utils.sign_(update, graft)
 
 
-@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), init_fn=_init_psgd, skip_first=False)
-@no_state_no_foreach
-def update_by_delayed_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, cached: bool = False,
-                           prob: Optional[callable] = None):
-    Q_mat = utils.line_to_triu(Q) if group['store_triu_as_line'] else Q
+@general_guard("Q", "exprs", ("Q_cache", None), ("cache_expr", None), ("precond_refresh", None), init_fn=_init_psgd,
+               skip_first=False)
+@no_state
+def update_by_delayed_psgd(group, update, grad, param, Q, exprs, Q_cache, cache_expr: str, precond_refresh,
+                           cached: bool = False, prob: Optional[callable] = None):
+    Q_mat = _unpack_psgd_Q(Q, Q_cache)
     _fused_cached_psgd_precond_grad(group, update, param, cache_expr, exprs, update, Q_mat, Q_cache)
     _ = _update_psgd_precond(cached, Q_cache, group, param, update if group['momentum_into_precond_update'] else grad,
-                             Q_mat, Q, exprs, prob)
+                             Q_mat, Q, exprs, precond_refresh, prob)
     raise SkipUpdate
 
 
@@ -475,6 +605,7 @@ def palm_beta2(state, group, update, grad, param):
 
 
 def apply_to_idx(fn, idx):
+    @functools.wraps(fn)
     def _fn(state, group, update, grad, param):
         args = [state, group, update, grad, param]
         return fn(args[idx])
@@ -484,9 +615,14 @@ def apply_to_idx(fn, idx):
 
 def _inner_chain(state, group, update, grad, param, *fns):
     skip_update = False
+    profiler = utils.active_profiler()
     for fn in fns:
         try:
-            update = fn(state, group, update, grad, param)
+            if profiler is None:
+                update = fn(state, group, update, grad, param)
+            else:
+                with profiler.measure(_fn_name(fn), param[0]):
+                    update = fn(state, group, update, grad, param)
         except SkipUpdate:
             skip_update = True
             continue
@@ -495,11 +631,75 @@ def _inner_chain(state, group, update, grad, param, *fns):
     return update, skip_update
 
 
+def _base_fn(fn):
+    if isinstance(fn, functools.partial):
+        fn = fn.func
+    if isinstance(fn, FunctionTransform):
+        fn = fn.get_fn()
+    return fn
+
+
+def _fn_name(fn):
+    fn = _base_fn(fn)
+    return getattr(fn, '__name__', type(fn).__name__)
+
+
+def _chain_segments(fns):
+    segments = []
+    for fn in fns:
+        traceable = _base_fn(fn) not in _untraceable
+        if segments and segments[-1][0] == traceable:
+            segments[-1][1].append(fn)
+        else:
+            segments.append((traceable, [fn]))
+    return segments
+
+
+_compiled_inner_chain = None
+
+
+def _segmented_chain(state, group, update, grad, param, *fns):
+    """
+    Runs every maximal run of traceable transforms as one `torch.compile` region, so that Inductor can fuse across
+    transforms. Untraceable transforms (see `_untraceable`) run eagerly in between.
+    """
+    global _compiled_inner_chain
+    if utils.compile_mode is None:
+        return _inner_chain(state, group, update, grad, param, *fns)
+    if _compiled_inner_chain is None:
+        _compiled_inner_chain = torch.compile(_inner_chain, dynamic=utils.dynamic, mode=utils.compile_mode)
+
+    skip_update = False
+    step, lr = group['step'], group['lr']
+    for traceable, segment in _chain_segments(fns):
+        if traceable:  # pass step and lr in as tensors to avoid recompiling whenever they change
+            group['step'], group['lr'] = utils.scalar_guard(step, lr, param[0], name='chain')
+            try:
+                with utils.profiled(f'compiled[{"+".join(map(_fn_name, segment))}]', param[0]):
+                    update, skip = _compiled_inner_chain(state, group, update, grad, param, *segment)
+            finally:
+                group['step'], group['lr'] = step, lr
+        else:
+            update, skip = _inner_chain(state, group, update, grad, param, *segment)
+        skip_update |= skip
+        if update is None:
+            break
+    return update, skip_update
+
+
 def chain(state: Union[callable, dict], group, grad, param, *fns):
-    update = [torch.clone(g, memory_format=torch.preserve_format) for g in grad]
-    update, skip_update = _inner_chain(state, group, update, grad, param, *fns)
+    if group.get('flat_state', False):
+        update = utils.flat_clone(grad)
+    else:
+        update = [torch.clone(g, memory_format=torch.preserve_format) for g in grad]
+    if group.get('compile_chain', False):
+        update, skip_update = _segmented_chain(state, group, update, grad, param, *fns)
+    else:
+        update, skip_update = _inner_chain(state, group, update, grad, param, *fns)
     if not skip_update and update is not None:
-        utils.update_param_(param, update, group['lr'], group['weight_decay'], caution=group['caution'], grad=grad)
+        with utils.profiled('update_param_', param[0]):
+            utils.update_param_(param, update, group['lr'], group['weight_decay'], caution=group['caution'],
+                                grad=grad)
 
 
 def create_branch(branches: List[List[callable]], merge_fn: callable):
@@ -518,11 +718,24 @@ def create_branch(branches: List[List[callable]], merge_fn: callable):
 
 class ChainOpt(utils.StatefulOptimizer):
     promote: bool = False
+    flat_state: bool = False
+    compile_chain: bool = False
+    capturable: bool = False
+    async_precond: bool = False
+    adaptive_precond: bool = False
+    adaptive_precond_target: float = 0.05
 
     def __init__(self, params, defaults, foreach: bool, *fns):
         super().__init__(params, defaults, foreach)
         self.fns = tuple(fns)
 
+    def _refresh_due(self, group, view):
+        refresh = self.state[view].get('precond_refresh') if view in self.state else None
+        if refresh is None or not group.get('adaptive_precond', self.adaptive_precond):
+            return super()._refresh_due(group, view)
+        refresh['due'] = utils.adaptive_should_update(refresh, self._precond_prob)  # consumed by _refresh_schedule
+        return refresh['due']
+
     def _step(self, group):
         if 'base_lr' not in group:
             group['base_lr'] = group['lr']
@@ -532,6 +745,18 @@ class ChainOpt(utils.StatefulOptimizer):
             group['base_lr'] = group['lr']
 
         caution = group['caution']
+        group.setdefault('flat_state', self.flat_state)
+        compile_chain = group.setdefault('compile_chain', self.compile_chain)
+        capturable = group.setdefault('capturable', self.capturable)
+        if group.setdefault('async_precond', self.async_precond) and (self.offload_state or self.offload_step):
+            raise ValueError("async_precond refreshes bases in the background, so it can't be used with offloading.")
+        if group['async_precond'] and _storage_dtype(group) == torch.int8:
+            raise ValueError("async_precond rotates exp_avg in the background, so it can't be used with int8 storage.")
+        group.setdefault('adaptive_precond_target', self.adaptive_precond_target)
+        adaptive = group.setdefault('adaptive_precond', self.adaptive_precond)
+        if adaptive and self.hessian_approx and not self.hessian_subset:
+            raise ValueError("hessian_approx computes Hessian-vector products on the optimizer's refresh schedule, so "
+                             "the per-parameter schedules of adaptive_precond need hessian_subset.")
 
         vals = list(self.split_p_and_g_in_group(group, should_promote=self.promote, beta1=utils.get_beta1(group)))
 
@@ -541,16 +766,26 @@ class ChainOpt(utils.StatefulOptimizer):
 
         for param in p:
             state = self.state_(param)
-            if 'step' in state:
+            initialized = 'step' in state
+            if initialized:
                 step = state['step']
+            elif capturable:
+                step = state['step'] = torch.zeros((), dtype=torch.int64, device=param.device)
             elif self.compile_step:
                 step = utils.scalar_guard(0, param)
             else:
                 step = 0
             break
 
-        group['step'] = state['step'] = step = step + 1
-        group['prev_lr'] = group['lr'] = group['base_lr'] * step / max(step, group['warmup_steps'] + 1)
+        if capturable:  # step and warmup live on device and are updated in-place, so that the step can be replayed
+            group['step'] = step.add_(1)
+            group['prev_lr'] = group['base_lr']
+            group['lr'] = utils.warmup_lr_(utils.scalar_buffer('lr', p[0]), group['base_lr'], step,
+                                           group['warmup_steps'])
+        else:
+            group['step'] = state['step'] = step = step + 1
+            group['prev_lr'] = group['lr'] = group['base_lr'] * step / max(step, group['warmup_steps'] + 1)
+        group['compile_chain'] = compile_chain and initialized  # state is initialized eagerly in the first step
 
         if not group['foreach'] or len(p) == 1:
             for param, grad in zip(p, g):
@@ -559,9 +794,88 @@ class ChainOpt(utils.StatefulOptimizer):
             chain(self.state_, group, g, p, *self.fns)
 
         group['caution'] = caution
+        group['compile_chain'] = compile_chain
         group['lr'] = group['prev_lr']
         group['step'] = None
 
+    def _state_key_origins(self) -> dict:
+        origins = super()._state_key_origins()
+        for fn in self.fns:
+            while isinstance(fn, (functools.partial, FunctionTransform)):
+                if isinstance(fn, functools.partial):
+                    fn = fn.func
+                    continue
+                if isinstance(fn, (ZeroGuard, CopyGuard)):
+                    origins.update({fn.val_name(name): (fn.fn_name, name) for name in fn.names})
+                elif isinstance(fn, GeneralGuard):
+                    names = [name if isinstance(name, str) else name[0] for name in fn.names]
+                    origins.update({name: (fn.fn_name, name) for name in names})
+                fn = fn.fn
+        return origins
+
+    def memory_report(self) -> dict:
+        """
+        See `StatefulOptimizer.memory_report`. Additionally estimates the transient memory of a step under
+        `transient`: the cloned update plus the largest temporaries of any single transform, summed over the
+        parameters processed together (all of a group with foreach=True, one at a time otherwise).
+        Before the first step, preconditioner sizes are derived from the shapes and the group's size limits.
+        """
+        report = super().memory_report()
+        origins = self._state_key_origins()
+        state_names = {}
+        for transform, name in origins.values():
+            state_names.setdefault(transform, set()).add(name)
+
+        peak, by_transform = 0, {}
+        for group in self.param_groups:
+            group_total = {}
+            for p in group['params']:
+                views = self.mapping.get(p, (p,))
+                states = dict(self._group_states({'params': [p]}))
+                estimate = {'update': p.numel() * (4 if self.promote else p.element_size())}
+                for fn in self.fns:
+                    name = _fn_name(fn)
+                    estimate[name] = sum(_transient_bytes(v, states.get(v, {}), state_names.get(name, ()), group)
+                                         for v in views)
+                estimate['update_param_'] = p.numel() * 4
+                for name, size in estimate.items():
+                    if group['foreach']:
+                        group_total[name] = group_total.get(name, 0) + size
+                    else:
+                        group_total[name] = max(group_total.get(name, 0), size)
+            for name, size in group_total.items():
+                by_transform[name] = max(by_transform.get(name, 0), size)
+            if group_total:
+                update = group_total.pop('update')
+                peak = max(peak, update + max(group_total.values(), default=0))
+        report['transient'] = {'peak': peak, 'by_transform': by_transform}
+        return report
+
+
+def _preconditioner_dims(view, state, group, key, limit):
+    if key not in state:  # not initialized yet
+        if view.dim() < 2 and not group.get('precondition_1d', False):
+            return []
+        return [d for d in view.shape if 1 < d <= limit]
+    shapes = [m[0] if isinstance(m, tuple) else getattr(m, 'shape', None) for m in state[key]]  # (shape, line) or Q
+    return [shape[-1] for shape in shapes if shape is not None and len(shape) == 2 and shape[0] == shape[1]]
+
+
+def _transient_bytes(view, state, names, group) -> int:
+    """
+    Rough upper bound on the temporaries a transform allocates for one (merged) parameter: two fp32 copies of the
+    update for elementwise transforms, plus the projected/preconditioned update and batched QR (SOAP) or the noisy
+    gradient, A/conjB and per-factor terms (PSGD).
+    """
+    fp32 = view.numel() * 4
+    if 'GG' in names:
+        dims = _preconditioner_dims(view, state, group, 'GG', group.get('max_precond_dim', 0))
+        return 3 * fp32 + sum(4 * d * d * 4 for d in dims)
+    if 'exprs' in names:
+        dims = _preconditioner_dims(view, state, group, 'Q', group.get('max_size_triangular', 0))
+        return 3 * fp32 + sum(3 * d * d * 4 for d in dims)
+    return 2 * fp32
+
 
 use_default = object()
 str_or_fn = Union[str, callable, None, Literal[use_default]]
@@ -592,6 +906,13 @@ _scale_to_update_map_inv = {update_by_delayed_psgd.get_fn(): scale_by_delayed_ps
                             update_by_laprop.get_fn(): scale_by_laprop,  #
                             update_by_adopt.get_fn(): scale_by_adopt}
 
+# python control flow on the step count, RNG-driven schedules, eigh retries or per-parameter loops
+# these run eagerly when `compile_chain` is enabled
+_untraceable = {scale_by_soap.get_fn(), scale_by_psgd.get_fn(), scale_by_delayed_psgd.get_fn(),
+                update_by_psgd.get_fn(), update_by_delayed_psgd.get_fn(), update_by_schedule_free.get_fn(),
+                scale_by_adopt.get_fn(), update_by_adopt.get_fn(), orthogonalize_update.get_fn(), mup_approx.get_fn(),
+                palm_beta2}
+
 
 class BaseOpt(ChainOpt):
     """
@@ -615,6 +936,40 @@ class BaseOpt(ChainOpt):
     This will turn off
     This is syntactic sugar, equivalent to manually passing the function as the last element of the optimizer chain.
 
+    compile_chain: bool = False
+    Whether to trace all transforms of a param group into a single `torch.compile` graph, with step and lr passed in as
+    tensors. Transforms that can't be traced (e.g. SOAP, PSGD) fall back to eager execution between compiled segments.
+    Has no effect if `utils.compile_mode` is None. Can be overridden per param group via `group['compile_chain']`
+
+    capturable: bool = False
+    Whether to keep the step count and the warmed-up learning rate in persistent device tensors that are updated
+    in-place. Combined with the fused update_by_* transforms (e.g. ForeachAdamW, ForeachLaProp), a step then runs
+    without host synchronization and can be captured as a CUDA graph. `group['lr']` keeps the base learning rate.
+
+    async_precond: bool = False
+    Whether to compute SOAP's eigenbases (the initial eigendecomposition and the periodic QR refresh) on a background
+    thread and, on GPU, a side stream. New bases are swapped in, with exp_avg rotated accordingly, at the first step after
+    they are ready, so the preconditioner lags a few steps behind in exchange for never stalling the step.
+
+    profiler: Optional[utils.StepProfiler] = None
+    Set to a `heavyball.utils.StepProfiler()` to record host/device time, compiles and skipped updates per transform,
+    param group and step. Export with `profiler.to_dict()` or `profiler.chrome_trace(path)`.
+
+    flat_state: bool = False
+    Whether to allocate zero-initialized state (exp_avg, exp_avg_sq, momentum) as one contiguous buffer per param group
+    and hand out per-parameter views. Elementwise kernels then run on the whole buffer at once instead of launching
+    once per parameter. Only takes effect with foreach=True and floating-point `storage_dtype`. Can be overridden per
+    param group via `group['flat_state']`
+
+    adaptive_precond: bool = False
+    Whether SOAP and PSGD refresh each parameter's preconditioner on its own schedule. The optimizer's refresh
+    probability is scaled per parameter, doubling it when the preconditioner drifted by more than
+    `adaptive_precond_target` between refreshes and halving it below half of that, so that layers whose curvature has
+    settled stop paying for refreshes. PSGD measures the drift as |dQ| / |Q| of an update, SOAP as the relative
+    off-diagonal mass of Q^T GG Q. Inspect the per-parameter rates with `precond_report()`. Can be overridden per
+    param group via `group['adaptive_precond']` and `group['adaptive_precond_target']`. Combined with
+    `hessian_approx`, it needs `hessian_subset`.
+
     """
 
     gradient_clipping: str_or_fn = None
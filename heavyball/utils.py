@@ -1,19 +1,29 @@
+import concurrent.futures
+import contextlib
+import copy
 import functools
 import gc
+import json
 import math
+import os
 import random
 import string
+import time
 import warnings
-from typing import List, Optional, Tuple, Callable, Union
+import weakref
+from typing import Dict, List, Optional, Tuple, Callable, Union
 from unittest.mock import patch
 
 import numpy as np
+import opt_einsum as oe
 import torch
+import torch.distributed as dist
 from torch import Tensor
 from torch._dynamo import config
 from torch._dynamo.exc import TorchDynamoException
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.backends import cudnn, opt_einsum
-from torch.utils._pytree import tree_map
+from torch.utils._pytree import tree_map, tree_flatten
 
 config.cache_size_limit = 2 ** 16
 
@@ -63,6 +73,44 @@ def decorator_knowngood(func: Callable):
 
 einsum_base = string.ascii_lowercase
 
+_einsum_plans = {}
+
+
+def einsum_plan(expr: str, *shapes) -> Union[str, Tuple[str, Tuple[Tuple[Tuple[int, ...], str], ...]]]:
+    """
+    Contraction plan for `expr` on operands of the given shapes: `(expr, steps)`, where each step contracts the
+    operands at the given positions with a pairwise einsum and appends the result. The path is found by opt_einsum
+    once per (expr, shapes) and cached, so it's neither recomputed nor left to torch.einsum's operand order per step,
+    even with `set_torch()`'s `opt_einsum.enabled = False`. Expressions with fewer than three operands are returned
+    as-is. Pass the result to `contract`, including from compiled kernels, which can't search for paths themselves.
+    """
+    if expr.count(',') < 2:
+        return expr
+    shapes = tuple(tuple(sh) for sh in shapes)
+    key = (expr, shapes)
+    if key not in _einsum_plans:
+        _, info = oe.contract_path(expr, *shapes, shapes=True, optimize='auto-hq')
+        _einsum_plans[key] = (expr, tuple((tuple(step[0]), step[2]) for step in info.contraction_list))
+    return _einsum_plans[key]
+
+
+def contract(plan: Union[str, Tuple], *operands: Tensor) -> Tensor:
+    """
+    Evaluates an `einsum_plan` as a chain of pairwise contractions. Eagerly, plain expressions are planned (and
+    cached) on the fly; while compiling, they're passed to torch.einsum.
+    """
+    if isinstance(plan, str):
+        if is_compiling():
+            return torch.einsum(plan, *operands)
+        plan = einsum_plan(plan, *[o.shape for o in operands])
+        if isinstance(plan, str):
+            return torch.einsum(plan, *operands)
+    operands = list(operands)
+    for idx, expr in plan[1]:
+        args = [operands.pop(i) for i in idx]  # descending, in the operand order of `expr`
+        operands.append(torch.einsum(expr, *args))
+    return operands[0]
+
 
 @decorator_knowngood
 def _compilable_schedule_free_(p: List[Tensor], z: List[Tensor], ckp1: Tensor, update: List[Tensor], lr: Tensor,
@@ -93,7 +141,7 @@ def schedule_free_(lr: float, weight_lr_power: float, weight_sum: float, beta1:
         ckp1 = 0
 
     update, parameters, z, grad = list_guard(update, parameters, z, grad)
-    lr, ckp1, beta1 = scalar_guard(lr, ckp1, beta1, grad[0])
+    lr, ckp1, beta1 = scalar_guard(lr, ckp1, beta1, grad[0], name='schedule_free')
     _compilable_schedule_free_(parameters, z, ckp1, update, lr, beta1, decay, grad, caution)
     return weight_sum
 
@@ -180,7 +228,7 @@ def _compilable_exp_avg_sq_(state: List[Tensor], grad: List[Tensor], beta2: Tens
 
 def exp_avg_sq_(state, grad, beta2, eps, out=None):
     state, grad, out = list_guard(state, grad, out)
-    beta2, eps = scalar_guard(beta2, eps, state[0])
+    beta2, eps = scalar_guard(beta2, eps, state[0], name='exp_avg_sq')
     return _compilable_exp_avg_sq_(state, grad, beta2, eps, out)
 
 
@@ -194,8 +242,67 @@ def _compilable_scale_by_exp_avg_sq_(state: List[Tensor], grad: List[Tensor], be
 
 def scale_by_exp_avg_sq_(exp_avg_sq, grad, beta2, eps):
     grad, exp_avg_sq = list_guard(grad, exp_avg_sq)
-    beta2, eps = scalar_guard(beta2, eps, grad[0])
-    _compilable_scale_by_exp_avg_sq_(exp_avg_sq, grad, beta2, eps)
+    flat_grad, exp_avg_sq = flat_views(grad, exp_avg_sq)
+    beta2, eps = scalar_guard(beta2, eps, grad[0], name='scale_by_exp_avg_sq')
+    _compilable_scale_by_exp_avg_sq_(exp_avg_sq, flat_grad, beta2, eps)
+    return grad
+
+
+def factored_zeros_like(ref: Tensor, dtype: Optional[torch.dtype] = None) -> Tensor:
+    """
+    Zero-initialized state for `factored_exp_avg_sq_`. Tensors that `dim_merger` reduces to a matrix [m, n] (e.g. conv
+    kernels to [out, in * k * k]) keep m row and n column statistics in one tensor of size m + n, others a full-size
+    second moment.
+    """
+    dtype = ref.dtype if dtype is None else dtype
+    merged = dim_merger(ref, math.inf)
+    if merged.dim() != 2:
+        return torch.zeros_like(ref, dtype=dtype)
+    return torch.zeros(sum(merged.shape), dtype=dtype, device=ref.device)
+
+
+@decorator_knowngood
+def _compilable_factored_exp_avg_sq_(state: List[Tensor], grad: List[Tensor], beta2: Tensor, eps: Tensor):
+    denom = []
+    for s, g in zip(state, grad):
+        g32 = promote(g)
+        merged = dim_merger(g32, math.inf)
+        if merged.dim() != 2:
+            denom.append(eps_sqrt(_lerp([s], [g32 * g32], beta2)[0], eps))
+            continue
+        sq = merged * merged
+        m = merged.shape[0]
+        row, col = s[:m], s[m:]
+        row32 = promote(row).lerp(sq.mean(1), 1 - beta2)
+        col32 = promote(col).lerp(sq.mean(0), 1 - beta2)
+        copy_stochastic_(row, row32)
+        copy_stochastic_(col, col32)
+        v = row32[:, None] * col32[None, :] / row32.mean().clamp(min=torch.finfo(torch.float32).tiny)
+        denom.append(eps_sqrt(v, eps).view(g.shape))
+    return denom
+
+
+def factored_exp_avg_sq_(state: List[Tensor], grad: List[Tensor], beta2: float, eps: float) -> List[Tensor]:
+    """
+    Adafactor's second moment: updates the row and column means of grad ** 2 (see `factored_zeros_like`) and returns
+    the square root of their rank-1 reconstruction, `row * col / mean(row)`, as denominator.
+    """
+    state, grad = list_guard(state, grad)
+    beta2, eps = scalar_guard(beta2, eps, grad[0], name='factored_exp_avg_sq')
+    return _compilable_factored_exp_avg_sq_(state, grad, beta2, eps)
+
+
+@decorator_knowngood
+def _compilable_scale_by_factored_exp_avg_sq_(state: List[Tensor], grad: List[Tensor], beta2: Tensor, eps: Tensor):
+    g32 = list(map(promote, grad))
+    denom = _compilable_factored_exp_avg_sq_(state, g32, beta2, eps)
+    copy_stochastic_list_(grad, torch._foreach_div(g32, denom))
+
+
+def scale_by_factored_exp_avg_sq_(exp_avg_sq, grad, beta2, eps):
+    grad, exp_avg_sq = list_guard(grad, exp_avg_sq)
+    beta2, eps = scalar_guard(beta2, eps, grad[0], name='scale_by_factored_exp_avg_sq')
+    _compilable_scale_by_factored_exp_avg_sq_(exp_avg_sq, grad, beta2, eps)
     return grad
 
 
@@ -207,8 +314,8 @@ def _compilable_exp_avg_(state, grad, beta):
 
 def scale_by_exp_avg_(state, grad, beta):
     state, grad = list_guard(state, grad)
-    beta = scalar_guard(beta, state[0])
-    _compilable_exp_avg_(state, grad, beta)
+    beta = scalar_guard(beta, state[0], name='exp_avg')
+    _compilable_exp_avg_(*flat_views(state, grad), beta)
     return grad
 
 
@@ -231,7 +338,7 @@ def adaptive_gradient_clipping_(parameters: List[Tensor], gradients: List[Tensor
     if clip_val <= 0:
         return gradients
     parameters, gradients = list_guard(parameters, gradients)
-    clip_val = scalar_guard(clip_val, parameters[0])
+    clip_val = scalar_guard(clip_val, parameters[0], name='agc')
     _compilable_agc_(parameters, gradients, clip_val, minimum, eps)
     return gradients
 
@@ -300,34 +407,34 @@ def ortho(x):
 
 @decorator_knowngood
 def _compilable_heavyball_momentum_(state, grad, beta):
-    s32, g32 = [list(map(promote, x)) for x in (state, grad)]
+    s32, g32 = promote_state(state, grad), list(map(promote, grad))
     s32 = torch._foreach_mul(s32, beta)
     s32 = torch._foreach_add(s32, g32)
-    copy_stochastic_list_(state, s32)
+    store_state_(state, s32)
     copy_stochastic_list_(grad, s32)
 
 
 @decorator_knowngood
 def _compilable_nesterov_momentum_(state, grad, beta):
-    s32, g32 = [list(map(promote, x)) for x in (state, grad)]
+    s32, g32 = promote_state(state, grad), list(map(promote, grad))
     s32 = torch._foreach_mul(s32, beta)
     s32 = torch._foreach_add(s32, g32)
     g32 = [g + s * beta for g, s in zip(g32, s32)]
-    copy_stochastic_list_(state, s32)
+    store_state_(state, s32)
     copy_stochastic_list_(grad, g32)
 
 
 def heavyball_momentum(state, grad, beta):
     state, grad = list_guard(state, grad)
-    beta = scalar_guard(beta, state[0])
-    _compilable_heavyball_momentum_(state, grad, beta)
+    beta = scalar_guard(beta, state[0], name='heavyball_momentum')
+    _compilable_heavyball_momentum_(*flat_views(state, grad), beta)
     return grad
 
 
 def nesterov_momentum(state, grad, beta):
     state, grad = list_guard(state, grad)
-    beta = scalar_guard(beta, state[0])
-    _compilable_nesterov_momentum_(state, grad, beta)
+    beta = scalar_guard(beta, state[0], name='nesterov_momentum')
+    _compilable_nesterov_momentum_(*flat_views(state, grad), beta)
     return grad
 
 
@@ -339,8 +446,8 @@ def _compilable_nesterov_ema_(state, grad, beta):
 
 def nesterov_ema(state, grad, beta):
     state, grad = list_guard(state, grad)
-    beta = scalar_guard(beta, state[0])
-    _compilable_nesterov_ema_(state, grad, beta)
+    beta = scalar_guard(beta, state[0], name='nesterov_ema')
+    _compilable_nesterov_ema_(*flat_views(state, grad), beta)
     return grad
 
 
@@ -376,42 +483,35 @@ def _compilable_scatter_set(target, source, index):
     target[:] = source.contiguous()[index].reshape_as(target)
 
 
-#@decorator_knowngood
-def get_orthogonal_matrix_QR(GG: List[Tensor], Q: List[Tensor], exp_avg: Optional[Tensor] = None):
-    """
-    Computes the eigenbases of the preconditioner using one round of power iteration
-    followed by torch.linalg.qr decomposition, and updates exp_avg in-place from old to new eigenspace.
-
-    :param GG: List of accumulated gradient outer products.
-    :param Q: List of current eigenbases (updated in-place to Q_new).
-    :param exp_avg: Exponential moving average in the old eigenspace (updated in-place if provided).
-    """
-    if isinstance(Q, list) and not Q:
-        return
+def _shape_buckets(mats: List[Optional[Tensor]]):
+    buckets = {}
+    for i, m in enumerate(mats):
+        if m is not None:
+            buckets.setdefault((m.shape, m.dtype, m.device), []).append(i)
+    return buckets.values()
 
-    if exp_avg is not None and exp_avg.dim() != len(Q):
-        raise ValueError(f"exp_avg dim {exp_avg.dim()} does not match Q length {len(Q)}")
 
-    new_qs = []
-
-    for m, q in zip(GG, Q):
-        if m is None:
-            new_qs.append(None)
-            continue
+def _power_iteration_qr(GG: List[Tensor], Q: List[Tensor]):
+    """
+    One round of power iteration followed by QR, batched over same-shaped preconditioners.
+    """
+    m = torch.stack([promote(m_.data) for m_ in GG])
+    q_old = torch.stack([promote(q_.data) for q_ in Q])
 
-        m = promote(m.data)
-        q_old = promote(q.data)
+    tmp = m @ q_old
+    est_eig = torch.einsum('bij,bij->bj', q_old, tmp)
+    sort_idx = torch.argsort(est_eig, dim=-1, descending=True)
+    sort_idx = sort_idx.unsqueeze(1).expand_as(tmp)
 
-        tmp = m @ q_old
-        est_eig = torch.einsum('ij,ij->j', q_old, tmp)
-        sort_idx = torch.argsort(est_eig, descending=True)
+    q_new, _ = torch.linalg.qr(tmp.gather(2, sort_idx))
+    return tmp.scatter_(2, sort_idx, q_new).unbind(0)
 
-        tmp[:, sort_idx], _ = torch.linalg.qr(tmp[:, sort_idx])
-        new_qs.append(tmp)
 
+def _rotate_exp_avg_(Q: List[Optional[Tensor]], new_qs: List[Optional[Tensor]], exp_avg: Optional[Tensor]):
     if exp_avg is None:
         for q, q_new in zip(Q, new_qs):
-            copy_stochastic_(q, q_new)
+            if q is not None:
+                copy_stochastic_(q, q_new)
         return
 
     assert exp_avg.ndim < 13, "exp_avg.ndim must be less than 13"
@@ -426,7 +526,7 @@ def get_orthogonal_matrix_QR(GG: List[Tensor], Q: List[Tensor], exp_avg: Optiona
     out_str = ''.join([o if o in to_shampoo else i for i, o in zip(in_str, out_str)])
 
     subscripts = f'{in_str},{from_shampoo},{to_shampoo}->{out_str}'
-    exp_avg_new = torch.einsum(subscripts, exp_avg, *[q for q in Q if q is not None], *[q for q in new_qs if q is not None])
+    exp_avg_new = contract(subscripts, exp_avg, *[q for q in Q if q is not None], *[q for q in new_qs if q is not None])
     copy_stochastic_(exp_avg, exp_avg_new)
 
     for q, q_new in zip(Q, new_qs):
@@ -434,40 +534,189 @@ def get_orthogonal_matrix_QR(GG: List[Tensor], Q: List[Tensor], exp_avg: Optiona
             copy_stochastic_(q, q_new)
 
 
-def get_orthogonal_matrix(mat):
+def _foreach_power_iteration_qr(GGs: List[List[Optional[Tensor]]], Qs: List[List[Optional[Tensor]]]):
+    flat_gg, flat_q, index = [], [], []
+    for i, (GG, Q) in enumerate(zip(GGs, Qs)):
+        for j, (m, q) in enumerate(zip(GG, Q)):
+            if m is not None:
+                flat_gg.append(m)
+                flat_q.append(q)
+                index.append((i, j))
+
+    new_qs = [[None] * len(Q) for Q in Qs]
+    for bucket in _shape_buckets(flat_gg):
+        for k, q_new in zip(bucket, _power_iteration_qr([flat_gg[k] for k in bucket], [flat_q[k] for k in bucket])):
+            i, j = index[k]
+            new_qs[i][j] = q_new
+    return new_qs
+
+
+def foreach_orthogonal_matrix_QR(GGs: List[List[Tensor]], Qs: List[List[Tensor]],
+                                 exp_avgs: Optional[List[Tensor]] = None):
     """
-    Computes the eigenbases of the preconditioner using torch.linalg.eigh decomposition.
+    Like `get_orthogonal_matrix_QR`, but for the preconditioners of many parameters at once. All preconditioners of
+    the same shape (e.g., the [d, d] factors of a transformer's layers) share a single batched matmul and QR.
+
+    :param GGs: Per-parameter lists of accumulated gradient outer products.
+    :param Qs: Per-parameter lists of current eigenbases (updated in-place).
+    :param exp_avgs: Per-parameter exponential moving averages in the old eigenspaces (updated in-place if provided).
     """
+    if exp_avgs is None:
+        exp_avgs = [None] * len(Qs)
+    for Q, exp_avg in zip(Qs, exp_avgs):
+        if exp_avg is not None and Q and exp_avg.dim() != len(Q):
+            raise ValueError(f"exp_avg dim {exp_avg.dim()} does not match Q length {len(Q)}")
+
+    new_qs = _foreach_power_iteration_qr(GGs, Qs)
+    for Q, new_q, exp_avg in zip(Qs, new_qs, exp_avgs):
+        if Q:
+            _rotate_exp_avg_(Q, new_q, exp_avg)
+
+
+def get_orthogonal_matrix_QR(GG: List[Tensor], Q: List[Tensor], exp_avg: Optional[Tensor] = None):
+    """
+    Computes the eigenbases of the preconditioner using one round of power iteration
+    followed by torch.linalg.qr decomposition, and updates exp_avg in-place from old to new eigenspace.
 
-    final = []
-    for m in mat:
-        if m is None:
-            final.append(None)
+    :param GG: List of accumulated gradient outer products.
+    :param Q: List of current eigenbases (updated in-place to Q_new).
+    :param exp_avg: Exponential moving average in the old eigenspace (updated in-place if provided).
+    """
+    if isinstance(Q, list) and not Q:
+        return
+    foreach_orthogonal_matrix_QR([GG], [Q], None if exp_avg is None else [exp_avg])
+
+
+def _eigh(m: Tensor):
+    device, dtype = m.device, m.dtype
+    for modifier in (None, torch.double, 'cpu'):
+        if modifier is not None:
+            m = m.to(modifier)
+        try:
+            eye = torch.eye(m.shape[-1], device=m.device, dtype=m.dtype)
+            eigval, eigvec = torch.linalg.eigh(m + 1e-30 * eye)
+            eigvec = eigvec.to(device=device, dtype=dtype)
+            break
+        except torch.OutOfMemoryError:
+            pass
+        except RuntimeError:  # failed to compute eigenvalues
             continue
+        clean()
+    else:
+        raise RuntimeError("Failed to compute eigenvalues.")
+    return torch.flip(eigvec, [-1])
 
-        m = promote(m.data)
 
-        device, dtype = m.device, m.dtype
-        for modifier in (None, torch.double, 'cpu'):
-            if modifier is not None:
-                m = m.to(modifier)
+def get_orthogonal_matrix(mat):
+    """
+    Computes the eigenbases of the preconditioner using torch.linalg.eigh decomposition.
+    Same-shaped matrices are decomposed in one batched call, falling back to one-by-one decomposition (with retries in
+    double precision and on CPU) if the batched call fails.
+    """
+
+    final = [None] * len(mat)
+    for bucket in _shape_buckets(mat):
+        if len(bucket) > 1:
             try:
-                eigval, eigvec = torch.linalg.eigh(m + 1e-30 * torch.eye(m.shape[0], device=m.device, dtype=m.dtype))
-                eigvec = eigvec.to(device=device, dtype=dtype)
-                break
-            except torch.OutOfMemoryError:
-                pass
-            except RuntimeError:  # failed to compute eigenvalues
+                eigvecs = _eigh_batched([promote(mat[i].data) for i in bucket])
+                for i, eigvec in zip(bucket, eigvecs):
+                    final[i] = eigvec
                 continue
-            clean()
-        else:
-            raise RuntimeError("Failed to compute eigenvalues.")
+            except (torch.OutOfMemoryError, RuntimeError):
+                clean()
+        for i in bucket:
+            final[i] = _eigh(promote(mat[i].data))
 
-        eigvec = torch.flip(eigvec, [1])
+    return final
 
-        final.append(eigvec)
 
-    return final
+def _eigh_batched(mats: List[Tensor]):
+    m = torch.stack(mats)
+    eye = torch.eye(m.shape[-1], device=m.device, dtype=m.dtype)
+    eigval, eigvec = torch.linalg.eigh(m + 1e-30 * eye)
+    return torch.flip(eigvec, [-1]).unbind(0)
+
+
+_basis_executor = None
+_basis_streams = {}
+_pending_bases = {}  # id(param) -> (weakref to param, future, index into the future's result)
+
+
+def _compute_bases(fn, GGs, Qs, event):
+    device = next(m.device for GG in GGs for m in GG if m is not None)
+    if device.type != 'cuda':
+        return fn(GGs, Qs)
+    if device not in _basis_streams:
+        _basis_streams[device] = torch.cuda.Stream(device)
+    stream = _basis_streams[device]
+    stream.wait_event(event)
+    with torch.cuda.stream(stream):
+        out = fn(GGs, Qs)
+    stream.synchronize()
+    return out
+
+
+def _eigh_bases(GGs, Qs):
+    return [get_orthogonal_matrix(GG) for GG in GGs]
+
+
+def submit_async_bases(params: List[Tensor], GGs: List[List[Optional[Tensor]]], Qs: List[List[Optional[Tensor]]],
+                       eigh: bool = False):
+    """
+    Starts computing new eigenbases for `params` on a background thread (and, for CUDA tensors, a side stream), using
+    a snapshot of the current `GGs` and `Qs`. Parameters that still have a refresh in flight are skipped.
+    The result is applied by `swap_async_bases` once it is ready.
+
+    :param eigh: Use a full eigendecomposition (as in `init_preconditioner`) instead of one power iteration + QR.
+    """
+    global _basis_executor
+
+    for key in [key for key, (ref, _, _) in _pending_bases.items() if ref() is None]:
+        del _pending_bases[key]
+
+    todo = [i for i, (p, GG) in enumerate(zip(params, GGs))
+            if id(p) not in _pending_bases and any(m is not None for m in GG)]
+    if not todo:
+        return
+
+    GGs = [[None if m is None else m.detach().clone() for m in GGs[i]] for i in todo]
+    Qs = [[None if q is None else q.detach().clone() for q in Qs[i]] for i in todo]
+    event = None
+    device = next(m.device for m in GGs[0] if m is not None)
+    if device.type == 'cuda':
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(device))
+
+    if _basis_executor is None:
+        _basis_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='heavyball-bases')
+    future = _basis_executor.submit(_compute_bases, _eigh_bases if eigh else _foreach_power_iteration_qr, GGs, Qs,
+                                    event)
+    for k, i in enumerate(todo):
+        _pending_bases[id(params[i])] = (weakref.ref(params[i]), future, k)
+
+
+def wait_async_bases():
+    """
+    Blocks until all in-flight eigenbasis refreshes have finished. They are applied at the next optimizer step.
+    """
+    concurrent.futures.wait([future for _, future, _ in _pending_bases.values()])
+
+
+def swap_async_bases(params: List[Tensor], Qs: List[List[Optional[Tensor]]], exp_avgs: List[Optional[Tensor]]):
+    """
+    Swaps in the eigenbases computed by `submit_async_bases` for all parameters whose refresh has finished, rotating
+    `exp_avgs` from the old to the new eigenspace. Unfinished refreshes are left running; this never blocks.
+    """
+    for p, Q, exp_avg in zip(params, Qs, exp_avgs):
+        ref, future, index = _pending_bases.get(id(p), (None, None, None))
+        if ref is None or ref() is not p or not future.done():
+            continue
+        del _pending_bases[id(p)]
+        new_q = future.result()[index]
+        for q in new_q:
+            if q is not None and q.is_cuda:
+                q.record_stream(torch.cuda.current_stream(q.device))
+        _rotate_exp_avg_(Q, new_q, exp_avg)
 
 
 @decorator_knowngood
@@ -502,7 +751,7 @@ def get_beta2(group):
 
 def stochastic_lerp_(x: List[Tensor], y: List[Tensor], a: Union[float, int, Tensor]):
     x, y = list_guard(x, y)
-    a = scalar_guard(a, x[0])
+    a = scalar_guard(a, x[0], name='stochastic_lerp')
     _compilable_stochastic_lerp_(x, y, a)
 
 
@@ -518,16 +767,269 @@ def list_guard(*xs):
     return out
 
 
-def scalar_guard(*args):
+def _flat_alloc(tensors: List[Tensor], dtype: Optional[torch.dtype], alloc_fn: Callable):
+    out = [None] * len(tensors)
+    buckets = {}
+    for i, t in enumerate(tensors):
+        buckets.setdefault((t.device, t.dtype if dtype is None else dtype), []).append(i)
+    for (device, dt), idx in buckets.items():
+        numel = [tensors[i].numel() for i in idx]
+        buffer = alloc_fn(sum(numel), dtype=dt, device=device)
+        for i, view in zip(idx, buffer.split(numel)):
+            out[i] = view.view(tensors[i].shape)
+    return out
+
+
+def flat_zeros_like(tensors: List[Tensor], dtype: Optional[torch.dtype] = None):
+    """
+    Allocates one contiguous, zero-initialized buffer per (device, dtype) and returns per-tensor views into it.
+    Views that tile a buffer can be collapsed back into it via `flat_views`, letting elementwise kernels run on a
+    single large tensor instead of launching once per parameter.
+    """
+    return _flat_alloc(tensors, dtype, torch.zeros)
+
+
+def flat_clone(tensors: List[Tensor]):
+    out = _flat_alloc(tensors, None, torch.empty)
+    torch._foreach_copy_(out, tensors)
+    return out
+
+
+def _flat_base(x: List[Tensor]):
+    if not isinstance(x, (list, tuple)) or len(x) < 2:
+        return None
+    base = x[0]._base
+    if base is None or base.dim() != 1:
+        return None
+    offset = base.storage_offset()
+    for t in x:
+        if t._base is not base or not t.is_contiguous() or t.storage_offset() != offset:
+            return None
+        offset += t.numel()
+    if offset != base.storage_offset() + base.numel():
+        return None
+    return base
+
+
+def flat_views(*xs):
+    """
+    If every list consists of views that exactly tile one flat buffer (see `flat_zeros_like`), returns the buffers
+    wrapped in single-element lists. Otherwise, returns the inputs unchanged, as all lists have to be zipped together.
+    """
+    bases = [_flat_base(x) for x in xs]
+    if any(b is None for b in bases) or len({len(x) for x in xs}) > 1:
+        return xs
+    return [[b] for b in bases]
+
+
+def _split_like(x: List[Tensor], ref: List[Tensor]):
+    if len(x) == len(ref):
+        return x
+    return list(x[0].split([r.numel() for r in ref]))
+
+
+_scalar_cache: Optional[dict] = None
+
+
+@contextlib.contextmanager
+def scalar_cache(cache: Optional[dict]):
+    """
+    Makes `scalar_guard(..., name=...)` return persistent 0-dim tensors from `cache` instead of allocating new ones.
+    StatefulOptimizer.step activates one cache per param group, so entries are keyed by (group, name, device, dtype).
+    """
+    global _scalar_cache
+    prev, _scalar_cache = _scalar_cache, cache
+    try:
+        yield
+    finally:
+        _scalar_cache = prev
+
+
+class StepProfiler:
+    """
+    Opt-in instrumentation for StatefulOptimizer. Assign an instance to `optimizer.profiler`, and every step records,
+    per param group and transform, the host (wall) time, the device time (via CUDA events, resolved lazily), the number
+    of graphs compiled and whether that was a recompile, as well as the exception a transform exited with (SkipUpdate).
+    Every range is also emitted as a `torch.profiler.record_function`, so it shows up in torch.profiler traces.
+
+    Results are available as a nested dict (`to_dict`) or as a Chrome trace (`chrome_trace`, viewable in Perfetto).
+    """
+
+    def __init__(self, device_time: bool = True, record_function: bool = True):
+        self.device_time = device_time
+        self.record_function = record_function
+        self.events = []
+        self.step = 0
+        self.group = None
+        self._compiled = set()
+        self._origin = time.perf_counter()
+
+    def reset(self):
+        self.events = []
+        self.step = 0
+        self._compiled = set()
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def measure(self, name: str, ref: Optional[Tensor] = None):
+        event = {'name': name, 'group': self.group, 'step': self.step, 'compiles': 0, 'recompile': False,
+                 'raised': None}
+        cuda = self.device_time and ref is not None and ref.is_cuda
+        if cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        graphs = torch._dynamo.utils.counters['stats']['unique_graphs']
+        record = torch.profiler.record_function(f'heavyball.{name}') if self.record_function else contextlib.nullcontext()
+        t0 = time.perf_counter()
+        try:
+            with record:
+                yield event
+        except BaseException as e:
+            event['raised'] = type(e).__name__
+            raise
+        finally:
+            event['start_us'] = (t0 - self._origin) * 1e6
+            event['wall_ms'] = (time.perf_counter() - t0) * 1e3
+            if cuda:
+                end = torch.cuda.Event(enable_timing=True)
+                end.record()
+                event['_events'] = start, end
+            compiles = torch._dynamo.utils.counters['stats']['unique_graphs'] - graphs
+            if compiles:
+                event['compiles'] = compiles
+                event['recompile'] = name in self._compiled
+                self._compiled.add(name)
+            self.events.append(event)
+
+    def _resolve(self):
+        for event in self.events:
+            if '_events' in event:
+                start, end = event.pop('_events')
+                end.synchronize()
+                event['device_ms'] = start.elapsed_time(end)
+        return self.events
+
+    def to_dict(self):
+        """
+        :return: {'steps': int, 'groups': {group: {name: totals}}, 'events': [per-call records]}, where totals hold
+            calls, wall_ms, device_ms (None on CPU), compiles, recompiles and skips (calls that raised SkipUpdate).
+            The whole step of a group is recorded under the name `step`, the closure under group None.
+        """
+        groups = {}
+        for event in self._resolve():
+            totals = groups.setdefault(event['group'], {}).setdefault(event['name'], {
+                'calls': 0, 'wall_ms': 0.0, 'device_ms': None, 'compiles': 0, 'recompiles': 0, 'skips': 0})
+            totals['calls'] += 1
+            totals['wall_ms'] += event['wall_ms']
+            if 'device_ms' in event:
+                totals['device_ms'] = (totals['device_ms'] or 0.0) + event['device_ms']
+            totals['compiles'] += event['compiles']
+            totals['recompiles'] += event['recompile']
+            totals['skips'] += event['raised'] == 'SkipUpdate'
+        return {'steps': self.step, 'groups': groups, 'events': [dict(e) for e in self.events]}
+
+    def chrome_trace(self, path: Optional[str] = None):
+        """
+        :param path: If given, the trace is also written to this file as JSON.
+        :return: The trace in Chrome's Trace Event Format, with one thread per param group.
+        """
+        trace = []
+        for event in self._resolve():
+            args = {k: event[k] for k in ('step', 'compiles', 'recompile', 'raised', 'device_ms') if k in event}
+            trace.append({'name': event['name'], 'cat': 'heavyball', 'ph': 'X', 'ts': event['start_us'],
+                          'dur': event['wall_ms'] * 1e3, 'pid': 0,
+                          'tid': 'closure' if event['group'] is None else f'group {event["group"]}', 'args': args})
+        trace = {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+
+_profiler: Optional[StepProfiler] = None
+
+
+def active_profiler() -> Optional[StepProfiler]:
+    """
+    The profiler of the optimizer step that's currently running, or None. Always None while tracing for torch.compile.
+    """
+    if is_compiling():
+        return None
+    return _profiler
+
+
+def profiled(name: str, ref: Optional[Tensor] = None):
+    """
+    Records the block as `name` in the active profiler, if any. Must not be used in code traced by torch.compile.
+    """
+    profiler = active_profiler()
+    return contextlib.nullcontext() if profiler is None else profiler.measure(name, ref)
+
+
+@contextlib.contextmanager
+def profiling(profiler: Optional[StepProfiler], name: str, ref: Optional[Tensor] = None, group=None):
+    """
+    Activates `profiler` for the duration of the block and records the block itself as `name`.
+    No-op if `profiler` is None.
+    """
+    global _profiler
+    if profiler is None:
+        yield
+        return
+    prev, _profiler = _profiler, profiler
+    prev_group, profiler.group = profiler.group, group
+    try:
+        with profiler.measure(name, ref):
+            yield
+    finally:
+        _profiler = prev
+        profiler.group = prev_group
+
+
+def _cached_scalar(key, x, dtype, device):
+    key = (*key, device, dtype)
+    if key not in _scalar_cache:
+        _scalar_cache[key] = [x, torch.empty((), dtype=dtype, device=device).fill_(x)]
+    entry = _scalar_cache[key]
+    if entry[0] != x:  # only fill (host-to-device copy) if the value changed
+        entry[1].fill_(x)
+        entry[0] = x
+    return entry[1]
+
+
+def scalar_buffer(name: str, ref: Tensor, dtype: Optional[torch.dtype] = None):
+    """
+    Returns a persistent 0-dim tensor from the active `scalar_cache`, meant to be updated in-place on device.
+    """
+    dtype = promote(ref.dtype) if dtype is None else dtype
+    if _scalar_cache is None:
+        return torch.zeros((), dtype=dtype, device=ref.device)
+    key = ('buffer', name, ref.device, dtype)
+    if key not in _scalar_cache:
+        _scalar_cache[key] = torch.zeros((), dtype=dtype, device=ref.device)
+    return _scalar_cache[key]
+
+
+def scalar_guard(*args, name: Optional[str] = None):
+    """
+    Converts python scalars to 0-dim tensors on the device of the last argument.
+    If `name` is given and a `scalar_cache` is active, the tensors are persistent and refilled in-place. Callers passing
+    a name must not modify the returned tensors.
+    """
     *xs, ref = args
     out = []
-    for x in xs:
+    for i, x in enumerate(xs):
         if isinstance(x, float):
-            out.append(torch.empty((), dtype=promote(ref.dtype), device=ref.device).fill_(x))
+            dtype = promote(ref.dtype) if ref.is_floating_point() else torch.float32  # e.g. int8 storage
         elif isinstance(x, int):
-            out.append(torch.empty((), dtype=torch.int64, device=ref.device).fill_(x))
+            dtype = torch.int64
         else:
             out.append(x)
+            continue
+        if name is not None and _scalar_cache is not None and not is_compiling():
+            out.append(_cached_scalar((name, i), x, dtype, ref.device))
+        else:
+            out.append(torch.empty((), dtype=dtype, device=ref.device).fill_(x))
     if len(xs) == 1:
         return out[0]
     return out
@@ -543,7 +1045,7 @@ def _compilable_stochastic_add_(x: List[Tensor], y: List[Tensor], alpha: Union[f
 
 def stochastic_add_(x: List[Tensor], y: List[Tensor], alpha: Union[float, int, Tensor] = 1):
     x, y = list_guard(x, y)
-    alpha = scalar_guard(alpha, x[0])
+    alpha = scalar_guard(alpha, x[0], name='stochastic_add')
     _compilable_stochastic_add_(x, y, alpha)
 
 
@@ -612,9 +1114,46 @@ def update_preconditioner(grad, Q, GG, exp_avg, max_precond_dim, precondition_1d
         get_orthogonal_matrix_QR(GG, Q, exp_avg)
 
 
-def init_preconditioner(grad, state, max_precond_dim, precondition_1d):
+def foreach_update_preconditioner(grads, Qs, GGs, exp_avgs, max_precond_dim, precondition_1d, beta, update_precond,
+                                  async_params: Optional[List[Tensor]] = None, params: Optional[List[Tensor]] = None):
+    """
+    Like `update_preconditioner`, but batches the eigenbasis refresh across all parameters.
+    `update_precond` may also be a list of per-parameter flags, in which case only those parameters are refreshed.
+    If `async_params` is given, the refresh runs in the background (see `submit_async_bases`) instead.
+    If `params` is given and `precond_shard` is active, only owned parameters are refreshed locally.
+    """
+    for grad, GG in zip(grads, GGs):
+        update_ggt(grad, GG, max_precond_dim, precondition_1d, beta)
+    if isinstance(update_precond, (list, tuple)):
+        idx = [i for i, u in enumerate(update_precond) if u]
+        if len(idx) < len(update_precond):
+            Qs, GGs, exp_avgs, async_params, params = [None if x is None else [x[i] for i in idx]
+                                                       for x in (Qs, GGs, exp_avgs, async_params, params)]
+        update_precond = bool(idx)
+    if not update_precond:
+        return
+    if async_params is not None:
+        submit_async_bases(async_params, GGs, Qs)
+        return
+    owned = None if params is None else precond_owned(params)
+    if owned is None:
+        foreach_orthogonal_matrix_QR(GGs, Qs, exp_avgs)
+        return
+
+    new_qs = [[None if q is None else torch.empty_like(q) for q in Q] for Q in Qs]
+    idx = [i for i, o in enumerate(owned) if o]
+    for i, new_q in zip(idx, _foreach_power_iteration_qr([GGs[i] for i in idx], [Qs[i] for i in idx])):
+        new_qs[i] = [None if q is None else q.to(b.dtype) for q, b in zip(new_q, new_qs[i])]
+    sync_precond_(params, new_qs)
+    for Q, new_q, exp_avg in zip(Qs, new_qs, exp_avgs):
+        if Q:
+            _rotate_exp_avg_(Q, new_q, exp_avg)
+
+
+def init_preconditioner(grad, state, max_precond_dim, precondition_1d, async_param: Optional[Tensor] = None):
     """
     Initializes the preconditioner matrices (L and R in the paper).
+    If `async_param` is given, the eigenbases start as identities and the eigendecomposition runs in the background.
     """
     state['GG'] = []  # Will hold all the preconditioner matrices (L and R in the paper).
     if grad.numel() > 1 and (grad.ndim > 1 or precondition_1d):
@@ -628,7 +1167,12 @@ def init_preconditioner(grad, state, max_precond_dim, precondition_1d):
         state['GG'].append(None)
 
     update_ggt(grad, state['GG'], max_precond_dim, precondition_1d, 0)
-    state['Q'] = get_orthogonal_matrix(state['GG'])
+    if async_param is None:
+        state['Q'] = get_orthogonal_matrix(state['GG'])
+        return
+    state['Q'] = [None if m is None else torch.eye(m.shape[0], device=m.device, dtype=promote(m.dtype))
+                  for m in state['GG']]
+    submit_async_bases([async_param], [state['GG']], [state['Q']], eigh=True)
 
 
 @decorator
@@ -643,7 +1187,7 @@ def project(grad, Q, back: bool):
     preconditioners = ",".join([(g + g.upper())[::-1 if back else 1] for m, g in zip(Q, param) if m is not None])
     if preconditioners:
         out = ''.join([c.upper() if c.upper() in preconditioners else c for c in param])
-        out = torch.einsum(f'{param},{preconditioners}->{out}', promote(grad), *[q for q in Q if q is not None])
+        out = contract(f'{param},{preconditioners}->{out}', promote(grad), *[q for q in Q if q is not None])
         grad = out.to(grad.dtype)
     return grad
 
@@ -669,12 +1213,298 @@ def modify_closure(closure):
         return closure()
 
 
+def param_cost(p: Tensor, group: dict) -> int:
+    """
+    Relative per-step cost of the optimizer state of `p`: its numel for elementwise optimizers, plus the einsums
+    (numel * dim) and decompositions (dim ** 3) of every preconditioned dim for SOAP and PSGD.
+    """
+    limit = group.get('max_precond_dim', group.get('max_size_triangular', 0))
+    dims = [d for d in p.shape if 1 < d <= limit] if p.dim() > 1 or group.get('precondition_1d', False) else []
+    return p.numel() + sum(p.numel() * d + d ** 3 for d in dims)
+
+
+def partition_by_cost(costs: List[int], world_size: int) -> List[int]:
+    """
+    Assigns every item to a rank, largest first to the least loaded rank, so that all ranks carry a similar total cost.
+    The assignment is deterministic, so every rank computes the same one.
+    """
+    load = [0] * world_size
+    owners = [0] * len(costs)
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        rank = min(range(world_size), key=lambda r: load[r])
+        owners[i] = rank
+        load[rank] += costs[i]
+    return owners
+
+
+def broadcast_from_owners(tensors: List[Tensor], owners: List[int], group=None):
+    """
+    Broadcasts every tensor from the rank that owns it, with one collective per (owner, dtype, device).
+    """
+    rank = dist.get_rank(group)
+    buckets = {}
+    for t, owner in zip(tensors, owners):
+        buckets.setdefault((owner, t.dtype, t.device), []).append(t)
+    for (owner, dtype, device), ts in buckets.items():
+        if owner == rank:
+            flat = _flatten_dense_tensors(ts)
+        else:
+            flat = torch.empty(sum(t.numel() for t in ts), dtype=dtype, device=device)
+        dist.broadcast(flat, src=owner if group is None else dist.get_global_rank(group, owner), group=group)
+        if owner != rank:
+            for t, new in zip(ts, _unflatten_dense_tensors(flat, ts)):
+                t.copy_(new)
+
+
+_precond_shard: Optional[Tuple[dict, object]] = None
+
+
+@contextlib.contextmanager
+def precond_shard(owners: Optional[dict], group=None):
+    """
+    While active, SOAP and PSGD refresh the preconditioners of only those parameters this rank owns (`owners` maps
+    id(param) to a rank of `group`) and receive the others' refreshed preconditioners via broadcast.
+    """
+    global _precond_shard
+    prev, _precond_shard = _precond_shard, None if owners is None else (owners, group)
+    try:
+        yield
+    finally:
+        _precond_shard = prev
+
+
+def precond_owned(params: List[Tensor]) -> Optional[List[bool]]:
+    """
+    Whether this rank refreshes the preconditioner of each parameter, or None if `precond_shard` isn't active.
+    """
+    if _precond_shard is None:
+        return None
+    owners, group = _precond_shard
+    rank = dist.get_rank(group)
+    return [owners[id(p)] == rank for p in params]
+
+
+@contextlib.contextmanager
+def precond_rng_fork(device: torch.device):
+    """
+    With `precond_shard`, forks the RNG for work that only a parameter's owner runs (e.g. stochastic rounding of its
+    preconditioner), so that the global random stream advances identically on every rank. No-op otherwise.
+    """
+    if _precond_shard is None:
+        yield
+        return
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        yield
+
+
+def sync_precond_(params: List[Tensor], states: List):
+    """
+    Broadcasts all tensors in `states[i]` from the rank owning `params[i]`. No-op if `precond_shard` isn't active.
+    """
+    if _precond_shard is None:
+        return
+    owners, group = _precond_shard
+    tensors, tensor_owners = [], []
+    for p, state in zip(params, states):
+        for t in tree_flatten(state)[0]:
+            if isinstance(t, Tensor):
+                tensors.append(t)
+                tensor_owners.append(owners[id(p)])
+    broadcast_from_owners(tensors, tensor_owners, group)
+
+
+_offload_streams = {}
+
+
+def offload_stream(device: torch.device):
+    """
+    The side stream used for host<->device copies of offloaded state on `device`, or None for CPU devices.
+    """
+    if device.type != 'cuda':
+        return None
+    if device not in _offload_streams:
+        _offload_streams[device] = torch.cuda.Stream(device)
+    return _offload_streams[device]
+
+
+def _stream_context(stream):
+    return contextlib.nullcontext() if stream is None else torch.cuda.stream(stream)
+
+
+def offload_prefetch(tensors: List[Tensor], device: torch.device, stream=None):
+    """
+    Starts copying `tensors` to `device` on `stream` (after all work queued on the current stream).
+    Returns the copies and an event (or None) marking their arrival. See `offload_install_`.
+    """
+    if stream is not None:
+        stream.wait_stream(torch.cuda.current_stream(stream.device))
+    with _stream_context(stream):
+        buffers = [t.to(device, non_blocking=stream is not None) for t in tensors]
+        event = None if stream is None else stream.record_event()
+    return buffers, event
+
+
+def offload_install_(tensors: List[Tensor], buffers: List[Tensor], event=None, host: bool = False):
+    """
+    Waits for `offload_prefetch` and swaps the copies into `tensors` (in-place, so all references stay valid).
+    With `host=True`, the CPU waits for the copies; otherwise, only the current stream does.
+    """
+    if event is not None:
+        if host:
+            event.synchronize()
+        else:
+            compute = torch.cuda.current_stream(event.device)
+            compute.wait_event(event)
+            for b in buffers:
+                b.record_stream(compute)
+    for t, b in zip(tensors, buffers):
+        t.data = b
+
+
+def offload_write_back_(tensors: List[Tensor], stream=None):
+    """
+    Moves `tensors` (in-place) to host memory, pinned if `stream` is given, or into their file (see `mmap_like`).
+    The copies run on `stream` after all work queued on the current stream, so the host values are only valid after
+    synchronizing with `stream`.
+    """
+    if stream is not None:
+        stream.wait_stream(torch.cuda.current_stream(stream.device))
+    with _stream_context(stream):
+        for t in tensors:
+            if t.device.type == 'cpu':
+                continue
+            host = getattr(t, 'mmap_buffer', None)
+            if host is None:
+                host = torch.empty(t.shape, dtype=t.dtype, device='cpu', pin_memory=stream is not None)
+            host.copy_(t, non_blocking=stream is not None and host.is_pinned())
+            if stream is not None:
+                t.record_stream(stream)
+            t.data = host
+
+
+def mmap_like(t: Tensor, path: str) -> Tensor:
+    """
+    Returns an uninitialized host tensor shaped like `t`, backed by a new memory-mapped file at `path`. The file is
+    unlinked right away, so it's removed once the tensor is freed. Pages are read from (and written back to) disk by
+    the OS as they are accessed, so the tensors can exceed the available RAM.
+    """
+    buffer = torch.from_file(path, shared=True, size=max(t.numel(), 1), dtype=t.dtype)
+    os.unlink(path)
+    return buffer[:t.numel()].view(t.shape)
+
+
+def _rebase_views_(views, old: Tensor, new: Tensor):
+    for v in views:
+        offset = v.storage_offset() - old.storage_offset() + new.storage_offset()
+        v.data = new.as_strided(v.size(), v.stride(), offset)
+
+
+_STATE_MAGIC = b'HBSTATE1'
+_STATE_ALIGN = 64
+
+
+def _encode_state(x, write_tensor: Callable):
+    """
+    Converts (nested) optimizer state into JSON, storing tensors via `write_tensor`, which returns their index.
+    """
+    if isinstance(x, Tensor):
+        return {'t': write_tensor(x)}
+    if isinstance(x, torch.Size):
+        return {'s': list(x)}
+    if isinstance(x, tuple):
+        return {'u': [_encode_state(v, write_tensor) for v in x]}
+    if isinstance(x, list):
+        return {'l': [_encode_state(v, write_tensor) for v in x]}
+    if isinstance(x, dict):
+        return {'d': [[k, _encode_state(v, write_tensor)] for k, v in x.items()]}
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    raise TypeError(f"Can't save optimizer state of type {type(x).__name__}.")
+
+
+def _decode_state(x, read_tensor: Callable):
+    if not isinstance(x, dict):
+        return x
+    (kind, v), = x.items()
+    if kind == 't':
+        return read_tensor(v)
+    if kind == 's':
+        return torch.Size(v)
+    if kind == 'u':
+        return tuple(_decode_state(i, read_tensor) for i in v)
+    if kind == 'l':
+        return [_decode_state(i, read_tensor) for i in v]
+    return {k: _decode_state(i, read_tensor) for k, i in v}
+
+
+def load_state_file(path: str):
+    """
+    Reads the index of a `StatefulOptimizer.save_state` file and memory-maps its tensors. The tensors are zero-copy,
+    copy-on-write views of the file, so only the pages that are accessed are read, and modifying them leaves the file
+    untouched.
+
+    :return: The index and the list of tensors it refers to.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(size - 16)
+        magic, start = f.read(8), int.from_bytes(f.read(8), 'little')
+        if magic != _STATE_MAGIC:
+            raise ValueError(f"{path} is not a heavyball optimizer state file.")
+        f.seek(start)
+        index = json.loads(f.read(size - 16 - start))
+    data = torch.from_file(path, shared=False, size=size, dtype=torch.uint8)
+    tensors = []
+    for offset, dtype, shape, stride in index['tensors']:
+        dtype = getattr(torch, dtype.split('.')[-1])
+        nbytes = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+        tensors.append(data[offset:offset + nbytes].view(dtype).as_strided(shape, stride))
+    return index, tensors
+
+
 class StatefulOptimizer(torch.optim.Optimizer):
     """
     finite_differences saves memory, but needs more compute. (Alternative is true HVP)
     Both `True` and `False` have some edge cases they don't support, so experiment with it.
     The previous (heavyball<=1.5.3) default was `True`, which is incompatible with some benchmarks but works better with RevNet
     Further notice that both methods have different numerics outputs
+
+    hessian_subset: bool = False
+    With `hessian_approx`, decides which parameters refresh their preconditioner in this step before running the
+    closure (see `_refresh_due`) and computes Hessian-vector products only for those. The others skip the double
+    backward (or, with `finite_differences`, aren't perturbed), and steps in which no preconditioner is due run the
+    closure without `create_graph`. Pays off with per-parameter schedules (`adaptive_precond`), under which parameters
+    rarely refresh in the same step.
+
+    shard_state: bool = False
+    ZeRO-1-style sharding over `shard_group` (default: the world). Every rank owns a partition of the parameters,
+    balanced by `param_cost`, keeps optimizer state (incl. preconditioners) only for those and only computes their
+    update. Updated parameters are then broadcast from their owners. Gradients must already be identical across ranks
+    (e.g. after DDP's all-reduce), and each rank's `state_dict` holds only its own shard.
+
+    shard_preconditioner: bool = False
+    Keeps the optimizer state replicated, but partitions the periodic preconditioner refresh (SOAP's power iteration
+    and QR, PSGD's Q update) across the ranks of `shard_group` the same way, then broadcasts the refreshed bases.
+    Removes the N-fold redundant preconditioner work of data-parallel training. Gradients must be identical across ranks.
+
+    offload_state: bool = False
+    Keeps the optimizer state in (pinned) host memory. Every param group is stepped in chunks of about
+    `offload_chunk_mb` MB of parameters. The next chunk's state is prefetched to the device on a side stream while the
+    current chunk is computed, and written back asynchronously afterwards (double buffering), so only a few chunks'
+    state is on the device at any time. State tensors are swapped in-place, so `flat_state` falls back to per-tensor
+    kernels.
+
+    mmap_dir: Optional[str] = None
+    Keeps the state under `mmap_keys` (by default the preconditioners, SOAP's `Q` and `GG` and PSGD's `Q`) in
+    memory-mapped files in this directory instead of RAM. The OS pages them in when they are accessed, so state that's
+    rarely touched costs I/O only when it is. Parameters on the device additionally need `offload_state` or
+    `offload_step`, which then stream these tensors from and to their files.
+
+    offload_step: bool = False
+    Runs the entire step on the host instead, next to the offloaded state: gradients are copied to the host, the update
+    is computed by the CPU's multi-threaded (foreach) kernels and only the parameters are copied back, again chunked
+    and overlapped. Moves less data than `offload_state` for elementwise optimizers (e.g. Adam, whose state is twice the
+    size of the parameters), but is slower for compute-heavy preconditioners. Implies `offload_state`.
     """
     ema_decay: float = 0.001
     compile_step: bool = False
@@ -682,6 +1512,16 @@ class StatefulOptimizer(torch.optim.Optimizer):
     precond_schedule: Union[Callable, float, None] = None
     stochastic_schedule: bool = False
     finite_differences: bool = False
+    hessian_subset: bool = False
+    profiler: Optional[StepProfiler] = None
+    shard_state: bool = False
+    shard_preconditioner: bool = False
+    shard_group = None
+    offload_state: bool = False
+    offload_step: bool = False
+    offload_chunk_mb: float = 64
+    mmap_dir: Optional[str] = None
+    mmap_keys: Tuple[str, ...] = ('Q', 'GG')
 
     def __init__(self, params, defaults, foreach: bool = True, use_ema: bool = False):
         super().__init__(params, {**defaults, 'foreach': foreach})
@@ -690,13 +1530,56 @@ class StatefulOptimizer(torch.optim.Optimizer):
         self._inner_group = {'stochastic_schedule': self.stochastic_schedule}
         self._precond_rng = random.Random(0x12312)
         self._is_preconditioning = None
-
+        self._precond_prob = None
+        self._scalar_caches = {}
+        self._shard_owners = {}
+        self._param_subsets = {}
+        self._offload_event = None
+        self._mmap_files = 0
+
+        if (self.shard_state or self.shard_preconditioner) and not dist.is_initialized():
+            raise ValueError("shard_state and shard_preconditioner require an initialized torch.distributed process "
+                             "group.")
+        if self.shard_state and self.shard_preconditioner:
+            raise ValueError("shard_state already partitions the preconditioner; don't combine it with "
+                             "shard_preconditioner.")
         if self.hessian_approx and self.compile_step:
             raise ValueError("Hessian approximation can't be used with compile_step.")
+        if self.hessian_approx and getattr(self, 'capturable', False):
+            raise ValueError("Hessian approximation can't be used with capturable.")
+        if (self.offload_state or self.offload_step) and getattr(self, 'capturable', False):
+            raise ValueError("Offloaded state moves between host and device, so it can't be used with capturable.")
+        if self.offload_step and self.hessian_approx:
+            raise ValueError("offload_step can't be used with Hessian approximation, which runs on the device.")
+        if self.mmap_dir is not None and not (self.offload_state or self.offload_step) and any(
+                p.device.type != 'cpu' for group in self.param_groups for p in group['params']):
+            raise ValueError("mmap_dir keeps state on the host, so parameters on a device need offload_state or "
+                             "offload_step.")
 
     def get_groups(self, group):
         return [group]
 
+    def shard_owners(self, group) -> List[int]:
+        """
+        The rank owning each parameter of `group` under `shard_state`. Computed once per set of parameters.
+        """
+        params = [p for g in self.param_groups for p in g['params']]
+        key = tuple(map(id, params))
+        if key not in self._shard_owners:
+            costs = [param_cost(p, g) for g in self.param_groups for p in g['params']]
+            owners = partition_by_cost(costs, dist.get_world_size(self.shard_group))
+            self._shard_owners = {key: dict(zip(map(id, params), owners))}
+        owners = self._shard_owners[key]
+        return [owners[id(p)] for p in group['params']]
+
+    def _view_owners(self, group) -> dict:
+        owners = {}
+        for p, owner in zip(group['params'], self.shard_owners(group)):
+            if p not in self.mapping:
+                self.mapping[p] = merge_group(group, p)
+            owners.update({id(v): owner for v in (p, *self.mapping[p])})
+        return owners
+
     def state_(self, arg: Tensor):
         return self.state[arg]
 
@@ -734,17 +1617,62 @@ class StatefulOptimizer(torch.optim.Optimizer):
                 yield pv, g
 
     def state_size(self) -> int:
-        total_bytes = 0
-
-        def _add(x):
-            nonlocal total_bytes
-            if isinstance(x, Tensor):
-                total_bytes += x.numel() * x.element_size()
-
+        return self.memory_report()['total']
+
+    def _state_key_origins(self) -> dict:
+        """
+        Maps state keys to (transform, name) for `memory_report`. Unknown keys are reported as ('other', key).
+        """
+        return {'mars_old_grad': ('mars', 'mars_old_grad'), 'param_ema': ('ema', 'param_ema')}
+
+    def _group_states(self, group):
+        """
+        Yields (parameter view, state) for all initialized states of `group`, without creating or modifying any.
+        """
+        seen = set()
+        for p in group['params']:
+            for view in (p, *self.mapping.get(p, ())):
+                if id(view) not in seen and view in self.state:
+                    seen.add(id(view))
+                    yield view, self.state[view]
+
+    def memory_report(self) -> dict:
+        """
+        Bytes held by the optimizer state, in total and broken down by state key (e.g. `exp_avg`, `Q`, `GG`), by
+        dtype, by device, by the transform that allocated it and by param group.
+        Unlike iterating `split_p_and_g_in_group`, this neither touches gradients nor allocates state.
+        """
+        origins = self._state_key_origins()
+        report = {'total': 0, 'by_key': {}, 'by_dtype': {}, 'by_device': {}, 'by_transform': {}, 'by_group': {}}
+        for group_idx, group in enumerate(self.param_groups):
+            for _, state in self._group_states(group):
+                for key, value in state.items():
+                    transform, name = origins.get(key, ('other', key))
+                    for x in tree_flatten(value)[0]:
+                        if not isinstance(x, Tensor):
+                            continue
+                        size = x.numel() * x.element_size()
+                        report['total'] += size
+                        for breakdown, k in (('by_key', name), ('by_dtype', str(x.dtype)), ('by_device', str(x.device)),
+                                             ('by_transform', transform), ('by_group', group_idx)):
+                            report[breakdown][k] = report[breakdown].get(k, 0) + size
+        return report
+
+    def precond_report(self) -> Dict[Tensor, List[dict]]:
+        """
+        Preconditioner refresh schedule of every parameter with `adaptive_precond`: one dict per state (a parameter has
+        several with `split` or merged dims) holding the refresh probability `prob` of the last step, its multiplier
+        `scale` of the optimizer's schedule and the `drift` measured at the last refresh (None before the first).
+        """
+        report = {}
         for group in self.param_groups:
-            for p, _ in self.split_p_and_g_in_group(group, skip_none=False):
-                tree_map(_add, self.state_(p))
-        return total_bytes
+            for p in group['params']:
+                views = {id(self.state[v]): self.state[v] for v in (p, *self.mapping.get(p, ())) if v in self.state}
+                refreshes = [dict(st['precond_refresh']) for st in views.values()
+                             if st.get('precond_refresh') is not None]
+                if refreshes:
+                    report[p] = refreshes
+        return report
 
     def _step(self, group):
         raise NotImplementedError
@@ -794,8 +1722,36 @@ class StatefulOptimizer(torch.optim.Optimizer):
                         set_(self.state_(p)['param_ema'], p.data)
                         set_(p.data, ema_clone)
 
+    def _refresh_due(self, group: dict, view: Tensor) -> bool:
+        """
+        Whether the preconditioner of the parameter view `view` refreshes in this step, decided before the closure
+        runs. Optimizers with per-parameter schedules override this and have to stick to the decision.
+        """
+        return bool(self._is_preconditioning)
+
+    def _hessian_subset(self) -> Tuple[set, bool]:
+        """
+        ids of the parameter views that don't need a Hessian-vector product in this step, and whether any view does.
+        Parameters that haven't been stepped yet have no views or state and always get one.
+        """
+        skip, due = set(), False
+        for group in self.param_groups:
+            for p in group['params']:
+                if p not in self.mapping:
+                    due = True
+                    continue
+                for view in self.mapping[p]:
+                    if self._refresh_due(group, view):
+                        due = True
+                    else:
+                        skip.add(id(view))
+        return skip, due
+
     def _handle_closure(self, closure):
         hessian_approx = self.hessian_approx and self._is_preconditioning
+        skip = set()
+        if self.hessian_approx and self.hessian_subset:
+            skip, hessian_approx = self._hessian_subset()
 
         if closure is None:
             if hessian_approx:
@@ -815,6 +1771,8 @@ class StatefulOptimizer(torch.optim.Optimizer):
             for group in self.param_groups:
                 for p, g in self.split_p_and_g_in_group(group, skip_none=True, should_promote=False):
                     grads.append(g)
+                    if id(p) in skip:
+                        continue
                     p.vector = torch.randn_like(p)
                     p.orig = p.data.clone()
                     stochastic_add_(p.data, p.vector, tiny_bf16)
@@ -829,6 +1787,8 @@ class StatefulOptimizer(torch.optim.Optimizer):
             for group in self.param_groups:
                 for p, g in self.split_p_and_g_in_group(group, skip_none=True, should_promote=False):
                     p.grad = grads.pop(0)
+                    if id(p) in skip:
+                        continue
                     stochastic_add_(g, p.grad, -1)
                     p.hessian_vector = g
                     p.data.copy_(p.orig)
@@ -838,7 +1798,8 @@ class StatefulOptimizer(torch.optim.Optimizer):
                 for p, g in self.split_p_and_g_in_group(group, skip_none=True, should_promote=False):
                     p.grad = g
             params, grads = zip(*[x for group in self.param_groups for x in
-                                  self.split_p_and_g_in_group(group, skip_none=True, should_promote=False)])
+                                  self.split_p_and_g_in_group(group, skip_none=True, should_promote=False)
+                                  if id(x[0]) not in skip])
             vs = [torch.randn_like(p) for p in params]
             with torch.enable_grad():
                 hvs = torch.autograd.grad(grads, params, vs)
@@ -850,36 +1811,437 @@ class StatefulOptimizer(torch.optim.Optimizer):
 
         return loss
 
-    def step(self, closure: Optional[Callable] = None):
+    def _offload_chunks(self, group) -> List[List[Tensor]]:
+        chunks, size, cap = [], 0, self.offload_chunk_mb * 2 ** 20
+        for p in group['params']:
+            nbytes = p.numel() * p.element_size()
+            if not chunks or size + nbytes > cap:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(p)
+            size += nbytes
+        return chunks
+
+    def _offloaded_tensors(self, params: List[Tensor]) -> List[Tensor]:
+        seen, tensors = set(), []
+        for _, state in self._group_states({'params': params}):
+            for key, value in state.items():
+                if key == 'param_ema':  # updated outside of `_step`, stays with the parameters
+                    continue
+                for x in tree_flatten(value)[0]:
+                    if isinstance(x, Tensor) and id(x) not in seen:
+                        seen.add(id(x))
+                        tensors.append(x)
+        return tensors
+
+    def _step_chunk(self, group, chunk: List[Tensor]):
+        original = group['params']
+        group['params'] = chunk
+        try:
+            self._step(group)
+        finally:
+            group['params'] = original
+        self._mmap_state_(chunk)
+
+    def _mmap_state_(self, params: List[Tensor]):
+        """
+        Gives every (new) state tensor under `mmap_keys` a file-backed `mmap_buffer`. Host tensors are moved into it
+        right away, device tensors when they are written back by the offloading.
+        """
+        if self.mmap_dir is None:
+            return
+        for _, state in self._group_states({'params': params}):
+            for key in self.mmap_keys:
+                for t in tree_flatten(state.get(key))[0]:
+                    if not isinstance(t, Tensor) or hasattr(t, 'mmap_buffer'):
+                        continue
+                    path = os.path.join(self.mmap_dir, f'heavyball_{os.getpid()}_{id(self):x}_{self._mmap_files}.bin')
+                    self._mmap_files += 1
+                    t.mmap_buffer = mmap_like(t, path)
+                    if t.device.type == 'cpu':
+                        t.mmap_buffer.copy_(t)
+                        t.data = t.mmap_buffer
+
+    def _step_offloaded(self, group):
+        device = group['params'][0].device
+        stream = offload_stream(device)
+        chunks = self._offload_chunks(group)
+
+        with profiled('offload_prefetch', group['params'][0]):
+            tensors = self._offloaded_tensors(chunks[0])
+            pending = (tensors, *offload_prefetch(tensors, device, stream))
+        for i, chunk in enumerate(chunks):
+            current = pending
+            if i + 1 < len(chunks):  # overlaps with this chunk's compute
+                with profiled('offload_prefetch', group['params'][0]):
+                    tensors = self._offloaded_tensors(chunks[i + 1])
+                    pending = (tensors, *offload_prefetch(tensors, device, stream))
+            offload_install_(*current)
+            self._step_chunk(group, chunk)
+            with profiled('offload_write_back', group['params'][0]):
+                offload_write_back_(self._offloaded_tensors(chunk), stream)  # includes freshly initialized state
+        if stream is not None:
+            self._offload_event = stream.record_event()
+
+    def _step_on_host(self, group):
+        device = group['params'][0].device
+        stream = offload_stream(device)
+        chunks = [[p for p in chunk if p.grad is not None] for chunk in self._offload_chunks(group)]
+        chunks = [chunk for chunk in chunks if chunk]
+        for p in group['params']:
+            if p not in self.mapping:  # views have to be created from the parameter on the device
+                self.mapping[p] = merge_group(group, p)
+
+        def _prefetch(chunk):
+            tensors = [t for p in chunk for t in (p.data, p.grad)]
+            return offload_prefetch(tensors, torch.device('cpu'), stream)
+
+        pending = _prefetch(chunks[0]) if chunks else None
+        for i, chunk in enumerate(chunks):
+            (host, event), originals = pending, [p.data for p in chunk]
+            if i + 1 < len(chunks):  # overlaps with this chunk's compute
+                pending = _prefetch(chunks[i + 1])
+            if event is not None:
+                event.synchronize()
+            for p, data, hp, hg in zip(chunk, originals, host[::2], host[1::2]):
+                if stream is not None:
+                    p.grad.record_stream(stream)
+                p.grad = None
+                p.data = hp
+                p.grad = hg
+                _rebase_views_([v for v in self.mapping[p] if v is not p], data, hp)
+
+            self._step_chunk(group, chunk)
+            offload_write_back_(self._offloaded_tensors(chunk))  # state initialized on the device before offloading
+
+            with _stream_context(stream):
+                for p, data in zip(chunk, originals):
+                    hp = p.data
+                    if hp.device != data.device:
+                        data.copy_(hp, non_blocking=stream is not None)
+                    p.grad = None
+                    p.data = data
+                    _rebase_views_([v for v in self.mapping[p] if v is not p], hp, data)
+        if stream is not None:
+            torch.cuda.current_stream(device).wait_stream(stream)
+
+    def wait_offload(self):
+        """
+        Blocks until the offloaded state of the last step has been written back to host memory.
+        """
+        if self._offload_event is not None:
+            self._offload_event.synchronize()
+            self._offload_event = None
+
+    def _schedule_state(self) -> dict:
+        """
+        The optimizer-wide preconditioner schedule (`precond_schedule`'s counters and random state), which
+        `state_dict` and `save_state` store next to the per-parameter state.
+        """
+        return {'inner_group': dict(self._inner_group), 'precond_rng': self._precond_rng.getstate()}
+
+    def _load_schedule_state(self, schedule: dict):
+        self._inner_group.update({k: v for k, v in schedule['inner_group'].items() if k != 'stochastic_schedule'})
+        version, internal, gauss_next = schedule['precond_rng']
+        self._precond_rng.setstate((version, tuple(internal), gauss_next))  # JSON turns the tuple into a list
+
+    def state_dict(self):
+        self.wait_offload()
+        return {**super().state_dict(), 'schedule': self._schedule_state()}
+
+    def load_state_dict(self, state_dict):
+        """
+        `torch.optim.Optimizer.load_state_dict` that restores the per-parameter state as saved. torch would turn
+        strings (e.g. einsum expressions) into generators and cast floating-point state to the parameter's dtype.
+        """
+        state_dict = dict(state_dict)
+        schedule = state_dict.pop('schedule', None)
+        super().load_state_dict(state_dict)
+
+        def _copy(value, device):
+            if isinstance(value, Tensor):
+                return value.to(device, copy=True)
+            if isinstance(value, dict):
+                return {k: _copy(v, device) for k, v in value.items()}
+            if isinstance(value, (list, tuple)):
+                return type(value)(_copy(v, device) for v in value)
+            return copy.deepcopy(value)
+
+        saved = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = dict(zip(saved, [p for group in self.param_groups for p in group['params']]))
+        for i, state in state_dict['state'].items():
+            if i in params:
+                p = params[i]
+                device = torch.device('cpu') if self.offload_state or self.offload_step else p.device
+                self.state[p] = _copy(state, device)
+        if schedule is not None:
+            self._load_schedule_state(schedule)
+
+    def _state_views(self, group, p: Tensor) -> List[Tensor]:
+        if p not in self.mapping:
+            self.mapping[p] = merge_group(group, p)
+        return [p, *(v for v in self.mapping[p] if v is not p)]
+
+    def save_state(self, path: str):
+        """
+        Writes the optimizer state to `path`, tensor by tensor, followed by a JSON index of the param groups and the
+        (nested) per-parameter state. Unlike `state_dict`, this never holds more than one tensor in host memory.
+        Load it with `load_state`.
+        """
+        self.wait_offload()
+        offsets, written = [], {}
+        with open(path, 'wb') as f:
+            def _write(t: Tensor):
+                if id(t) not in written:
+                    order = sorted(range(t.dim()), key=lambda d: -t.stride(d))  # keep the memory layout, e.g. of Q.T
+                    dense = t.detach().cpu().permute(order).contiguous()
+                    stride = [0] * t.dim()
+                    for d, st in zip(order, dense.stride()):
+                        stride[d] = st
+                    f.write(bytes(-f.tell() % _STATE_ALIGN))
+                    offsets.append([f.tell(), str(t.dtype), list(t.shape), stride])
+                    f.write(dense.reshape(-1).view(torch.uint8).numpy().data)
+                    written[id(t)] = (len(offsets) - 1, t)  # keep `t` alive, so that its id isn't reused
+                return written[id(t)][0]
+
+            groups, states, idx = [], [], 0
+            for group in self.param_groups:
+                groups.append({'params': list(range(idx, idx + len(group['params'])))})
+                for k, v in group.items():
+                    if k == 'params':
+                        continue
+                    try:
+                        groups[-1][k] = _encode_state(v, _write)
+                    except TypeError:  # construction-time settings (e.g. sentinels), recreated with the optimizer
+                        continue
+                for p in group['params']:
+                    for view_idx, view in enumerate(self._state_views(group, p)):
+                        if view in self.state:
+                            states.append([idx, view_idx, _encode_state(self.state[view], _write)])
+                    idx += 1
+
+            index = json.dumps({'tensors': offsets, 'param_groups': groups, 'state': states,
+                                'schedule': self._schedule_state()}).encode()
+            start = f.tell()
+            f.write(index)
+            f.write(_STATE_MAGIC + start.to_bytes(8, 'little'))
+
+    def load_state(self, path: str, params: Optional[List[Tensor]] = None):
+        """
+        Restores the state written by `save_state`. State of parameters on the host (or with `offload_state` or
+        `offload_step`) is used as zero-copy views of the memory-mapped file, without reading it upfront.
+
+        :param params: If given, only the state of these parameters is restored, and the param groups' settings and
+            the preconditioner schedule are kept. Parameters are matched by position, like in `load_state_dict`.
+        """
+        index, tensors = load_state_file(path)
+        indexed = [(group, p) for group in self.param_groups for p in group['params']]
+        if len(indexed) != sum(len(g['params']) for g in index['param_groups']):
+            raise ValueError("The saved state belongs to a different set of parameters.")
+        restore = None if params is None else set(map(id, params))
+
+        if restore is None:
+            for group, saved in zip(self.param_groups, index['param_groups']):
+                group.update({k: _decode_state(v, tensors.__getitem__) for k, v in saved.items() if k != 'params'})
+            self.state.clear()
+            if 'schedule' in index:  # files written before the schedule was saved
+                self._load_schedule_state(index['schedule'])
+
+        moved = {}
+
+        def _read(i: int, device: torch.device):
+            if device.type == 'cpu':
+                return tensors[i]
+            if (i, device) not in moved:  # tensors shared between states stay shared
+                moved[(i, device)] = tensors[i].to(device)
+            return moved[(i, device)]
+
+        for idx, view_idx, state in index['state']:
+            group, p = indexed[idx]
+            if restore is not None and id(p) not in restore:
+                continue
+            device = torch.device('cpu') if self.offload_state or self.offload_step else p.device
+            self.state[self._state_views(group, p)[view_idx]] = _decode_state(state, functools.partial(_read,
+                                                                                                     device=device))
+
+    def _advance_precond_schedule(self):
         if self.precond_schedule is None:
             self._is_preconditioning = False
+            self._precond_prob = None
         else:
             self._is_preconditioning = psgd_should_update(self._inner_group, self.precond_schedule, self._precond_rng)
-        loss = self._handle_closure(closure)
+            self._precond_prob = self._inner_group['cumulative_prob_last_prob']
 
+    def _step_groups(self, groups: List[Tuple[int, dict]], ema: bool = True):
         # we assume that parameters are constant and that there are no excessive recompiles
         with torch.no_grad(), torch._dynamo.utils.disable_cache_limit():
-            for group in self.param_groups:
+            for i, group in groups:
                 group['is_preconditioning'] = self._is_preconditioning
-                self._step(group)
-                if self.use_ema:
+                group['precond_prob'] = self._precond_prob
+                if self.shard_state:
+                    owners = self.shard_owners(group)
+                    rank = dist.get_rank(self.shard_group)
+                    for p, owner in zip(group['params'], owners):
+                        if owner != rank:
+                            p.grad = None
+                view_owners = self._view_owners(group) if self.shard_preconditioner else None
+                with scalar_cache(self._scalar_caches.setdefault(i, {})), \
+                        precond_shard(view_owners, self.shard_group), \
+                        profiling(self.profiler, 'step', group['params'][0], i):
+                    if self.offload_step:
+                        self._step_on_host(group)
+                    elif self.offload_state:
+                        self._step_offloaded(group)
+                    else:
+                        self._step(group)
+                        self._mmap_state_(group['params'])
+                    if self.shard_state:
+                        with profiled('broadcast_shards', group['params'][0]):
+                            broadcast_from_owners([p.data for p in group['params']], owners, self.shard_group)
+                if self.use_ema and ema:
                     self.ema_update()
 
+    def _count_step(self):
+        """
+        Counts an optimizer step in every param group, on the host. Lets transforms tell a new step from another slice
+        of the current one (`foreach=False`, `step_params`), even where `group['step']` is a tensor that's updated
+        in-place (capturable, compile_step).
+        """
+        for group in self.param_groups:
+            group['step_index'] = group.get('step_index', 0) + 1
+
+    def step(self, closure: Optional[Callable] = None):
+        self._count_step()
+        self._advance_precond_schedule()
+        with profiling(self.profiler, 'closure', self.param_groups[0]['params'][0]):
+            loss = self._handle_closure(closure)
+
+        self._step_groups(list(enumerate(self.param_groups)))
+
+        if self.profiler is not None:
+            self.profiler.step += 1
         return loss
 
+    def step_params(self, params: List[Tensor], begin: bool = True, end: bool = True):
+        """
+        Steps only `params` (a fixed subset of this optimizer's parameters, e.g. a bucket whose gradients are ready),
+        with the same state and settings as `step`. Only the selected parameters are visited, so stepping a
+        model in many small slices costs no more Python overhead than stepping it at once.
+
+        :param begin: Whether this is the first slice of an optimizer step (counts the step and advances the
+            preconditioner schedule).
+        :param end: Whether this is the last slice of an optimizer step (updates the EMA and the profiler's step).
+        """
+        key = tuple(map(id, params))
+        if key not in self._param_subsets:
+            ids = set(key)
+            self._param_subsets[key] = [(i, [p for p in group['params'] if id(p) in ids])
+                                        for i, group in enumerate(self.param_groups)]
+        if begin:
+            self._count_step()
+            self._advance_precond_schedule()
+
+        subsets = [(i, subset) for i, subset in self._param_subsets[key] if subset]
+        originals = [self.param_groups[i]['params'] for i, _ in subsets]
+        try:
+            for i, subset in subsets:
+                self.param_groups[i]['params'] = subset
+            self._step_groups([(i, self.param_groups[i]) for i, _ in subsets], ema=False)
+        finally:
+            for (i, _), original in zip(subsets, originals):
+                self.param_groups[i]['params'] = original
+
+        if end:
+            if self.use_ema:
+                self.ema_update()
+            if self.profiler is not None:
+                self.profiler.step += 1
+
 
 def copy_stochastic_list_(target: List[Tensor], source: List[Tensor]):
     for t, s in zip(target, source):
         copy_stochastic_(t, s)
 
 
+_quant_block = 256
+
+
+def quantized_zeros_like(ref: Tensor) -> Tensor:
+    """
+    Zero-initialized block-wise 8-bit storage for a tensor shaped like `ref` (`storage_dtype="int8"`): one uint8
+    buffer holding a code per element, padded to blocks of 256, followed by each block's float32 absmax.
+    """
+    blocks = -(-ref.numel() // _quant_block)
+    return torch.zeros(blocks * (_quant_block + 4), dtype=torch.uint8, device=ref.device)
+
+
+def is_quantized(x: Tensor) -> bool:
+    return x.dtype == torch.uint8
+
+
+def _dequantize(x: Tensor, ref: Tensor) -> Tensor:
+    """
+    Codes are a sign bit and a 7-bit index `m` into a dynamic (tree) codebook: zero for m=0, otherwise
+    `10 ** (i - 6) * (0.1 + 0.9 * (m - 2 ** i + 1) / 2 ** i)` for the largest i with 2 ** i <= m, which covers
+    [1e-6, 1] relative to the block's absmax, evenly spaced within each decade.
+    """
+    blocks = x.numel() // (_quant_block + 4)
+    codes = x[:blocks * _quant_block].view(blocks, _quant_block)
+    absmax = x[blocks * _quant_block:].view(torch.float32).view(blocks, 1)
+    m = (codes & 127).float()
+    i = torch.floor(torch.log2(m + 0.5)).clamp(min=0)
+    power = torch.exp2(i)
+    value = torch.pow(10.0, i - 6) * (0.1 + 0.9 * (m - power + 1) / power)
+    value = torch.where(m == 0, 0.0, value) * absmax
+    value = torch.where(codes >= 128, -value, value)
+    return value.flatten()[:ref.numel()].view(ref.shape)
+
+
+def _quantize_(x: Tensor, value: Tensor):
+    """
+    Inverse of `_dequantize` with stochastic rounding between neighbouring codes. As the codebook is linear between
+    consecutive codes, the rounding is unbiased.
+    """
+    blocks = x.numel() // (_quant_block + 4)
+    value = value.float().flatten()
+    value = torch.cat([value, value.new_zeros(blocks * _quant_block - value.numel())]).view(blocks, _quant_block)
+    absmax = value.abs().amax(1, keepdim=True)
+    y = value.abs() / absmax.clamp(min=torch.finfo(torch.float32).tiny)
+    i = (torch.ceil(torch.log10(y)) + 6).clamp(min=0, max=6)
+    power = torch.exp2(i)
+    m = power - 1 + (y / torch.pow(10.0, i - 6) - 0.1) / 0.9 * power
+    m = torch.where(i == 0, y * 1e6, m)  # between zero and 1e-6
+    m = torch.floor(m + torch.rand_like(m)).clamp(min=0, max=127)
+    codes = torch.where(value < 0, m + 128, m).to(torch.uint8)
+    x[:blocks * _quant_block].copy_(codes.flatten())
+    x[blocks * _quant_block:].view(torch.float32).copy_(absmax.flatten())
+
+
+def promote_state(state: List[Tensor], ref: List[Tensor]) -> List[Tensor]:
+    """
+    Promotes state to float32, dequantizing `storage_dtype="int8"` state into the shapes of `ref`.
+    """
+    return [_dequantize(s, r) if is_quantized(s) else promote(s) for s, r in zip(state, ref)]
+
+
+def store_state_(state: List[Tensor], source: List[Tensor]):
+    """
+    Writes float32 values back into state, rounding stochastically to bfloat16 or int8 storage.
+    """
+    for s, x in zip(state, source):
+        if is_quantized(s):
+            _quantize_(s, x)
+        else:
+            copy_stochastic_(s, x)
+
+
 @decorator_knowngood
 def _lerp(state: List[Tensor], grad: List[Tensor], beta):
-    ea32 = list(map(promote, state))
+    ea32 = promote_state(state, grad)
     grad = list(map(promote, grad))
     beta = promote(beta)
     stochastic_lerp_(ea32, grad, 1 - beta)
-    copy_stochastic_list_(state, ea32)
+    store_state_(state, ea32)
     return ea32
 
 
@@ -899,8 +2261,33 @@ def _compilable_adam_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: Lis
 def adam_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: List[Tensor], beta1: float, beta2: float, step: int,
           eps: float = 1e-8):
     exp_avg, exp_avg_sq, grad = map(list_guard, (exp_avg, exp_avg_sq, grad))
-    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0])
-    _compilable_adam_(exp_avg, exp_avg_sq, grad, beta1, beta2, step, eps)
+    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0], name='adam')
+    _compilable_adam_(*flat_views(exp_avg, exp_avg_sq, grad), beta1, beta2, step, eps)
+    return grad
+
+
+@decorator_knowngood
+def _compilable_adafactor_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: List[Tensor], beta1: Tensor,
+                           beta2: Tensor, step: Tensor, eps: Tensor):
+    beta1 = beta_debias(beta1, step)
+    beta2 = beta_debias(beta2, step)
+
+    g32 = list(map(promote, grad))
+    exp_avg32 = _lerp(exp_avg, g32, beta1)
+    denom = _compilable_factored_exp_avg_sq_(exp_avg_sq, g32, beta2, eps)
+    u32 = torch._foreach_div(exp_avg32, denom)
+    copy_stochastic_list_(grad, u32)
+
+
+def adafactor_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: List[Tensor], beta1: float, beta2: float,
+               step: int, eps: float = 1e-8):
+    """
+    Adam with Adafactor's factored second moment (see `factored_exp_avg_sq_`), so `exp_avg_sq` takes O(m + n) memory
+    for an [m, n] matrix. `exp_avg_sq` has to be allocated with `factored_zeros_like`.
+    """
+    exp_avg, exp_avg_sq, grad = list_guard(exp_avg, exp_avg_sq, grad)
+    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, grad[0], name='adafactor')
+    _compilable_adafactor_(exp_avg, exp_avg_sq, grad, beta1, beta2, step, eps)
     return grad
 
 
@@ -915,14 +2302,15 @@ def _fused_compilable_adam_(y: List[Tensor], exp_avg: List[Tensor], exp_avg_sq:
     exp_avg32 = _lerp(exp_avg, u32, beta1)
     denom = _compilable_exp_avg_sq_(exp_avg_sq, u32, beta2, eps, [None])
     u32 = torch._foreach_div(exp_avg32, denom)
-    _compilable_update_(y, u32, decay, lr, caution, g32)
+    _compilable_update_(y, _split_like(u32, y), decay, lr, caution, g32)
 
 
 def fused_adam_(y: List[Tensor], exp_avg: List[Tensor], exp_avg_sq: List[Tensor], update: List[Tensor],
                 grad: List[Tensor], beta1: float, beta2: float, step: int, lr: float, eps: float, decay: float,
                 caution: bool):
     y, exp_avg, exp_avg_sq, grad = list_guard(y, exp_avg, exp_avg_sq, grad)
-    beta1, beta2, step, lr = scalar_guard(beta1, beta2, step, lr, y[0])
+    beta1, beta2, step, lr = scalar_guard(beta1, beta2, step, lr, y[0], name='fused_adam')
+    exp_avg, exp_avg_sq, update = flat_views(exp_avg, exp_avg_sq, list_guard(update))
     _fused_compilable_adam_(y, exp_avg, exp_avg_sq, update, grad, beta1, beta2, step, decay, lr, eps, caution)
 
 
@@ -942,8 +2330,8 @@ def _compilable_laprop_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: L
 def laprop_(exp_avg: List[Tensor], exp_avg_sq: List[Tensor], grad: List[Tensor], beta1: float, beta2: float, step: int,
             eps: float = 1e-8):
     exp_avg, exp_avg_sq, grad = list_guard(exp_avg, exp_avg_sq, grad)
-    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0])
-    _compilable_laprop_(exp_avg, exp_avg_sq, grad, beta1, beta2, step, eps)
+    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0], name='laprop')
+    _compilable_laprop_(*flat_views(exp_avg, exp_avg_sq, grad), beta1, beta2, step, eps)
     return grad
 
 
@@ -958,53 +2346,56 @@ def _fused_compilable_laprop_(y: List[Tensor], exp_avg: List[Tensor], exp_avg_sq
     denom = _compilable_exp_avg_sq_(exp_avg_sq, u32, beta2, eps, [None])
     u32 = torch._foreach_div(u32, denom)
     u32 = _lerp(exp_avg, u32, beta1)
-    _compilable_update_(y, u32, decay, lr, caution, gp32)
+    _compilable_update_(y, _split_like(u32, y), decay, lr, caution, gp32)
 
 
 def fused_laprop_(y: List[Tensor], exp_avg: List[Tensor], exp_avg_sq: List[Tensor], update: List[Tensor],
                   grad: List[Tensor], beta1: float, beta2: float, step: int, lr: float, decay: float, caution: bool,
                   eps: float = 1e-8):
     exp_avg, exp_avg_sq, grad, y = list_guard(exp_avg, exp_avg_sq, grad, y)
-    beta1, beta2, step, lr, eps = scalar_guard(beta1, beta2, step, lr, eps, exp_avg[0])
+    beta1, beta2, step, lr, eps = scalar_guard(beta1, beta2, step, lr, eps, exp_avg[0], name='fused_laprop')
+    exp_avg, exp_avg_sq, update = flat_views(exp_avg, exp_avg_sq, list_guard(update))
     _fused_compilable_laprop_(y, exp_avg, exp_avg_sq, update, grad, beta1, beta2, step, lr, decay, caution, eps)
 
 
 @decorator_knowngood
 def _fused_compilable_adopt_(y, update, grad, exp_avg_sq, exp_avg, beta1, beta2, step, lr, eps, decay, caution):
-    u32, g32, exp_avg_sq32, exp_avg32 = [list(map(promote, x)) for x in [update, grad, exp_avg_sq, exp_avg]]
+    u32, g32 = [list(map(promote, x)) for x in [update, grad]]
+    exp_avg_sq32 = promote_state(exp_avg_sq, g32)
     _compilable_update_(y, u32, decay, lr, caution, g32)
 
     beta1 = beta_debias(beta1, step)
     denom = [eps_sqrt(d, eps) for d in exp_avg_sq32]
-    stochastic_lerp_(exp_avg, torch._foreach_div(g32, denom), 1 - beta1)
+    _lerp(exp_avg, torch._foreach_div(g32, denom), beta1)
 
     beta2 = beta_debias(beta2, step + 1)
-    stochastic_lerp_(exp_avg_sq, torch._foreach_mul(g32, g32), 1 - beta2)
+    _lerp(exp_avg_sq, torch._foreach_mul(g32, g32), beta2)
 
 
 def fused_adopt_(y, update, grad, exp_avg_sq, exp_avg, beta1, beta2, step, lr, eps, decay, caution):
     exp_avg, exp_avg_sq, grad, y = list_guard(exp_avg, exp_avg_sq, grad, y)
-    beta1, beta2, step, lr = scalar_guard(beta1, beta2, step, lr, exp_avg[0])
+    beta1, beta2, step, lr = scalar_guard(beta1, beta2, step, lr, exp_avg[0], name='fused_adopt')
     _fused_compilable_adopt_(y, update, grad, exp_avg_sq, exp_avg, beta1, beta2, step, lr, eps, decay, caution)
 
 
 @decorator_knowngood
 def _compilable_adopt_(grad, exp_avg_sq, exp_avg, beta1, beta2, step, eps):
-    g32, exp_avg32, exp_avg_sq32 = [list(map(promote, x)) for x in [grad, exp_avg, exp_avg_sq]]
-    update = [e.clone() for e in exp_avg]
+    g32 = list(map(promote, grad))
+    exp_avg32, exp_avg_sq32 = promote_state(exp_avg, g32), promote_state(exp_avg_sq, g32)
+    update = [e.clone() for e in exp_avg32]
 
     beta1 = beta_debias(beta1, step)
     denom = [eps_sqrt(d, eps) for d in exp_avg_sq32]
-    stochastic_lerp_(exp_avg, torch._foreach_div(g32, denom), 1 - beta1)
+    _lerp(exp_avg, torch._foreach_div(g32, denom), beta1)
 
-    stochastic_lerp_(exp_avg_sq, torch._foreach_mul(g32, g32), 1 - beta2)
+    _lerp(exp_avg_sq, torch._foreach_mul(g32, g32), beta2)
 
     copy_stochastic_list_(grad, update)
 
 
 def adopt(grad, exp_avg_sq, exp_avg, beta1, beta2, step, eps: float = 1e-8):
     exp_avg, exp_avg_sq, grad = list_guard(exp_avg, exp_avg_sq, grad)
-    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0])
+    beta1, beta2, step, eps = scalar_guard(beta1, beta2, step, eps, exp_avg[0], name='adopt')
     _compilable_adopt_(grad, exp_avg_sq, exp_avg, beta1, beta2, step, eps)
     return grad
 
@@ -1051,12 +2442,26 @@ def _compilable_update_(p: List[Tensor], u: List[Tensor], decay: Tensor, lr: Ten
 def update_param_(param: List[Tensor], update: List[Tensor], lr: float, decay: float, caution: bool = False,
                   grad: List[Tensor] = None):
     param, update, grad = list_guard(param, update, grad)
-    lr = scalar_guard(lr, param[0])
+    lr = scalar_guard(lr, param[0], name='update_param')
     if not caution:
         grad = [None] * len(param)
     _compilable_update_(param, update, decay, lr, caution, grad)
 
 
+@decorator_knowngood
+def _compilable_warmup_lr_(out: Tensor, base_lr: Tensor, step: Tensor, warmup_steps: int):
+    out.copy_(base_lr * step / step.clamp(min=warmup_steps + 1))
+
+
+def warmup_lr_(out: Tensor, base_lr: float, step: Tensor, warmup_steps: int):
+    """
+    Computes the linearly warmed-up learning rate on device, without synchronizing with the host.
+    """
+    base_lr = scalar_guard(base_lr, out, name='warmup_lr')
+    _compilable_warmup_lr_(out, base_lr, step, warmup_steps)
+    return out
+
+
 def precond_schedule(step, precond_scheduler, rng):
     precond_prob = max(step, 1) ** precond_scheduler[0]
     precond_prob = math.log10(precond_prob)
@@ -1079,9 +2484,124 @@ def _max_idx(x: List[int]):
     return len(x) - 1 - np.argmax(x[::-1])  # we want to start counting from the back, as torch is fan-out/fan-in
 
 
-def init_Q_exprs(t, scale, max_size, min_ndim_triangular, memory_save_mode, dtype=None):
+def init_lowrank_Q(size: int, rank: int, scale: float, dtype, device) -> Tensor:
+    """
+    Low-rank-plus-diagonal PSGD factor Q = (I + U V^T) diag(d), as in Xi-Lin Li's "UVd" preconditioner. d, U and V
+    are packed column-wise into one [size, 1 + 2 * rank] tensor, so that the factor is stored, sharded and
+    checkpointed like the diagonal and triangular ones. U and V start small but nonzero, as each one's gradient is
+    proportional to the other.
+    """
+    q = torch.randn(size, 1 + 2 * rank, dtype=dtype, device=device)
+    q[:, 1:] *= (0.1 / (size * rank)) ** 0.5
+    q[:, 0] = scale
+    return q
+
+
+def is_lowrank(q: Union[Tensor, Tuple[Optional[List[int]], Tensor]]) -> bool:
+    """
+    Whether a (possibly `triu_to_line`-packed) PSGD factor is an `init_lowrank_Q` factor; triangular ones are square.
+    """
+    shape = dense_shape(q)
+    return len(shape) == 2 and shape[0] != shape[1]
+
+
+def _lowrank_parts(q: Tensor):
+    rank = (q.size(1) - 1) // 2
+    return q[:, 0], q[:, 1:1 + rank], q[:, 1 + rank:]
+
+
+def _ipuvt(U: Tensor, V: Tensor, x: Tensor, inverse: bool = False) -> Tensor:
+    """
+    (I + U V^T) x, or its inverse (via Woodbury, solving one [rank, rank] system) applied to x.
+    """
+    if not inverse:
+        return x + U @ (V.T @ x)
+    eye = torch.eye(U.size(1), dtype=U.dtype, device=U.device)
+    return x - U @ torch.linalg.solve(eye + V.T @ U, V.T @ x)
+
+
+def lowrank_apply(q: Tensor, x: Tensor, transpose: bool = False, inverse: bool = False) -> Tensor:
+    """
+    Q x, Q^T x, Q^-1 x or Q^-T x for an `init_lowrank_Q` factor q and x of shape [size, n], in O(size * rank * n).
+    """
+    d, U, V = (promote(t) for t in _lowrank_parts(q))
+    x, d = promote(x), d.view(-1, 1)
+    if transpose:  # Q^T = diag(d) (I + V U^T)
+        U, V = V, U
+    if transpose == inverse:  # diag(d) is applied first
+        return _ipuvt(U, V, x / d if inverse else x * d, inverse)
+    x = _ipuvt(U, V, x, inverse)
+    return x / d if inverse else x * d
+
+
+def _mode_apply(x: Tensor, dim: int, fn: Callable[[Tensor], Tensor]) -> Tensor:
+    """
+    Applies a matrix-vector function to every fiber of x along `dim`.
+    """
+    y = x.movedim(dim, 0)
+    shape = y.shape
+    return fn(y.reshape(shape[0], -1)).reshape(shape).movedim(0, dim)
+
+
+def lowrank_precond_(x: Tensor, Q: List[Tensor], transpose: bool = False, inverse: bool = False,
+                     gram: bool = False) -> Tensor:
+    """
+    Applies every `init_lowrank_Q` factor of Q along its dimension of x (Q^T Q with `gram`). `init_Q_exprs` leaves
+    these dimensions out of its einsum expressions, so this complements them. Other factors are skipped.
+    """
+    for i, q in enumerate(Q):
+        if not is_lowrank(q):
+            continue
+        if gram:
+            x = _mode_apply(x, i, lambda y: lowrank_apply(q, lowrank_apply(q, y), transpose=True))
+        else:
+            x = _mode_apply(x, i, lambda y: lowrank_apply(q, y, transpose, inverse))
+    return x
+
+
+def _frob_prod(x: Tensor, gram: Tensor) -> Tensor:
+    """
+    ||x W^T|| for gram = W^T W, without materializing x W^T.
+    """
+    return ((x @ gram) * x).sum().clamp(min=0).sqrt()
+
+
+def _lowrank_update(q: Tensor, a: Tensor, b: Tensor, precond_lr, update_u: bool) -> Tensor:
+    """
+    Step of an `init_lowrank_Q` factor q towards fitting a = Q h and b = Q^-T v (the update's A and conjB along q's
+    dimension, as [size, n] matrices), following Li's UVd update. Updates d like a diagonal factor and either U
+    (`update_u`) or V, as updating both at once is unstable, each normalized by a bound of its gradient's scale.
+    The caller picks the branch at random (see `psgd_update_noise`). Returns the decrement of q.
+    """
+    d, U, V = (promote(t) for t in _lowrank_parts(q))
+    a, b = promote(a), promote(b)
+    tiny = torch.finfo(a.dtype).tiny
+    Ph, h = lowrank_apply(q, a, transpose=True), lowrank_apply(q, a, inverse=True)
+    invPv, v = lowrank_apply(q, b, inverse=True), lowrank_apply(q, b, transpose=True)
+    nabla_d, term_b = (Ph * h).sum(1), (v * invPv).sum(1)
+    norm = (nabla_d.abs() + term_b.abs()).max().clamp(min=tiny)
+    dd = precond_lr * d * (nabla_d - term_b) / norm
+
+    if update_u:
+        eye = torch.eye(U.size(1), dtype=U.dtype, device=U.device)
+        VtU = V.T @ U
+        atV, btV = a.T @ V, b.T @ V
+        VtV = V.T @ V
+        mu = precond_lr / (a.norm() * _frob_prod(atV, VtV) + b.norm() * _frob_prod(btV, VtV)).clamp(min=tiny)
+        dU, dV = mu * (a @ (atV @ (eye + VtU)) - b @ (btV @ (eye + VtU))), torch.zeros_like(V)
+    else:
+        atU, btU = a.T @ U, b.T @ U
+        UtU = U.T @ U
+        mu = precond_lr / (a.norm() * _frob_prod(atU, UtU) + b.norm() * _frob_prod(btU, UtU)).clamp(min=tiny)
+        dU, dV = torch.zeros_like(U), mu * ((a + V @ atU.T) @ atU - (b + V @ btU.T) @ btU)
+    return torch.cat([dd.view(-1, 1), dU, dV], 1)
+
+
+def init_Q_exprs(t, scale, max_size, min_ndim_triangular, memory_save_mode, dtype=None, rank: int = 0):
     """For a scalar or tensor t, we initialize its preconditioner Q and
     reusable einsum expressions for updating Q and preconditioning gradient.
+    With rank > 0, dimensions that would get a diagonal Q because they're larger than max_size or selected by
+    memory_save_mode get an `init_lowrank_Q` factor instead, which the expressions leave to `lowrank_precond_`.
     """
     letters = string.ascii_lowercase + string.ascii_uppercase
     dtype = dtype if dtype is not None else t.dtype
@@ -1120,7 +2640,17 @@ def init_Q_exprs(t, scale, max_size, min_ndim_triangular, memory_save_mode, dtyp
     exprGs = []
     piece1P, piece2P, piece3P, piece4P = ([], [], "", "")
     for i, (size, dim_d) in enumerate(zip(shape, dim_diag)):
-        if size == 1 or size > max_size or len(shape) < min_ndim_triangular or dim_d:
+        if (size > max_size or dim_d) and size > 1 + 2 * rank > 1 and len(shape) >= min_ndim_triangular:
+            # use diagonal plus low-rank matrix as preconditioner for this dim, applied by lowrank_precond_
+            Q.append(init_lowrank_Q(size, rank, scale, promote(dtype), t.device))
+
+            piece2A = piece2A + letters[i]
+            piece3A = piece3A + letters[i]
+            piece1 = "".join([(letters[i + 13] if j == i else letters[j]) for j in range(len(shape))])
+            exprGs.append(piece1 + "," + piece1 + "->" + letters[i + 13])  # unused, updated by _lowrank_update
+            piece3P = piece3P + letters[i + 13]
+            piece4P = piece4P + letters[i + 13]
+        elif size == 1 or size > max_size or len(shape) < min_ndim_triangular or dim_d:
             # use diagonal matrix as preconditioner for this dim
             Q.append(scale * torch.ones(size, dtype=promote(dtype), device=t.device))
 
@@ -1150,34 +2680,62 @@ def init_Q_exprs(t, scale, max_size, min_ndim_triangular, memory_save_mode, dtyp
             piece3P = piece3P + c
             piece4P = piece4P + b
 
-    exprA = ",".join(piece1A) + "," + piece2A + "->" + piece3A
-    exprP = (",".join(piece1P) + "," + ",".join(piece2P) + "," + piece3P + "->" + piece4P)
+    exprA = ",".join(piece1A + [piece2A]) + "->" + piece3A
+    exprP = ",".join(piece1P + piece2P + [piece3P]) + "->" + piece4P
     return [Q, (exprA, tuple(exprGs), exprP)]
 
 
 @decorator
 def psgd_balance_Q(Q_in):
+    """
+    Rescales the factors of Q to equal max-norms without changing their Kronecker product. `init_lowrank_Q` factors
+    are scaled through their diagonal, and their U and V are rescaled to equal norms without changing U V^T.
+    """
+    lowrank = [_lowrank_parts(q) for q in Q_in if is_lowrank(q)]
+    Q_in = [q[:, 0] if is_lowrank(q) else q for q in Q_in]
     norms = torch.stack([q.norm(float("inf")) for q in Q_in])
     geometric_mean = norms.log().mean().exp()
     norms = geometric_mean / norms
     torch._foreach_mul_(Q_in, list(norms))
+    for _, U, V in lowrank:
+        rho = (U.norm().clamp(min=tiny_bf16) / V.norm().clamp(min=tiny_bf16)).sqrt()
+        U.div_(rho)
+        V.mul_(rho)
 
 
-def psgd_calc_A_and_conjB(exprA, G, Q, V=None):
+def psgd_update_noise(G: Tensor, V: Optional[Tensor] = None,
+                      Q: Optional[List] = None) -> Tuple[Tensor, Optional[Tensor], List[bool]]:
+    """
+    Random numbers one PSGD preconditioner update of G consumes: the perturbation of G, without a V (see
+    `hessian_approx`) the probe vector that stands in for it, and for every `init_lowrank_Q` factor of Q whether
+    `_lowrank_update` steps its U or its V. The latter are drawn on the host, so branching on them doesn't sync.
+    """
+    noise = torch.randn_like(G)
+    update_u = (torch.rand(sum(is_lowrank(q) for q in Q or ())) < 0.5).tolist()
+    if V is not None:
+        return noise, None, update_u
+    return noise, torch.randn(G.shape[1:] + G.shape[:1], dtype=promote(G.dtype), device=G.device), update_u
+
+
+def psgd_calc_A_and_conjB(exprA, G, Q, V=None, noise=None):
+    noise, probe, _ = psgd_update_noise(G, V) if noise is None else noise
     eps = scalar_guard(math.sqrt(torch.finfo(G.dtype).eps), G)
     eps *= G.norm() / G.numel()
-    G = G + torch.randn_like(G) * eps
+    G = G + noise * eps
     md = min_dtype(Q + [G])
-    A = torch.einsum(exprA, *[q.to(md) for q in Q], G.to(md)).to(G.dtype)
+    A = contract(exprA, *[q.to(md) for q in Q if not is_lowrank(q)], G.to(md))
+    A = lowrank_precond_(A, Q).to(G.dtype)
     order = G.dim()
     if V is None:
-        conjB = torch.randn(G.shape[1:] + G.shape[:1], dtype=promote(G.dtype), device=G.device)
+        conjB = probe
     else:
         conjB = V.permute(*range(1, order), 0).to(promote(G.dtype))
     Q = [promote(q) for q in Q]
     for i, q in enumerate(Q):
         if q.dim() <= 1:
             conjB /= q
+        elif is_lowrank(q):
+            conjB = lowrank_apply(q, conjB.reshape(-1, q.size(0)).T, True, True).T.reshape_as(conjB)
         else:
             conjB = torch.linalg.solve_triangular(q, conjB.reshape(-1, q.size(0)), upper=True, left=False).reshape_as(
                 conjB)
@@ -1200,12 +2758,27 @@ def psgd_lb(A, max_abs):
 
 
 @decorator
-def psgd_update_precond(Q, exprs, G, precond_lr, oq, store_triu_as_line, V):
-    """Update Kronecker product preconditioner Q with pair (V, G)."""
+def psgd_update_precond(Q, exprs, G, precond_lr, oq, store_triu_as_line, V, noise=None):
+    """
+    Update Kronecker product preconditioner Q with pair (V, G). The update is added to oq. With store_triu_as_line,
+    oq holds `triu_to_line` entries: the update is added to the dense, `unpack_triu`-ed Q instead, which is then
+    packed into oq, so that a caller passing its unpacked Q keeps using the updated one. `init_lowrank_Q` factors are
+    updated by `_lowrank_update`. `noise` is the `psgd_update_noise` of G, drawn here if not given.
+    """
     exprA, exprGs, _ = exprs
-    A, conjB = psgd_calc_A_and_conjB(exprA, G, Q, V)
-
-    for q, exprG, o in zip(Q, exprGs, oq):
+    Q = [unpack_triu(q) for q in Q]
+    noise = psgd_update_noise(G, V, Q) if noise is None else noise
+    A, conjB = psgd_calc_A_and_conjB(exprA, G, Q, V, noise)
+    update_u = iter(noise[2])
+
+    drift = []
+    for k, (q, exprG, o) in enumerate(zip(Q, exprGs, oq)):
+        if is_lowrank(q):
+            term1 = _lowrank_update(q, A.movedim(k, 0).reshape(q.size(0), -1),
+                                    conjB.movedim(k, 0).reshape(q.size(0), -1), precond_lr, next(update_u))
+            drift.append(term1.norm() / q.norm().to(term1.dtype).clamp(min=tiny_bf16))
+            stochastic_add_(o[1] if store_triu_as_line else o, term1, -1)
+            continue
         term1 = promote(torch.einsum(exprG, A, A))
         term2 = promote(torch.einsum(exprG, conjB, conjB))
         term1, term2 = term1 - term2, term1 + term2
@@ -1217,10 +2790,128 @@ def psgd_update_precond(Q, exprs, G, precond_lr, oq, store_triu_as_line, V):
             torch.triu(term1, out=term1)
             term1 /= torch.where(norm > 0, psgd_lb(term2, norm), norm).clamp_(tiny_bf16)
             term1 = torch.mm(term1, q.to(term1.dtype))
+        drift.append(term1.norm() / q.norm().to(term1.dtype).clamp(min=tiny_bf16))
+        if not store_triu_as_line:
+            stochastic_add_(o, term1, -1)
+            continue
+        stochastic_add_(q, term1, -1)
+        update_triu_([o], [q])
+    return torch.stack(drift).max()
+
+
+def _batch_expr(expr: str, batch: str = 'Z'):
+    """
+    Prepends a batch dimension to every operand of an einsum expression. init_Q_exprs never uses `Z`.
+    """
+    inputs, output = expr.split('->')
+    return ','.join(batch + x for x in inputs.split(',')) + '->' + batch + output
+
+
+def _batched_psgd_calc_A_and_conjB(exprA, G, Q, V, noise, probe):
+    order = G.dim() - 1
+    eps = math.sqrt(torch.finfo(G.dtype).eps) * G.flatten(1).norm(dim=1) / G[0].numel()
+    G = G + noise * eps.view(-1, *[1] * order)
+    md = min_dtype(Q + [G])
+    A = contract(_batch_expr(exprA), *[q.to(md) for q in Q], G.to(md)).to(G.dtype)
+    if V is None:
+        conjB = probe
+    else:
+        conjB = V.permute(0, *range(2, order + 1), 1).to(promote(G.dtype))
+    Q = [promote(q) for q in Q]
+    for i, q in enumerate(Q):
+        if q.dim() <= 2:
+            conjB /= q.view(q.size(0), *[1] * (order - 1), q.size(1))
+        else:
+            conjB = torch.linalg.solve_triangular(q, conjB.reshape(q.size(0), -1, q.size(1)), upper=True,
+                                                  left=False).reshape_as(conjB)
+        if i < order - 1:
+            conjB = torch.transpose(conjB, i + 1, order)
+    return A, conjB
+
+
+def _batched_psgd_lb(A, max_abs):
+    A /= max_abs
+    a0 = torch.einsum('bij,bij->bj', A, A)
+    i = torch.argmax(a0, dim=1)
+    x = torch.gather(A, 2, i.view(-1, 1, 1).expand(-1, A.size(1), 1)).squeeze(-1)
+    x = torch.einsum('bi,bij->bj', x, A)
+    x /= x.norm(dim=1, keepdim=True)
+    x = torch.einsum('bj,bkj->bk', x, A)
+    x = x.norm(dim=1)
+    return x.view(-1, 1, 1) * max_abs
+
+
+@decorator
+def _batched_psgd_update_precond(Q, exprs, G, precond_lr, oq, V, noise, probe):
+    """
+    psgd_update_precond for a stack of same-shaped parameters. Q holds one stacked tensor per factor, oq holds the
+    dense per-parameter factors that receive the update, noise and probe the stacked `psgd_update_noise`.
+    """
+    exprA, exprGs, _ = exprs
+    A, conjB = _batched_psgd_calc_A_and_conjB(exprA, G, Q, V, noise, probe)
+
+    drift = []
+    for k, (q, exprG) in enumerate(zip(Q, exprGs)):
+        exprG = _batch_expr(exprG)
+        term1 = promote(torch.einsum(exprG, A, A))
+        term2 = promote(torch.einsum(exprG, conjB, conjB))
+        term1, term2 = term1 - term2, term1 + term2
+        term1 *= precond_lr
+        norm = torch.linalg.vector_norm(term2.flatten(1), float('inf'), dim=1)
+        if q.dim() < 3:
+            term1 *= q.to(term1.dtype) / norm.clamp_(min=tiny_bf16).view(-1, 1)
+        else:
+            torch.triu(term1, out=term1)
+            norm = norm.view(-1, 1, 1)
+            term1 /= torch.where(norm > 0, _batched_psgd_lb(term2, norm), norm).clamp_(tiny_bf16)
+            term1 = torch.bmm(term1, q.to(term1.dtype))
+        norm = q.flatten(1).norm(dim=1).to(term1.dtype).clamp(min=tiny_bf16)
+        drift.append(term1.flatten(1).norm(dim=1) / norm)
+        stochastic_add_([o_[k] for o_ in oq], list(term1.unbind(0)), -1)
+    return torch.stack(drift).amax(0)
+
+
+def foreach_psgd_update_precond(Qs: List[List[Tensor]], exprs: List[Tuple], Gs: List[Tensor], precond_lr,
+                                oqs: List[List], store_triu_as_line: bool, Vs: List[Optional[Tensor]],
+                                noises: Optional[List[Tuple]] = None):
+    """
+    psgd_update_precond for a list of parameters. Parameters sharing shape, dtype, einsum expressions and
+    preconditioner layout are stacked, so that their Kronecker factors are updated with one batched einsum,
+    triangular solve and matmul each, instead of one small kernel launch per parameter.
+    The `psgd_update_noise` of every parameter is drawn up front, in parameter order, unless given in `noises`, so
+    that the random numbers don't depend on the batching. As in `psgd_update_precond`, unpacked Qs are updated, too.
+    Returns the relative change of every Q (the largest |dQ| / |Q| over its factors) as 0-dim tensors.
+    """
+    if noises is None:
+        noises = [psgd_update_noise(G, V, Q) for G, V, Q in zip(Gs, Vs, Qs)]
+    drifts = [None] * len(Gs)
+    buckets = {}
+    for i, (Q, expr, G, V) in enumerate(zip(Qs, exprs, Gs, Vs)):
+        lowrank = any(is_lowrank(q) for q in Q)
+        Q = [q if isinstance(q, Tensor) else q[1] for q in Q]
+        key = (G.shape, G.dtype, G.device, expr, tuple((q.shape, q.dtype) for q in Q), V is None, lowrank)
+        buckets.setdefault(key, []).append(i)
+
+    for key, bucket in buckets.items():
+        if len(bucket) == 1 or Gs[bucket[0]].dim() == 0 or key[-1]:  # low-rank factors are updated one by one
+            for i in bucket:
+                drifts[i] = psgd_update_precond(Qs[i], exprs[i], Gs[i], precond_lr, oqs[i], store_triu_as_line, Vs[i],
+                                                noises[i])
+            continue
+        dense = [[unpack_triu(q) for q in Qs[i]] for i in bucket]
+        Q = [torch.stack(q) for q in zip(*dense)]
+        G = torch.stack([Gs[i] for i in bucket])
+        V = None if Vs[bucket[0]] is None else torch.stack([Vs[i] for i in bucket])
+        noise = torch.stack([noises[i][0] for i in bucket])
+        probe = None if V is not None else torch.stack([noises[i][1] for i in bucket])
+        oq = dense if store_triu_as_line else [oqs[i] for i in bucket]
+        drift = _batched_psgd_update_precond(Q, exprs[bucket[0]], G, precond_lr, oq, V, noise, probe)
         if store_triu_as_line:
-            term1 = triu_to_line([term1])[0][1]
-            o = o[1]
-        stochastic_add_(o, term1, -1)
+            for i, d in zip(bucket, dense):
+                update_triu_(oqs[i], d)
+        for i, d in zip(bucket, drift.unbind(0)):
+            drifts[i] = d
+    return drifts
 
 
 @decorator_knowngood
@@ -1284,7 +2975,7 @@ def mu_law_compress(x, mu=127.0):
         mu: Compression parameter (default 127.0 for behavior similar to trust_region=1.5)
     """
     x = list_guard(x)
-    mu = scalar_guard(mu, x[0])
+    mu = scalar_guard(mu, x[0], name='mu_law_compress')
     _compilable_mu_law_compress_(x, mu)
     return x
 
@@ -1313,7 +3004,7 @@ def a_law_compress(x, A=87.6):
     :return:
     """
     x = list_guard(x)
-    A = scalar_guard(A, x[0])
+    A = scalar_guard(A, x[0], name='a_law_compress')
     _compilable_a_law_compress_(x, A)
     return x
 
@@ -1330,7 +3021,7 @@ def _compilable_weight_decay_to_ema_(p, ema, ema_decay, weight_decay):
 
 def weight_decay_to_ema_(p, ema, ema_decay, weight_decay):
     p, ema = list_guard(p, ema)
-    ema_decay, weight_decay = scalar_guard(ema_decay, weight_decay, p[0])
+    ema_decay, weight_decay = scalar_guard(ema_decay, weight_decay, p[0], name='weight_decay_to_ema')
     _compilable_weight_decay_to_ema_(p, ema, ema_decay, weight_decay)
 
 
@@ -1345,7 +3036,7 @@ def _compilable_l1_weight_decay_to_ema_(p, ema, ema_decay, weight_decay):
 
 def l1_weight_decay_to_ema_(p, ema, ema_decay, weight_decay):
     p, ema = list_guard(p, ema)
-    ema_decay, weight_decay = scalar_guard(ema_decay, weight_decay, p[0])
+    ema_decay, weight_decay = scalar_guard(ema_decay, weight_decay, p[0], name='l1_weight_decay_to_ema')
     _compilable_l1_weight_decay_to_ema_(p, ema, ema_decay, weight_decay)
 
 
@@ -1380,19 +3071,38 @@ def _compilable_trust_region_clip_(grad, lerp, scale):
 
 def trust_region_clip_(grad, lerp=0.9, scale=1.5):
     grad = list_guard(grad)
-    lerp, scale = scalar_guard(lerp, scale, grad[0])
+    lerp, scale = scalar_guard(lerp, scale, grad[0], name='trust_region_clip')
     _compilable_trust_region_clip_(grad, lerp, scale)
     return grad
 
 
+_triu_index_cache = {}
+
+
+def _triu_flat_index(n: int, device: torch.device) -> Tensor:
+    """
+    Flat positions `i * n + j` of the upper triangle of an [n, n] matrix in `triu_to_line` order. Cached per shape and
+    device, so all factors of the same size share one device-resident index instead of rebuilding it every step.
+    """
+    device = torch.device(device)
+    key = (n, device)
+    if key in _triu_index_cache:
+        return _triu_index_cache[key]
+    i, j = torch.triu_indices(n, n, device=device)
+    idx = (i * n + j).to(torch.int32 if n * n < 2 ** 31 else torch.int64)
+    if not is_compiling():
+        _triu_index_cache[key] = idx
+    return idx
+
+
 @decorator
 def triu_to_line(Q_list: List[Tensor]):
     out = []
     for q in Q_list:
-        if q.dim() < 2:
+        if q.dim() < 2 or is_lowrank(q):
             out.append((None, q))
         else:
-            out.append((q.shape, q[tuple(torch.triu_indices(*q.shape))]))
+            out.append((q.shape, q.reshape(-1).index_select(0, _triu_flat_index(q.size(0), q.device))))
     return out
 
 
@@ -1404,21 +3114,83 @@ def _triu_shape(numel):
 
 @decorator
 def line_to_triu(Q_list: List[Tuple[Optional[List[int]], Tensor]]):
-    new = []
-    for shape, q in Q_list:
-        if shape is not None:
-            shape = _triu_shape(q.numel())
-            x = torch.zeros(shape, device=q.device, dtype=q.dtype)
-            x[tuple(torch.triu_indices(*shape, device=q.device))] = q
-            q = x
-        new.append(q)
-    return new
+    return [unpack_triu(q) for q in Q_list]
+
+
+def _triu_line_index(n: int, device: torch.device) -> Tensor:
+    """
+    Flattened positions of the elements of an upper-triangular [n, n] matrix in its `triu_to_line` line. Entries below
+    the diagonal point to valid (unrelated) positions, so the line can be gathered without masking. Cached like
+    `_triu_flat_index`.
+    """
+    device = torch.device(device)
+    key = ('line', n, device)
+    if key in _triu_index_cache:
+        return _triu_index_cache[key]
+    i = torch.arange(n, device=device).view(-1, 1)
+    j = torch.arange(n, device=device).view(1, -1)
+    idx = (i * (2 * n - i + 1) // 2 + j - i).flatten().to(torch.int32 if n * n < 2 ** 31 else torch.int64)
+    if not is_compiling():
+        _triu_index_cache[key] = idx
+    return idx
+
+
+def unpack_triu(q: Union[Tensor, Tuple[Optional[List[int]], Tensor]]) -> Tensor:
+    """
+    Triangular matrix of a `triu_to_line` entry; plain tensors are returned as-is. The line is read with a single
+    gather, followed by zeroing the lower triangle in-place, instead of zero-filling a dense matrix and scattering the
+    line into it. The result is a dense copy, so callers should unpack once per step and share it.
+    """
+    if isinstance(q, Tensor):
+        return q
+    shape, q = q
+    if shape is None:
+        return q
+    n = _triu_shape(q.numel())[0]
+    return q.index_select(0, _triu_line_index(n, q.device)).view(n, n).triu_()
+
+
+def dense_shape(q: Union[Tensor, Tuple[Optional[List[int]], Tensor]]) -> Tuple[int, ...]:
+    """
+    Shape of `unpack_triu(q)`, without unpacking.
+    """
+    if isinstance(q, Tensor):
+        return tuple(q.shape)
+    shape, q = q
+    return tuple(q.shape) if shape is None else _triu_shape(q.numel())
+
+
+def psgd_precond_plan(expr: str, ea: Tensor, preconds: List, cached: bool = False):
+    """
+    `einsum_plan` for `psgd_precond_grad` (or, with `cached`, `precond_grad_cached_`) of `ea` with `preconds`.
+    """
+    shapes = [dense_shape(q) for q in preconds if not is_lowrank(q)]
+    if not cached:
+        shapes = shapes + shapes
+    return einsum_plan(expr, *shapes, ea.shape)
+
+
+def psgd_cache_pays_off(Q: List, grad: Tensor, prob: float) -> bool:
+    """
+    Whether `precond_grad_cached_` with Q^T Q is cheaper than `psgd_precond_grad` with Q for `grad`, counting matmul
+    FLOPs. Caching replaces the two per-step products with each triangular factor of size d by one (saving 2 * d
+    FLOPs per element of `grad`), but Q^T Q has to be rebuilt after every preconditioner update (2 * d ** 3 FLOPs at
+    probability `prob`). Diagonal factors are elementwise either way and don't count.
+    """
+    saved = rebuild = 0
+    for q in Q:
+        shape = dense_shape(q)
+        if len(shape) == 2 and not is_lowrank(q):
+            saved += 2 * grad.numel() * shape[0]
+            rebuild += 2 * shape[0] ** 3
+    return saved > prob * rebuild
 
 
 def update_triu_(q_state, materialised):
     for (shape0, q), (shape1, m) in zip(q_state, triu_to_line(materialised)):
         assert shape0 == shape1
-        copy_stochastic_(q, m)
+        if q is not m:  # unpacked entries are shared with `materialised`
+            copy_stochastic_(q, m)
 
 
 _warned = set()
@@ -1430,16 +3202,74 @@ def warn_once(msg):
         _warned.add(msg)
 
 
+def new_precond_refresh() -> dict:
+    """
+    Per-parameter schedule state of `adaptive_precond`; see `adaptive_should_update` and `adapt_precond_schedule_`.
+    """
+    return {'scale': 1.0, 'cumulative': 0.0, 'prob': None, 'drift': None}
+
+
+def adaptive_should_update(refresh: dict, prob: float) -> bool:
+    """
+    Per-parameter `psgd_should_update`: refreshes whenever the cumulative probability crosses an integer, where the
+    optimizer's refresh probability `prob` is scaled by the parameter's `refresh['scale']`.
+    """
+    refresh['prob'] = min(1.0, prob * refresh['scale'])
+    cumulative = refresh['cumulative']
+    refresh['cumulative'] = cumulative + refresh['prob']
+    return int(refresh['cumulative']) > int(cumulative)
+
+
+def adapt_precond_schedule_(refreshes: List[dict], drifts: List[Tensor], target: float, max_scale: float = 64):
+    """
+    Doubles the refresh rate of parameters whose preconditioner drifted by more than `target` between two refreshes
+    and halves it for those that drifted by less than `target / 2`, within [1 / max_scale, max_scale] times the
+    optimizer's schedule. Reads the drifts back to the host (one synchronization per step with refreshes).
+    """
+    if not refreshes:
+        return
+    for refresh, drift in zip(refreshes, torch.stack([d.float() for d in drifts]).tolist()):
+        refresh['drift'] = drift
+        if drift > target:
+            refresh['scale'] = min(refresh['scale'] * 2, max_scale)
+        elif drift < target / 2:
+            refresh['scale'] = max(refresh['scale'] / 2, 1 / max_scale)
+
+
+def soap_basis_drift(Q: List[Optional[Tensor]], GG: List[Optional[Tensor]]) -> Tensor:
+    """
+    How stale SOAP's eigenbases are: the largest relative off-diagonal (Frobenius) mass of Q^T GG Q over all factors,
+    0 if every Q diagonalizes its GG.
+    """
+    drifts = []
+    for q, gg in zip(Q, GG):
+        if q is None or gg is None:
+            continue
+        q = promote(q)
+        m = q.T @ promote(gg) @ q
+        off = m - torch.diag_embed(m.diagonal())
+        drifts.append(off.norm() / m.norm().clamp(min=torch.finfo(m.dtype).tiny))
+    if not drifts:
+        return torch.zeros(())
+    return torch.stack(drifts).max()
+
+
 def psgd_should_update(group, prob: Union[float, callable], rng: Optional[random.Random] = None,
-                       name: str = 'cumulative_prob'):
-    group[f'{name}_prob_step'] = group.get(f'{name}_prob_step', 0) + 1
+                       name: str = 'cumulative_prob', store: Optional[dict] = None):
+    """
+    Whether to run a scheduled update, given `group`'s `stochastic_schedule`. The schedule's counters are kept in
+    `store` (default: `group`), e.g. a parameter's state for per-parameter schedules.
+    """
+    store = group if store is None else store
+    store[f'{name}_prob_step'] = store.get(f'{name}_prob_step', 0) + 1
     if not isinstance(prob, float):
-        prob = prob(group[f'{name}_prob_step'])
+        prob = prob(store[f'{name}_prob_step'])
+    store[f'{name}_last_prob'] = float(prob)
     if group['stochastic_schedule']:
         return rng.random() < prob
-    cumulative_prob = group.get(name, 0)
-    group[name] = cumulative_prob + prob
-    return int(group[name]) > int(cumulative_prob)
+    cumulative_prob = store.get(name, 0)
+    store[name] = cumulative_prob + prob
+    return int(store[name]) > int(cumulative_prob)
 
 
 @decorator_knowngood
@@ -1448,9 +3278,9 @@ def precond_grad_cached_(expr: str, ea: Tensor, *cached_q: Tensor, caution: bool
     if caution:
         ea = _compilable_cautioning(grad, ea)
     md = min_dtype(list(cached_q) + [ea])
-    args = [q.to(md) for q in cached_q]
-    args = args + [ea.to(md)]
-    new = torch.einsum(expr, *args)
+    args = [q.to(md) for q in cached_q if not is_lowrank(q)]
+    args = args + [lowrank_precond_(ea, cached_q, gram=True).to(md)]
+    new = contract(expr, *args)
     if cast:
         return new.to(ea.dtype)
     return new
@@ -1463,7 +3293,7 @@ def _compilable_fused_precond_grad_cached_(expr: str, ea: Tensor, param, lr, gra
 
 
 def fused_precond_grad_cached_(expr: str, ea: Tensor, param, lr, grad, decay, caution, *cached_q: Tensor):
-    lr = scalar_guard(lr, param[0])
+    lr = scalar_guard(lr, param[0], name='fused_precond_grad_cached')
     _compilable_fused_precond_grad_cached_(expr, ea, param, lr, grad, decay, caution, *cached_q)
 
 
@@ -1471,10 +3301,11 @@ def fused_precond_grad_cached_(expr: str, ea: Tensor, param, lr, grad, decay, ca
 def psgd_precond_grad(expr: str, ea: Tensor, *preconds: Tensor, caution: bool = False, grad: Optional[Tensor] = None):
     if caution:
         ea = _compilable_cautioning(grad, ea)
-    md = min_dtype(list(preconds) + [ea])
-    args = [q.to(md) for q in preconds]
-    args = args + args + [ea.to(md)]
-    new = torch.einsum(expr, *args)
+    preconds = [unpack_triu(q) for q in preconds]
+    md = min_dtype(preconds + [ea])
+    args = [q.to(md) for q in preconds if not is_lowrank(q)]
+    args = args + args + [lowrank_precond_(ea, preconds, gram=True).to(md)]
+    new = contract(expr, *args)
     return new.to(ea.dtype)
 
 
@@ -1485,7 +3316,7 @@ def _compilable_fused_psgd_precond_grad(expr: str, ea: Tensor, param, lr, grad,
 
 
 def fused_psgd_precond_grad(expr: str, ea: Tensor, param, lr, grad, decay, caution, *preconds: Tensor):
-    lr = scalar_guard(lr, param[0])
+    lr = scalar_guard(lr, param[0], name='fused_psgd_precond_grad')
     _compilable_fused_psgd_precond_grad(expr, ea, param, lr, grad, decay, caution, *preconds)
 
 
@@ -1499,7 +3330,7 @@ def _compilable_mars_correction_(g: Tensor, old_g: Tensor, a: Tensor):
 def mars_correction(g, old_g, beta1, gamma):
     a = -gamma * beta1 / (1 - beta1)
     g, old_g = list_guard(g), list_guard(old_g)
-    a = scalar_guard(a, g[0])
+    a = scalar_guard(a, g[0], name='mars_correction')
     _compilable_mars_correction_(g, old_g, a)
 
 
@@ -1520,7 +3351,7 @@ def _compilable_orthogonalization(weight: List[Tensor], grad: List[Tensor], eps:
 
 def orthogonalize_grad_to_param(weight, grad, eps, graft=True):
     weight, grad = list_guard(weight, grad)
-    eps = scalar_guard(eps, weight[0])
+    eps = scalar_guard(eps, weight[0], name='orthogonalize_grad_to_param')
     _compilable_orthogonalization(weight, grad, eps, graft)
     return grad
 
@@ -1569,38 +3400,72 @@ def merge_group(group, *tensors):
     return out
 
 
-def hook_optimizer_into_model(model, optimizer, *args, **kwargs):
-    optimizers = {}
-
-    def _step(p: Tensor):
-        o = optimizers[p]
-        o.step()
-        o.zero_grad()
-
-    for p in model.parameters():
-        optimizers[p] = optimizer([p], *args, **kwargs)
-        p.register_post_accumulate_grad_hook(_step)
+def hook_optimizer_into_model(model, optimizer, *args, bucket_cap_mb: float = 0, **kwargs):
+    """
+    Steps every parameter as soon as its gradient is accumulated. All parameters share a single `optimizer` instance
+    (one set of param groups and states, one preconditioner schedule), which steps one parameter at a time via
+    `step_params`, so overheads scale with the model size instead of with the number of optimizer objects.
 
-    return optimizers
+    :param bucket_cap_mb: See `fused_hook`. By default, every parameter is stepped on its own.
+    :return: A dict mapping every parameter to the shared optimizer.
+    """
+    parameters = [p for p in model.parameters() if p.requires_grad]
+    o = fused_hook(parameters, optimizer, *args, bucket_cap_mb=bucket_cap_mb, **kwargs)
+    return {p: o for p in parameters}
 
 
-def fused_hook(parameters, optimizer, *args, **kwargs):
-    parameters = list(parameters)
-    param_count = len(parameters)
-    seen_params = set()
+def fused_hook(parameters, optimizer, *args, bucket_cap_mb: float = 25, **kwargs):
+    """
+    Runs `optimizer` inside the backward pass. Parameters are split into buckets of at most `bucket_cap_mb` MB, in
+    reverse registration order (the order in which backward usually produces their gradients). Each bucket is
+    stepped with one foreach `step_params` call as soon as all of its gradients are accumulated, so the optimizer step
+    overlaps with the remaining backward pass and gradients are freed bucket by bucket.
+    Every backward pass is one optimizer step. Parameters that receive no gradient in it (e.g. unused experts or
+    branches) are skipped: at the end of the backward pass, the rest of their buckets is stepped without them.
+    """
+    parameters = [p for p in parameters if p.requires_grad]
 
     o = optimizer(parameters, *args, **kwargs)
-    step_fn = o.step
+    step_fn = o.step_params
     o.step = functools.partial(warn_once,
                                msg="You're trying to call `step` on a fused optimizer. This will not do anything.")
 
-    def _step(p: Tensor):
-        seen_params.add(p)
+    buckets, size, cap = [], 0, bucket_cap_mb * 2 ** 20
+    for p in reversed(parameters):
+        nbytes = p.numel() * p.element_size()
+        if not buckets or size + nbytes > cap:
+            buckets.append([])
+            size = 0
+        buckets[-1].append(p)
+        size += nbytes
+    bucket_of = {id(p): i for i, bucket in enumerate(buckets) for p in bucket}
+    ready = [[] for _ in buckets]
+    active = begun = False  # whether this backward pass' `_finish` is queued, and whether its step has begun
+
+    def _flush(idx: int, end: bool = False):
+        nonlocal begun
+        params, ready[idx] = ready[idx], []
+        step_fn(params, begin=not begun, end=end)  # consumes (frees) the grads
+        begun = True
+
+    def _finish():  # runs once the backward pass is done
+        nonlocal active, begun
+        partial = [i for i, r in enumerate(ready) if r]
+        for i in partial:
+            _flush(i, end=i == partial[-1])
+        if not partial:
+            step_fn([], begin=False, end=True)
+        active = begun = False
 
-        if len(seen_params) < param_count:
-            step_fn()
-            o.zero_grad()
-            seen_params.clear()
+    def _step(p: Tensor):
+        nonlocal active
+        if not active:
+            active = True
+            torch.autograd.Variable._execution_engine.queue_callback(_finish)
+        idx = bucket_of[id(p)]
+        ready[idx].append(p)
+        if len(ready[idx]) == len(buckets[idx]):
+            _flush(idx)
 
     for p in parameters:
         p.register_post_accumulate_grad_hook(_step)
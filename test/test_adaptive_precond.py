@@ -0,0 +1,97 @@
+import pytest
+import torch
+from torch import nn
+
+import heavyball
+import heavyball.utils
+from heavyball.utils import clean, set_torch
+
+heavyball.utils.compile_mode = None
+
+
+def test_adaptive_should_update():
+    refresh = heavyball.utils.new_precond_refresh()
+    refresh['scale'] = 0.25
+    assert sum(heavyball.utils.adaptive_should_update(refresh, 1.0) for _ in range(16)) == 4
+
+    heavyball.utils.adapt_precond_schedule_([refresh], [torch.tensor(1.0)], 0.1)
+    assert refresh['scale'] == 0.5 and refresh['drift'] == 1
+    for _ in range(16):
+        heavyball.utils.adapt_precond_schedule_([refresh], [torch.tensor(0.0)], 0.1)
+    assert refresh['scale'] == 1 / 64
+
+
+@pytest.mark.parametrize("opt", ['ForeachSOAP', 'ForeachPSGDKron', 'ForeachCachedDelayedPSGDKron'])
+@pytest.mark.parametrize("size,depth", [(64, 2)])
+def test_adaptive_precond(opt, size, depth: int, iterations: int = 128):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    losses = []
+    for adaptive in [False, True]:
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)])
+        o = type(opt.__name__, (opt,), {'adaptive_precond': adaptive})(model.parameters(), lr=1e-3)
+        for i in range(iterations):
+            torch.manual_seed(i)
+            loss = model(torch.randn((64, size))).square().mean()
+            loss.backward()
+            o.step()
+            o.zero_grad()
+        losses.append(loss.item())
+
+        report = o.precond_report()
+        assert len(report) == 2 * depth
+        for refreshes in report.values():
+            assert len(refreshes) == 1
+            if adaptive:  # drifts are measured and rates moved away from the optimizer's schedule
+                assert refreshes[0]['drift'] is not None
+                assert refreshes[0]['scale'] != 1
+            else:
+                assert refreshes[0]['prob'] is None
+        del model, o
+        clean()
+
+    assert losses[1] < losses[0] * 10
+
+
+@pytest.mark.parametrize("finite_differences", [False, True])
+def test_hessian_subset(finite_differences, size: int = 32, iterations: int = 64):
+    set_torch()
+    hvp_inputs = []
+    grad = torch.autograd.grad
+
+    def counting_grad(outputs, inputs, *args, **kwargs):
+        hvp_inputs.append(len(inputs))
+        return grad(outputs, inputs, *args, **kwargs)
+
+    losses = []
+    for attrs in [{}, {'hessian_subset': True}, {'hessian_subset': True, 'adaptive_precond': True}]:
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(nn.Linear(size, size), nn.Tanh(), nn.Linear(size, 1))
+        opt = heavyball.ForeachCachedNewtonPSGD
+        o = type(opt.__name__, (opt,), {'finite_differences': finite_differences, **attrs})(model.parameters(), lr=1e-3)
+        hvp_inputs.clear()
+        torch.autograd.grad = counting_grad
+        try:
+            for i in range(iterations):
+                torch.manual_seed(i)
+                inp = torch.randn((16, size))
+
+                def closure():
+                    loss = model(inp).square().mean()
+                    loss.backward()
+                    return loss
+
+                loss = o.step(closure)
+                o.zero_grad()
+        finally:
+            torch.autograd.grad = grad
+        losses.append((loss.item(), sum(hvp_inputs)))
+        del model, o
+        clean()
+
+    assert losses[0] == losses[1]  # with the optimizer's schedule, every parameter is due whenever any is
+    if not finite_differences:
+        assert 0 < losses[2][1] < losses[0][1]
+    assert losses[2][0] < losses[0][0] * 10
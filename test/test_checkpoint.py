@@ -0,0 +1,118 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+from torch.utils._pytree import tree_flatten
+
+import heavyball
+import heavyball.utils
+from heavyball.utils import clean, set_torch
+
+heavyball.utils.compile_mode = None
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def _model(device):
+    torch.manual_seed(0x2131290)
+    return nn.Sequential(*[nn.Linear(32, 32) for _ in range(2)], nn.Unflatten(1, (4, 8)), nn.Conv1d(4, 4, 3)).to(device)
+
+
+def _train(model, o, steps, device):
+    for i in steps:
+        torch.manual_seed(i)
+        loss = model(torch.randn((64, 32), device=device)).square().mean()
+        loss.backward()
+        o.step()
+        o.zero_grad()
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachPSGDKron', 'PaLMForeachSFAdamW'])
+@pytest.mark.parametrize("device", devices)
+def test_save_load_state(opt, device, tmp_path, iterations: int = 16):
+    set_torch()
+    opt = getattr(heavyball, opt)
+    path = str(tmp_path / 'state.bin')
+
+    model = _model(device)
+    o = opt(model.parameters(), lr=1e-3, weight_decay=1e-4, warmup_steps=4)
+    _train(model, o, range(iterations // 2), device)
+    o.save_state(path)
+    saved = copy.deepcopy(model.state_dict())
+    _train(model, o, range(iterations // 2, iterations), device)
+
+    restored = _model(device)
+    restored.load_state_dict(saved)
+    o2 = opt(restored.parameters(), lr=1e-3, weight_decay=1e-4, warmup_steps=4)
+    o2.load_state(path)
+    if device == 'cpu':  # zero-copy views into the memory-mapped file
+        tensors = [t for state in o2.state.values() for t in tree_flatten(state)[0] if isinstance(t, torch.Tensor)]
+        assert len({t.untyped_storage().data_ptr() for t in tensors}) == 1
+    _train(restored, o2, range(iterations // 2, iterations), device)
+
+    for p0, p1 in zip(model.parameters(), restored.parameters()):
+        assert torch.equal(p0, p1)
+
+    del model, restored, o, o2
+    clean()
+
+
+@pytest.mark.parametrize("device", devices)
+def test_partial_load_state(device, tmp_path):
+    set_torch()
+    path = str(tmp_path / 'state.bin')
+
+    model = _model(device)
+    o = heavyball.ForeachSOAP(model.parameters(), lr=1e-3)
+    _train(model, o, range(4), device)
+    o.save_state(path)
+
+    o2 = heavyball.ForeachSOAP(model.parameters(), lr=1e-3)
+    params = list(model.parameters())
+    o2.load_state(path, params[:2])
+    restored = [state for _, state in o2._group_states({'params': params})]
+    saved = [state for _, state in o._group_states({'params': params[:2]})]
+    assert len(restored) == len(saved)
+    for new, old in zip(restored, saved):
+        assert torch.equal(new['scale_by_soap_exp_avg'], old['scale_by_soap_exp_avg'])
+
+    with pytest.raises(ValueError):
+        heavyball.ForeachSOAP(params[:2], lr=1e-3).load_state(path)
+
+    del model, o, o2
+    clean()
+
+
+@pytest.mark.parametrize("stochastic_schedule", [False, True])
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("device", devices)
+def test_resume_psgd(stochastic_schedule, streaming, device, tmp_path, iterations: int = 512):
+    set_torch()
+    path = str(tmp_path / 'state.bin')
+    kwargs = dict(lr=1e-3, preconditioner_update_probability=0.3, stochastic_schedule=stochastic_schedule)
+
+    model = _model(device)
+    o = heavyball.ForeachPSGDKron(model.parameters(), **kwargs)
+    _train(model, o, range(iterations // 2), device)
+    if streaming:
+        o.save_state(path)
+    else:
+        state = copy.deepcopy(o.state_dict())
+    saved = copy.deepcopy(model.state_dict())
+    _train(model, o, range(iterations // 2, iterations), device)
+
+    restored = _model(device)
+    restored.load_state_dict(saved)
+    o2 = heavyball.ForeachPSGDKron(restored.parameters(), **kwargs)
+    if streaming:
+        o2.load_state(path)
+    else:
+        o2.load_state_dict(state)
+    _train(restored, o2, range(iterations // 2, iterations), device)
+
+    for p0, p1 in zip(model.parameters(), restored.parameters()):
+        assert torch.equal(p0, p1)
+
+    del model, restored, o, o2
+    clean()
@@ -0,0 +1,58 @@
+import pytest
+import torch
+from torch import nn
+from torch._dynamo import config
+
+import heavyball
+import heavyball.utils
+from benchmark.utils import get_optim
+from heavyball.utils import clean, set_torch
+
+heavyball.utils.compile_mode = 'default'
+config.cache_size_limit = 128
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.fixture(autouse=True)
+def log_recompiles(monkeypatch):
+    monkeypatch.setenv("TORCH_LOGS", "+recompiles")  # for compile workers; this process parsed it at import
+    torch._logging.set_logs(recompiles=True)
+    yield
+    torch._logging.set_logs()
+
+
+@pytest.mark.parametrize("opt", heavyball.__all__)
+@pytest.mark.parametrize("size,depth", [(128, 2)])
+@pytest.mark.parametrize("device", devices)
+def test_compile_chain(opt, device, size, depth: int, iterations: int = 128, outer_iterations: int = 1):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    losses = []
+
+    for compile_chain in [True, False]:
+        torch.manual_seed(0x2131290)
+        losses.append([])
+
+        for i in range(outer_iterations):
+            model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+            o = get_optim(opt, [{'params': list(model.parameters()), 'compile_chain': compile_chain}], lr=1e-3,
+                          warmup_steps=16)
+
+            def _closure():
+                loss = model(torch.randn((1024, size), device=device)).square().mean()
+                loss.backward()
+                return loss
+
+            for _ in range(iterations):
+                loss = o.step(_closure)
+                o.zero_grad()
+                losses[-1].append(loss.detach())
+
+            del model, o
+            clean()
+
+    for i, (l0, l1) in enumerate(zip(*losses)):
+        print(i, l0.item(), l1.item())
+        assert torch.allclose(l0.float(), l1.float(), rtol=0.01)
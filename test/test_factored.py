@@ -0,0 +1,61 @@
+import functools
+
+import pytest
+import torch
+from torch import nn
+
+import heavyball
+import heavyball.chainable as C
+import heavyball.utils
+from heavyball.utils import clean, set_torch
+
+heavyball.utils.compile_mode = None
+
+
+class FactoredAdam(C.BaseOpt):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.99), eps=1e-8, weight_decay=0, warmup_steps=0,
+                 foreach: bool = True, storage_dtype: str = 'float32', mars: bool = False, caution: bool = False,
+                 mars_gamma: float = 0.0025, beta2_scale: float = 0.8):
+        defaults = locals()
+        defaults.pop("self")
+        params = defaults.pop("params")
+        super().__init__(params, defaults, foreach, None, None, False, C.exp_avg, C.scale_by_factored_exp_avg_sq)
+
+
+class AdafactorSOAP(heavyball.ForeachSOAP):
+    def __init__(self, params, **kwargs):
+        super().__init__(params, **kwargs)
+        self.fns = (functools.partial(C.scale_by_soap, inner='adafactor'),)
+
+
+def test_rank1_exact():
+    a, b = torch.randn(8), torch.randn(2, 3, 3)
+    grad = a[:, None, None, None] * b[None]  # conv kernel, merged to [8, 18]
+    state = heavyball.utils.factored_zeros_like(grad)
+    assert state.shape == (8 + 18,)
+    denom, = heavyball.utils.factored_exp_avg_sq_(state, grad, 0., 0.)
+    assert torch.allclose(denom, grad.abs(), rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize("opt", [FactoredAdam, AdafactorSOAP])
+@pytest.mark.parametrize("size,depth", [(64, 2)])
+def test_factored(opt, size, depth: int, iterations: int = 64):
+    set_torch()
+    torch.manual_seed(0x2131290)
+    model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)])
+    o = opt(model.parameters(), lr=1e-3)
+
+    losses = []
+    for _ in range(iterations):
+        loss = model(torch.randn((64, size))).square().mean()
+        loss.backward()
+        o.step()
+        o.zero_grad()
+        losses.append(loss.item())
+
+    # [size, size] weights keep 2 * size statistics, [size] biases a full second moment
+    assert o.memory_report()['by_key']['exp_avg_sq'] == depth * 3 * size * 4
+    assert sum(losses[-8:]) < sum(losses[:8]) / 4
+
+    del model, o
+    clean()
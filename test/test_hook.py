@@ -14,6 +14,8 @@ from torch._dynamo import config
 heavyball.utils.compile_mode = 'default'
 config.cache_size_limit = 128
 
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
 
 @pytest.mark.parametrize("opt", heavyball.__all__)
 @pytest.mark.parametrize("size,depth", [(128, 1)])
@@ -49,3 +51,90 @@ def test_foreach(opt, size, depth: int, iterations: int = 128, outer_iterations:
     for i, (l0, l1) in enumerate(zip(*losses)):
         print(i, l0.item(), l1.item())
         assert torch.allclose(l0.float(), l1.float(), rtol=0.1)
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachMuon', 'PaLMForeachSFAdamW'])
+@pytest.mark.parametrize("bucket_cap_mb", [0, 0.1, 25])
+@pytest.mark.parametrize("size,depth", [(128, 4)])
+@pytest.mark.parametrize("device", devices)
+def test_fused_hook(opt, bucket_cap_mb, device, size, depth: int, iterations: int = 32):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    params = []
+    for fused in [False, True]:
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+        if fused:
+            heavyball.utils.fused_hook(model.parameters(), opt, lr=1e-3, bucket_cap_mb=bucket_cap_mb)
+        else:
+            o = opt(model.parameters(), lr=1e-3)
+        for _ in range(iterations):
+            model(torch.randn((1024, size), device=device)).square().mean().backward()
+            if not fused:
+                o.step()
+                o.zero_grad()
+            assert all(p.grad is None for p in model.parameters())
+        params.append([p.detach().clone() for p in model.parameters()])
+        clean()
+
+    for p0, p1 in zip(*params):
+        assert torch.allclose(p0, p1, rtol=1e-4, atol=1e-6)
+
+
+class Branches(nn.Module):
+    def __init__(self, size):
+        super().__init__()
+        self.first = nn.Linear(size, size)
+        self.second = nn.Linear(size, size)
+
+    def forward(self, x, use_second: bool):
+        x = self.first(x)
+        return self.second(x) if use_second else x
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachPSGDKron', 'PaLMForeachSFAdamW'])
+@pytest.mark.parametrize("bucket_cap_mb", [0, 25])
+@pytest.mark.parametrize("device", devices)
+def test_fused_hook_unused_params(opt, bucket_cap_mb, device, size: int = 32, iterations: int = 16):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    params, optimizers = [], []
+    for fused in [False, True]:
+        torch.manual_seed(0x2131290)
+        model = Branches(size).to(device)
+        if fused:
+            o = heavyball.utils.fused_hook(model.parameters(), opt, lr=1e-3, bucket_cap_mb=bucket_cap_mb)
+        else:
+            o = opt(model.parameters(), lr=1e-3)
+            ready = []  # in the order backward produces the gradients, like the hooks
+            for p in model.parameters():
+                p.register_post_accumulate_grad_hook(ready.append)
+        for i in range(iterations):
+            torch.manual_seed(i)
+            model(torch.randn((16, size), device=device), use_second=i % 3 != 1).square().mean().backward()
+            if not fused and bucket_cap_mb:
+                o.step()
+            elif not fused:  # one slice per parameter, each with its own step count
+                for j, p in enumerate(ready):
+                    o.step_params([p], begin=j == 0, end=j == len(ready) - 1)
+            if not fused:
+                ready.clear()
+                o.zero_grad()
+            assert all(p.grad is None for p in model.parameters())  # partial buckets are stepped, too
+        params.append([p.detach().clone() for p in model.parameters()])
+        optimizers.append(o)
+        clean()
+
+    assert all(o.param_groups[0]['step_index'] == iterations for o in optimizers)
+    for p0, p1 in zip(*params):
+        assert torch.allclose(p0, p1, rtol=1e-4, atol=1e-6)
+
+
+def test_hook_bucket_cap(size: int = 16):
+    model = nn.Sequential(nn.Linear(size, size), nn.Linear(size, size))
+    o, = set(hook_optimizer_into_model(model, heavyball.ForeachAdamW, lr=1e-3, bucket_cap_mb=25).values())
+    model(torch.randn((4, size))).square().mean().backward()
+    assert o.param_groups[0]['step_index'] == 1
+    assert all(p.grad is None for p in model.parameters())
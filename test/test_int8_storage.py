@@ -0,0 +1,66 @@
+import pytest
+import torch
+from torch import nn
+from torch._dynamo import config
+
+import heavyball
+import heavyball.utils
+from benchmark.utils import get_optim
+from heavyball.utils import clean, set_torch
+
+config.cache_size_limit = 128
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def test_quantize_roundtrip(numel: int = 1000, samples: int = 256):
+    torch.manual_seed(0x2131290)
+    x = torch.randn(numel) * torch.logspace(-8, 0, numel)
+    buf = heavyball.utils.quantized_zeros_like(x)
+    assert buf.numel() == 4 * 260  # 4 blocks of 256 codes + 4 bytes scale
+
+    mean = torch.zeros_like(x)
+    for _ in range(samples):
+        heavyball.utils._quantize_(buf, x)
+        y = heavyball.utils._dequantize(buf, x)
+        assert (y - x).abs().max() <= 0.015 * x.abs().max()  # spacing of the top decade
+        mean += y / samples
+    assert (mean - x).abs().max() <= 0.003 * x.abs().max()  # stochastic rounding is unbiased
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachLaProp', 'ForeachADOPT', 'ForeachSOAP', 'ForeachMuon'])
+@pytest.mark.parametrize("size,depth", [(256, 2)])
+@pytest.mark.parametrize("device", devices)
+def test_foreach(opt, device, size, depth: int, iterations: int = 128, outer_iterations: int = 3):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    losses = []
+    sizes = []
+
+    for dtype_name in ["float32", "int8"]:
+        torch.manual_seed(0x2131290)
+        losses.append([])
+
+        for i in range(outer_iterations):
+            model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+            o = get_optim(opt, model.parameters(), lr=1e-3, storage_dtype=dtype_name)
+
+            for _ in range(iterations):
+                loss = model(torch.randn((1024, size), device=device)).square().mean()
+                loss.backward()
+                o.step()
+                o.zero_grad()
+                losses[-1].append(loss.detach())
+
+            sizes.append(o.memory_report()['by_key'])
+            del model, o
+            clean()
+
+    for key in ('exp_avg', 'exp_avg_sq', 'momentum'):
+        if key in sizes[0]:
+            assert sizes[-1][key] * 3.5 < sizes[0][key]
+
+    for i, (l0, l1) in enumerate(zip(*losses)):
+        print(i, l0.item(), l1.item())
+        assert torch.allclose(l0.float(), l1.float(), rtol=0.1)
@@ -61,3 +61,32 @@ def test_memory(opt, method, size, depth: int, iterations: int = 5, outer_iterat
         if i > 0:
             assert peak / model_allocated < v['peak']
             assert opt_allocated / model_allocated < v['after']
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachPSGDKron', 'ForeachCachedPSGDKron'])
+@pytest.mark.parametrize("size,depth", [(512, 2)])
+def test_memory_report(opt, size, depth: int, iterations: int = 3):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).cuda()
+    o = get_optim(opt, model.parameters(), lr=1e-3)
+    estimated = o.memory_report()['transient']['peak']
+    assert estimated > 0 and o.state_size() == 0
+
+    model_allocated = get_memory()
+    for _ in range(iterations):
+        model(torch.randn((1, size), device='cuda')).sum().backward()
+        o.step()
+        o.zero_grad()
+    model(torch.randn((1, size), device='cuda')).sum().backward()
+
+    report = o.memory_report()
+    assert all(p.grad is not None for p in model.parameters())  # no side effects
+    for breakdown in ('by_key', 'by_dtype', 'by_device', 'by_transform', 'by_group'):
+        assert sum(report[breakdown].values()) == report['total']
+    assert 0 < report['total'] == o.state_size() <= get_memory() - model_allocated
+    assert report['transient']['peak'] == estimated
+
+    del model, o
+    clean()
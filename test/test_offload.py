@@ -0,0 +1,89 @@
+import pytest
+import torch
+from torch import nn
+from torch.utils._pytree import tree_flatten
+
+import heavyball
+import heavyball.utils
+from heavyball.utils import clean, set_torch
+
+heavyball.utils.compile_mode = None  # the host path must work without a GPU (and without a compiler toolchain)
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachMuon', 'PaLMForeachSFAdamW'])
+@pytest.mark.parametrize("mode", ['offload_state', 'offload_step'])
+@pytest.mark.parametrize("device", devices)
+@pytest.mark.parametrize("size,depth", [(32, 4)])
+def test_offload(opt, mode, device, size, depth: int, iterations: int = 16):
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    results = []
+    for offload in [False, True]:
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+        cls = type(opt.__name__, (opt,), {mode: offload, 'offload_chunk_mb': size * size * 4 / 2 ** 20})
+        o = cls(model.parameters(), lr=1e-3, weight_decay=1e-4, warmup_steps=4)
+
+        for _ in range(iterations):
+            loss = model(torch.randn((64, size), device=device)).square().mean()
+            loss.backward()
+            o.step()
+            o.zero_grad()
+
+        if offload:
+            o.wait_offload()
+            assert len(o._offload_chunks(o.param_groups[0])) > 1
+            for p in model.parameters():
+                assert p.device.type == device.split(':')[0]
+            for t in o._offloaded_tensors(list(model.parameters())):
+                assert t.device.type == 'cpu'
+                assert t.is_pinned() == (mode == 'offload_state' and device != 'cpu')
+        results.append([p.detach().clone() for p in model.parameters()])
+        del model, o
+        clean()
+
+    for ref, off in zip(*results):
+        assert torch.allclose(ref, off)
+
+
+@pytest.mark.parametrize("opt", ['ForeachSOAP', 'ForeachPSGDKron'])
+@pytest.mark.parametrize("mode", [None, 'offload_state', 'offload_step'])
+@pytest.mark.parametrize("device", devices)
+@pytest.mark.parametrize("size,depth", [(32, 2)])
+def test_mmap(opt, mode, device, size, depth: int, tmp_path, iterations: int = 16):
+    if mode is None and device != 'cpu':
+        pytest.skip("mmap_dir needs offloading for parameters on a device")
+    set_torch()
+    opt = getattr(heavyball, opt)
+
+    results = []
+    for mmap in [False, True]:
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+        attrs = {'mmap_dir': str(tmp_path) if mmap else None}
+        if mode is not None:
+            attrs[mode] = True
+        o = type(opt.__name__, (opt,), attrs)(model.parameters(), lr=1e-3, weight_decay=1e-4, warmup_steps=4)
+
+        for _ in range(iterations):
+            loss = model(torch.randn((64, size), device=device)).square().mean()
+            loss.backward()
+            o.step()
+            o.zero_grad()
+
+        if mmap:
+            o.wait_offload()
+            mapped = [t for _, state in o._group_states(o.param_groups[0]) for t in tree_flatten(state['Q'])[0]
+                      if isinstance(t, torch.Tensor)]
+            assert mapped
+            assert all(t.data_ptr() == t.mmap_buffer.data_ptr() for t in mapped)
+            assert not list(tmp_path.iterdir())  # unlinked, freed with the state
+        results.append([p.detach().clone() for p in model.parameters()])
+        del model, o
+        clean()
+
+    for ref, off in zip(*results):
+        assert torch.allclose(ref, off)
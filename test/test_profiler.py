@@ -0,0 +1,46 @@
+import pytest
+import torch
+from torch import nn
+
+import heavyball
+import heavyball.utils
+from benchmark.utils import get_optim
+from heavyball.utils import clean, set_torch
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachPSGDKron', 'ForeachCachedPSGDKron'])
+@pytest.mark.parametrize("size,depth", [(128, 2)])
+@pytest.mark.parametrize("device", devices)
+def test_profiler(opt, device, size, depth: int, iterations: int = 8):
+    set_torch()
+    skips = opt in ('ForeachAdamW', 'ForeachSOAP')  # fused update, or SOAP's skipped first step
+    opt = getattr(heavyball, opt)
+
+    model = nn.Sequential(*[nn.Linear(size, size) for _ in range(depth)]).to(device)
+    o = get_optim(opt, model.parameters(), lr=1e-3)
+    o.profiler = heavyball.utils.StepProfiler()
+
+    for _ in range(iterations):
+        loss = model(torch.randn((1024, size), device=device)).square().mean()
+        loss.backward()
+        o.step()
+        o.zero_grad()
+
+    result = o.profiler.to_dict()
+    assert result['steps'] == iterations
+    transforms = result['groups'][0]
+    assert transforms['step']['calls'] == iterations
+    if device == 'cpu':
+        assert transforms['step']['device_ms'] is None
+    else:
+        assert transforms['step']['device_ms'] > 0
+    assert sum(t['calls'] for name, t in transforms.items() if name != 'step') >= iterations
+    assert (sum(t['skips'] for t in transforms.values()) > 0) == skips
+
+    trace = o.profiler.chrome_trace()
+    assert len(trace['traceEvents']) == len(result['events'])
+
+    del model, o
+    clean()
@@ -64,3 +64,173 @@ def test_clip(opt, method, size, depth: int, iterations: int = 100, outer_iterat
         if i > 0:
             assert peak / model_allocated < v['peak']
             assert opt_allocated / model_allocated < v['after']
+
+
+@pytest.mark.parametrize("store_triu_as_line", [False, True])
+@pytest.mark.parametrize("memory_save_mode", [None, 'one_diag'])
+@pytest.mark.parametrize("shape", [(16, 8), (4, 6, 8)])
+def test_foreach_update_precond(store_triu_as_line, memory_save_mode, shape, count: int = 4):
+    torch.manual_seed(0x12783)
+    grads = [torch.randn(shape, dtype=torch.float64) for _ in range(count)]
+    vectors = [torch.randn(shape, dtype=torch.float64) for _ in range(count)]
+    states = []
+    for g in grads:
+        Q, exprs = heavyball.utils.init_Q_exprs(g, 1, 1024, 2, memory_save_mode, torch.float64)
+        Q = [q + torch.randn_like(q).triu() * 0.1 if q.dim() == 2 else q for q in Q]
+        states.append([heavyball.utils.triu_to_line(Q) if store_triu_as_line else Q, exprs])
+    reference = [[(s, q.clone()) for s, q in Q] if store_triu_as_line else [q.clone() for q in Q] for Q, _ in states]
+
+    def materialize(Q):
+        return heavyball.utils.line_to_triu(Q) if store_triu_as_line else [q.clone() for q in Q]
+
+    for ref, g, v, (_, exprs) in zip(reference, grads, vectors, states):
+        heavyball.utils.psgd_update_precond(materialize(ref), exprs, g, 0.1, ref, store_triu_as_line, v)
+    heavyball.utils.foreach_psgd_update_precond([Q for Q, _ in states], [e for _, e in states], grads, 0.1,
+                                                [Q for Q, _ in states], store_triu_as_line, vectors)
+
+    for ref, (Q, _) in zip(reference, states):
+        for r, q in zip(ref, Q):
+            if store_triu_as_line:
+                r, q = r[1], q[1]
+            assert torch.allclose(r, q, atol=1e-6)
+
+
+@pytest.mark.parametrize("count", [1, 4])
+def test_update_precond_unpacked(count, shape=(16, 8)):
+    torch.manual_seed(0x12783)
+    grads = [torch.randn(shape, dtype=torch.float64) for _ in range(count)]
+    vectors = [torch.randn(shape, dtype=torch.float64) for _ in range(count)]
+    states, exprs = [], []
+    for g in grads:
+        Q, e = heavyball.utils.init_Q_exprs(g, 1, 1024, 2, None, torch.float64)
+        states.append(heavyball.utils.triu_to_line([q + torch.randn_like(q).triu() * 0.1 for q in Q]))
+        exprs.append(e)
+    dense = [heavyball.utils.line_to_triu(Q) for Q in states]
+    heavyball.utils.foreach_psgd_update_precond(dense, exprs, grads, 0.1, states, True, vectors)
+
+    for Q, D in zip(states, dense):  # the unpacked Q the caller passed in is updated along with the line
+        for q, d in zip(Q, D):
+            assert torch.equal(heavyball.utils.unpack_triu(q), d)
+
+
+@pytest.mark.parametrize("n", [1, 2, 7, 64])
+def test_unpack_triu(n):
+    q = torch.randn(n, n).triu()
+    line = heavyball.utils.triu_to_line([q])[0]
+    assert torch.equal(heavyball.utils.unpack_triu(line), q)
+    assert torch.equal(heavyball.utils.unpack_triu(line), heavyball.utils.line_to_triu([line])[0])
+    assert heavyball.utils.unpack_triu(q) is q
+    assert heavyball.utils._triu_flat_index(n, q.device) is heavyball.utils._triu_flat_index(n, q.device)
+    assert heavyball.utils._triu_line_index(n, q.device) is heavyball.utils._triu_line_index(n, q.device)
+
+
+@pytest.mark.parametrize("shape", [(16, 8), (4, 6, 8), (8, 4, 3, 3)])
+def test_contract(shape):
+    torch.manual_seed(0x12783)
+    g = torch.randn(shape, dtype=torch.float64)
+    Q, (exprA, _, exprP) = heavyball.utils.init_Q_exprs(g, 1, 1024, 2, None, torch.float64)
+    Q = [q + torch.randn_like(q).triu() * 0.1 if q.dim() == 2 else q for q in Q]
+    plan = heavyball.utils.psgd_precond_plan(exprP, g, Q)
+    assert plan is heavyball.utils.psgd_precond_plan(exprP, g, Q)
+    assert torch.allclose(heavyball.utils.contract(plan, *Q, *Q, g), torch.einsum(exprP, *Q, *Q, g))
+    assert torch.allclose(heavyball.utils.contract(exprA, *Q, g), torch.einsum(exprA, *Q, g))
+
+
+def test_psgd_cache_pays_off():
+    g = torch.randn(256, 256)
+    Q, _ = heavyball.utils.init_Q_exprs(g, 1, 1024, 2, None, torch.float32)
+    assert not heavyball.utils.psgd_cache_pays_off(Q, g, 1.0)  # rebuilt every step, as expensive as it saves
+    assert heavyball.utils.psgd_cache_pays_off(heavyball.utils.triu_to_line(Q), g, 0.5)
+
+    wide = torch.randn(8, 256)
+    Q, _ = heavyball.utils.init_Q_exprs(wide, 1, 1024, 2, None, torch.float32)
+    assert not heavyball.utils.psgd_cache_pays_off(Q, wide, 0.1)  # the 256^3 rebuild dominates
+    assert heavyball.utils.psgd_cache_pays_off(Q, wide, 0.01)
+
+    Q, _ = heavyball.utils.init_Q_exprs(g, 1, 1024, 2, 'all_diag', torch.float32)
+    assert not heavyball.utils.psgd_cache_pays_off(Q, g, 0.01)
+
+
+@pytest.mark.parametrize("store_triu_as_line", [True, False])
+@pytest.mark.parametrize("memory_save_mode", [None, 'one_diag'])
+def test_lowrank_precond(store_triu_as_line, memory_save_mode):
+    torch.manual_seed(0x12783)
+    g = torch.randn(96, 8, dtype=torch.float64)
+    Q, (exprA, _, exprP) = heavyball.utils.init_Q_exprs(g, 1, 32, 2, memory_save_mode, torch.float64, rank=4)
+    assert heavyball.utils.is_lowrank(Q[0]) and Q[0].shape == (96, 9) and not heavyball.utils.is_lowrank(Q[1])
+    Q[0][:, 1:] *= 20  # make the low-rank part significant
+    Q[1] += torch.randn_like(Q[1]).triu() * 0.1
+    d, U, V = heavyball.utils._lowrank_parts(Q[0])
+    dense = (torch.eye(96, dtype=torch.float64) + U @ V.T) @ torch.diag(d)
+
+    x = torch.randn(96, 5, dtype=torch.float64)
+    for transpose, inverse in [(False, False), (True, False), (False, True), (True, True)]:
+        ref = dense.inverse() if inverse else dense
+        ref = ref.T if transpose else ref
+        assert torch.allclose(heavyball.utils.lowrank_apply(Q[0], x, transpose, inverse), ref @ x)
+
+    kron = torch.kron(dense, Q[1])
+    expected = (kron.T @ kron @ g.flatten()).view_as(g)
+    if store_triu_as_line:
+        Q = heavyball.utils.triu_to_line(Q)
+    out = heavyball.utils.psgd_precond_grad(exprP, g.float(), *Q)
+    assert torch.allclose(out.double(), expected, rtol=1e-4, atol=1e-4 * expected.abs().max().item())
+
+
+@pytest.mark.parametrize("update_u", [True, False])
+def test_lowrank_update(update_u, size: int = 48, rank: int = 3, n: int = 7, lr: float = 0.1):
+    torch.manual_seed(0x12783)
+    q = heavyball.utils.init_lowrank_Q(size, rank, 1, torch.float64, 'cpu')
+    q[:, 1:] *= 20
+    q[:, 0] += torch.rand(size, dtype=torch.float64)
+    d, U, V = heavyball.utils._lowrank_parts(q)
+    eye = torch.eye(size, dtype=torch.float64)
+    dense = (eye + U @ V.T) @ torch.diag(d)
+    h, v = torch.randn(size, n, dtype=torch.float64), torch.randn(size, n, dtype=torch.float64)
+    a, b = dense @ h, torch.linalg.solve(dense.T, v)  # Qh and Q^-T v, computed densely
+
+    # Li's UVd update, with dense P = Q^T Q instead of Woodbury
+    P = dense.T @ dense
+    term_a, term_b = ((P @ h) * h).sum(1), (v * torch.linalg.solve(P, v)).sum(1)
+    dd = lr * d * (term_a - term_b) / (term_a.abs() + term_b.abs()).max()
+    dU, dV = torch.zeros_like(U), torch.zeros_like(V)
+    if update_u:
+        mu = lr / (a.norm() * (a.T @ V @ V.T).norm() + b.norm() * (b.T @ V @ V.T).norm())
+        dU = mu * (a @ a.T @ V - b @ b.T @ V) @ (torch.eye(rank, dtype=torch.float64) + V.T @ U)
+    else:
+        mu = lr / (a.norm() * (a.T @ U @ U.T).norm() + b.norm() * (b.T @ U @ U.T).norm())
+        dV = mu * ((a + V @ U.T @ a) @ a.T @ U - (b + V @ U.T @ b) @ b.T @ U)
+
+    out = heavyball.utils._lowrank_update(q, a, b, lr, update_u)
+    assert torch.allclose(out, torch.cat([dd.view(-1, 1), dU, dV], 1))
+
+    q = q - out
+    d, U, V = heavyball.utils._lowrank_parts(q)
+    dense = (eye + U @ V.T) @ torch.diag(d)
+    for transpose, inverse in [(False, False), (True, False), (False, True), (True, True)]:
+        ref = dense.inverse() if inverse else dense
+        ref = ref.T if transpose else ref
+        assert torch.allclose(heavyball.utils.lowrank_apply(q, h, transpose, inverse), ref @ h)
+
+
+class UnscheduledPSGD(heavyball.ForeachPSGDKron):
+    """
+    PSGD without an optimizer-wide precond_schedule, like a custom BaseOpt built from C.scale_by_psgd.
+    """
+
+    def __init__(self, params, **kwargs):
+        super().__init__(params, **kwargs)
+        self.precond_schedule = None
+
+
+@pytest.mark.parametrize("cached", [True, 'auto'])
+def test_cached_psgd_without_schedule(cached, size: int = 16, iterations: int = 4):
+    set_torch()
+    torch.manual_seed(0x2131290)
+    model = nn.Sequential(nn.Linear(size, size), nn.Linear(size, size))
+    o = UnscheduledPSGD(model.parameters(), lr=1e-3, cached=cached)
+    for _ in range(iterations):
+        model(torch.randn((8, size))).square().mean().backward()
+        o.step()
+        o.zero_grad()
+    assert all(torch.isfinite(p).all() for p in model.parameters())
@@ -0,0 +1,62 @@
+import contextlib
+
+import pytest
+import torch
+from torch import nn
+
+import heavyball
+import heavyball.utils
+from heavyball.utils import scalar_cache, scalar_guard, set_torch
+
+heavyball.utils.compile_mode = None
+
+devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+@pytest.mark.parametrize("device", devices)
+def test_scalar_cache_reuse(device):
+    ref = torch.zeros(4, device=device)
+    cache = {}
+    with scalar_cache(cache):
+        lr, beta = scalar_guard(0.1, 0.9, ref, name='test')
+        lr2, beta2 = scalar_guard(0.1, 0.9, ref, name='test')
+        assert lr is lr2 and beta is beta2
+        assert lr.device == ref.device and lr.dtype == torch.float32
+
+        other, _ = scalar_guard(0.1, 0.9, ref, name='other')  # names don't share tensors
+        assert other is not lr
+        step, _ = scalar_guard(1, 0.9, ref, name='test')  # neither do dtypes
+        assert step is not lr and step.dtype == torch.int64
+        assert scalar_guard(0.1, 0.9, ref, name='test')[0] is lr
+
+        lr3, _ = scalar_guard(0.2, 0.9, ref, name='test')  # e.g. lr warmup: refilled in-place
+        assert lr3 is lr and lr.item() == pytest.approx(0.2)
+
+    with scalar_cache(cache):  # the next step reuses the same tensors
+        assert scalar_guard(0.2, 0.9, ref, name='test')[0] is lr
+
+    assert scalar_guard(0.2, 0.9, ref, name='test')[0] is not lr  # no active cache
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSFAdamW', 'ForeachPSGDKron'])
+@pytest.mark.parametrize("device", devices)
+def test_scalar_cache_warmup(opt, device, monkeypatch, size: int = 32, iterations: int = 16):
+    set_torch()
+    params = []
+    for cached in [True, False]:
+        if not cached:
+            monkeypatch.setattr(heavyball.utils, 'scalar_cache', lambda cache: contextlib.nullcontext())
+        torch.manual_seed(0x2131290)
+        model = nn.Sequential(nn.Linear(size, size), nn.Linear(size, size)).to(device)
+        o = getattr(heavyball, opt)(model.parameters(), lr=1e-3, warmup_steps=iterations // 2)
+        for i in range(iterations):
+            torch.manual_seed(i)
+            model(torch.randn((8, size), device=device)).square().mean().backward()
+            o.step()
+            o.zero_grad()
+        if cached:
+            assert o._scalar_caches  # the cache was used
+        params.append([p.detach().clone() for p in model.parameters()])
+
+    for p0, p1 in zip(*params):
+        assert torch.equal(p0, p1)
@@ -0,0 +1,80 @@
+import os
+import socket
+import tempfile
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+
+import heavyball
+import heavyball.utils
+from heavyball.utils import set_torch
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _train(rank, world_size, opt, attrs, port, path, iterations: int = 8):
+    if world_size > 1:
+        dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    set_torch()
+
+    torch.manual_seed(0x2131290)
+    model = nn.Sequential(nn.Linear(32, 64), nn.ReLU(), nn.Linear(64, 16), nn.Linear(16, 16))
+    opt = type(opt, (getattr(heavyball, opt),), attrs)
+    o = opt(model.parameters(), lr=1e-3)
+    for i in range(iterations):
+        torch.manual_seed(i)  # identical data, and hence identical gradients, on every rank
+        model(torch.randn((8, 32))).square().mean().backward()
+        o.step()
+        o.zero_grad()
+
+    if attrs.get('shard_state'):
+        owned = [p for p, owner in zip(model.parameters(), o.shard_owners(o.param_groups[0])) if owner == rank]
+        assert {id(p) for p in o.state} <= {id(v) for p in owned for v in (p, *o.mapping.get(p, ()))}
+    torch.save([p.detach() for p in model.parameters()], f'{path}.{rank}')
+    if world_size > 1:
+        dist.barrier()  # gloo can hang in teardown if a peer has already exited
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("opt", ['ForeachAdamW', 'ForeachSOAP', 'ForeachLaProp'])
+@pytest.mark.parametrize("world_size", [2, 3])
+def test_sharded(opt, world_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'params')
+        _train(0, 1, opt, {}, None, f'{path}_ref')
+        mp.spawn(_train, args=(world_size, opt, {'shard_state': True}, _free_port(), path), nprocs=world_size)
+
+        reference = torch.load(f'{path}_ref.0')
+        for rank in range(world_size):
+            for p, r in zip(torch.load(f'{path}.{rank}'), reference):
+                assert torch.allclose(p, r, atol=1e-6)
+
+
+@pytest.mark.parametrize("opt", ['ForeachSOAP', 'ForeachPSGDKron', 'ForeachCachedPSGDKron'])
+@pytest.mark.parametrize("world_size", [2])
+def test_sharded_preconditioner(opt, world_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'params')
+        _train(0, 1, opt, {}, None, f'{path}_ref')
+        mp.spawn(_train, args=(world_size, opt, {'shard_preconditioner': True}, _free_port(), path),
+                 nprocs=world_size)
+
+        reference = torch.load(f'{path}_ref.0')
+        results = [torch.load(f'{path}.{rank}') for rank in range(world_size)]
+        for rank in range(1, world_size):  # replicated state stays in sync
+            assert all(torch.equal(p, r) for p, r in zip(results[rank], results[0]))
+        assert all(torch.allclose(p, r, atol=1e-6) for p, r in zip(results[0], reference))
+
+
+def test_partition_by_cost():
+    costs = [100, 1, 1, 50, 50, 1]
+    owners = heavyball.utils.partition_by_cost(costs, 2)
+    loads = [sum(c for c, o in zip(costs, owners) if o == r) for r in range(2)]
+    assert loads == [101, 102] or loads == [102, 101]
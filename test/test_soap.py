@@ -276,4 +276,61 @@ def test_project(size, max_precond, merge_dims, precondition_1d, beta, back, ite
         proj_ref = (project_back if back else project)(grad.clone(), ref_state, merge_dims, max_precond)
         proj_new = utils.project(grad.clone(), ref_state['Q'], merge_dims, max_precond, back)
 
-        assert ref_state['step'] and torch.allclose(proj_ref.contiguous(), proj_new.contiguous())
\ No newline at end of file
+        assert ref_state['step'] and torch.allclose(proj_ref.contiguous(), proj_new.contiguous())
+
+
+def _reference_qr(GG, Q):
+    out = []
+    for m, q in zip(GG, Q):
+        tmp = m @ q
+        est_eig = torch.einsum('ij,ij->j', q, tmp)
+        sort_idx = torch.argsort(est_eig, descending=True)
+        tmp[:, sort_idx], _ = torch.linalg.qr(tmp[:, sort_idx])
+        out.append(tmp)
+    return out
+
+
+@pytest.mark.parametrize('shapes', [[(_size, _size)] * 4, [(_size, _size), (_size, _size * 2), (_size * 2, _size)]])
+@torch.no_grad()
+def test_foreach_orthogonal_matrix_QR(shapes):
+    grads = [torch.randn(shape, dtype=torch.double) for shape in shapes]
+    states = [{} for _ in grads]
+    for g, st in zip(grads, states):
+        utils.init_preconditioner(g, st, max_precond_dim=10000, precondition_1d=False)
+        utils.update_ggt(torch.randn_like(g), st['GG'], 10000, False, 0.9)
+
+    GGs, Qs = [st['GG'] for st in states], [st['Q'] for st in states]
+    expected = [_reference_qr(GG, Q) for GG, Q in zip(GGs, Qs)]
+    utils.foreach_orthogonal_matrix_QR(GGs, Qs)
+    for Q, ref in zip(Qs, expected):
+        for q, r in zip(Q, ref):
+            assert torch.allclose(q, r)
+
+
+@torch.no_grad()
+def test_async_bases(shapes=((_size, _size), (_size, _size * 2), (_size, _size))):
+    params = [torch.randn(shape, dtype=torch.double) for shape in shapes]
+    ref_states, async_states = [{} for _ in params], [{} for _ in params]
+    for p, ref, st in zip(params, ref_states, async_states):
+        grad = torch.randn_like(p)
+        utils.init_preconditioner(grad, ref, max_precond_dim=10000, precondition_1d=False)
+        utils.init_preconditioner(grad, st, max_precond_dim=10000, precondition_1d=False, async_param=p)
+        assert all(torch.equal(q, torch.eye(q.shape[0], dtype=q.dtype)) for q in st['Q'])
+
+    utils.wait_async_bases()
+    utils.swap_async_bases(params, [st['Q'] for st in async_states], [None] * len(params))
+    for ref, st in zip(ref_states, async_states):
+        assert all(torch.allclose(q, r) for q, r in zip(st['Q'], ref['Q']))
+
+    exp_avgs = [torch.randn_like(p) for p in params]
+    ref_exp_avgs = [e.clone() for e in exp_avgs]
+    grads = [torch.randn_like(p) for p in params]
+    utils.foreach_update_preconditioner(grads, [st['Q'] for st in ref_states], [st['GG'] for st in ref_states],
+                                        ref_exp_avgs, 10000, False, 0.9, True)
+    utils.foreach_update_preconditioner(grads, [st['Q'] for st in async_states], [st['GG'] for st in async_states],
+                                        exp_avgs, 10000, False, 0.9, True, async_params=params)
+    utils.wait_async_bases()
+    utils.swap_async_bases(params, [st['Q'] for st in async_states], exp_avgs)
+    for ref, st, ref_exp_avg, exp_avg in zip(ref_states, async_states, ref_exp_avgs, exp_avgs):
+        assert all(torch.allclose(q, r) for q, r in zip(st['Q'], ref['Q']))
+        assert torch.allclose(exp_avg, ref_exp_avg)